@@ -0,0 +1,56 @@
+# Run many evshell commands at once through a server, from one
+# asyncio event loop with AsyncShell, and with a thread per command
+# calling the blocking client, and report the wall time and the
+# number of threads each needed.
+from evshell.aio import AsyncShell
+from evshell.client import run
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, DEVNULL
+from tempfile import TemporaryDirectory
+from time import time, sleep
+import asyncio
+import os
+import sys
+import threading
+
+cmd = "x=1; for i in 1 2 3; do x=$i; done; echo $x"
+
+async def run_async(sock:str, n:int)->int:
+    ash = AsyncShell(server=True, path=sock)
+    results = await asyncio.gather(*[ash.run(cmd) for i in range(n)])
+    assert all([r == (0, "3\n", "") for r in results])
+    return threading.active_count()
+
+def run_threads(sock:str, n:int)->int:
+    with open(os.devnull, "w") as null:
+        os.dup2(null.fileno(), 1)
+    with ThreadPoolExecutor(n) as pool:
+        futures = [pool.submit(run, ["-c", cmd], None, sock) for i in range(n)]
+        nthreads = threading.active_count()
+        assert all([f.result() == 0 for f in futures])
+    return nthreads
+
+if __name__ == "__main__":
+    n = 200
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    with TemporaryDirectory() as tmp:
+        sock = os.path.join(tmp, "server.sock")
+        server = Popen([sys.executable, "-m", "evshell.server", "--socket", sock, "--workers", "16"], stderr=DEVNULL)
+        try:
+            while not os.path.exists(sock):
+                sleep(0.01)
+            t0 = time()
+            nthreads = asyncio.run(run_async(sock, n))
+            t_async = time()-t0
+            print(f"{n} commands  asyncio: {t_async:6.2f}s with {nthreads} thread(s)")
+            sys.stdout.flush()
+            save = os.dup(1)
+            t0 = time()
+            nthreads = run_threads(sock, n)
+            t_threads = time()-t0
+            os.dup2(save, 1)
+            print(f"{n} commands  threads: {t_threads:6.2f}s with {nthreads} thread(s)")
+        finally:
+            server.kill()
+            server.wait()
@@ -0,0 +1,44 @@
+# Compare the size of JSON and binary logs and the time to
+# write them and to find one process's start record.
+from evshell.auditlog import get_log_format, read_log, Query
+from evshell.logwriter import LogWriter
+from tempfile import TemporaryDirectory
+from time import time
+import os
+import sys
+
+def records(n:int)->list:
+    recs = []
+    t = time()
+    for i in range(n):
+        t += 0.001
+        if i % 4 == 0:
+            recs += [{"msg":"start","pid":100000+i,"args":["/usr/bin/date","+%s"],"time":t,"script":"bash"}]
+        elif i % 4 == 1:
+            recs += [{"msg":"end","rc":"0","pid":100000+i-1,"time":t,"script":"bash"}]
+        else:
+            recs += [{"setvar":"i","value":str(i),"time":t,"script":"bash"}]
+    return recs
+
+def bench(fmt_name:str, recs:list, tmp:str)->None:
+    fmt = get_log_format(fmt_name)
+    fname = os.path.join(tmp, "log-1"+fmt.suffix)
+    t0 = time()
+    w = LogWriter(fmt.open(fname), fmt)
+    for rec in recs:
+        w.write(fmt.encode(rec))
+    w.close()
+    t1 = time()
+    found = list(read_log(fname, Query(pid=100000+len(recs)//2, events={"start"})))
+    t2 = time()
+    size = os.path.getsize(fname)
+    print(f"{fmt_name:6s}  size: {size/1024:8.1f}K  write: {1e6*(t1-t0)/len(recs):5.2f}us/record  search: {1e3*(t2-t1):7.2f}ms  found: {len(found)}")
+
+if __name__ == "__main__":
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    recs = records(n)
+    with TemporaryDirectory() as tmp:
+        for fmt_name in ["json", "binary"]:
+            bench(fmt_name, recs, tmp)
@@ -0,0 +1,42 @@
+# Throughput of run_batch() on many small generated scripts for
+# growing numbers of workers, against starting a new evshell
+# process for each script.
+from evshell.batch import run_batch
+from subprocess import run, DEVNULL
+from tempfile import TemporaryDirectory
+from time import time
+import os
+import sys
+
+script = """x={n}
+for i in 1 2 3; do y=$i; done
+z=$(echo $x)
+echo $x $y $z
+exit {rc}
+"""
+
+if __name__ == "__main__":
+    nscripts = 1000
+    if len(sys.argv) > 1:
+        nscripts = int(sys.argv[1])
+    with TemporaryDirectory() as tmp:
+        fnames = []
+        for n in range(nscripts):
+            fname = os.path.join(tmp, f"s{n}.sh")
+            with open(fname, "w") as fd:
+                fd.write(script.format(n=n, rc=n%2))
+            fnames += [fname]
+        nproc = min(20, nscripts)
+        t0 = time()
+        for fname in fnames[:nproc]:
+            run([sys.executable, "-c", "import evshell; evshell.main()", fname], stdout=DEVNULL)
+        rate = nproc/(time()-t0)
+        print(f"process per script: {rate:7.1f} scripts/s")
+        for workers in [1, 2, 4, 8]:
+            t0 = time()
+            results = list(run_batch(fnames, workers))
+            rate = nscripts/(time()-t0)
+            for res in results:
+                n = int(os.path.basename(res.fname)[1:-3])
+                assert res.stdout == f"{n} 3 {n}\n" and res.rc == n % 2, (res, res.stdout, res.stderr)
+            print(f"workers: {workers:3d}  {rate:7.1f} scripts/s")
@@ -0,0 +1,63 @@
+# Compare the breadth first brace expansion evshell used to have,
+# which builds every expansion as a list before any is used, with
+# the streaming one, on {a,b}{a,b}... words. Also run a for loop
+# over a large {1..N} sequence, which is expanded as it goes.
+from evshell import shell, expandCurly, Expando
+from evshell.tmpfile import tmpfile
+from time import time
+import sys
+import tracemalloc
+
+def old_build_strs(ex:Expando):
+    streams = [a for a in ex.a]
+    final_streams = []
+    while len(streams) > 0:
+        new_streams = []
+        for stream in streams:
+            found = False
+            for i in range(len(stream)):
+                item = stream[i]
+                if isinstance(item,Expando):
+                    found = True
+                    for a in item.a:
+                        new_streams += [stream[:i]+a+stream[i+1:]]
+                    break
+            if not found:
+                final_streams += [stream]
+        streams = new_streams
+    return final_streams
+
+def word_token(n:int):
+    # The evaluated form of the word {a,b} repeated n times
+    s = shell([])
+    m = s.matcher("echo "+"{a,b}"*n)
+    assert m.matches()
+    word = m.gr.children[0].children[1]
+    return s.eval(word)
+
+def measure(f):
+    # Time it, then run it again to see its peak memory,
+    # since tracing slows it down
+    t0 = time()
+    n = f()
+    t = time()-t0
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return n, t, peak
+
+if __name__ == "__main__":
+    n = 16
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    tok = word_token(n)
+    count, t, peak = measure(lambda: sum(1 for _ in old_build_strs(expandCurly(tok))))
+    print(f"{{a,b}}x{n}: {count} words  breadth first: {t:6.3f}s {peak/1e6:7.1f}MB", end="")
+    count, t, peak = measure(lambda: sum(1 for _ in expandCurly(tok).iter_strs()))
+    print(f"  streaming: {t:6.3f}s {peak/1e6:7.1f}MB")
+    s = shell([])
+    s.stdout = tmpfile()
+    for size in [1000, 20000]:
+        _, t, peak = measure(lambda: s.run_text(f"for i in {{1..{size}}}; do x=$i; done"))
+        print(f"for i in {{1..{size}}}: {t:6.3f}s  peak {peak/1e6:6.2f}MB")
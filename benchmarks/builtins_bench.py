@@ -0,0 +1,28 @@
+# Measure the throughput of a loop whose body runs small commands,
+# with the in-process builtins and with all of them switched off,
+# so that the programs they stand in for are run.
+from evshell import shell
+from time import time
+import os
+import sys
+
+def bench(n:int, builtins:bool)->None:
+    s = shell(["evshell"])
+    if not builtins:
+        s.builtins.clear()
+    s.stdout = open(os.devnull, "w")
+    txt = f'for i in $(seq 1 {n}); do echo $i; [ $i -gt 0 ] && true; done\n'
+    t0 = time()
+    s.run_text(txt)
+    t1 = time()
+    s.stdout.close()
+    mode = "on" if builtins else "off"
+    print(f"builtins: {mode:3s}  iterations: {n:6d}  total: {t1-t0:8.3f}s  iterations/s: {n/(t1-t0):8.1f}")
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]]
+    if len(sizes) == 0:
+        sizes = [100, 500]
+    for n in sizes:
+        for builtins in [False, True]:
+            bench(n, builtins)
@@ -0,0 +1,50 @@
+# Time a command line that expands globs over the same directories
+# several times, the way "cp src/*.c src/*.h dest/" or a loop over
+# *.dat does, with and without the shell's directory cache.
+from evshell import shell
+from evshell.tmpfile import tmpfile
+from time import time
+import os
+import shutil
+import sys
+import tempfile
+
+cmd = """
+for i in 1 2 3 4 5; do
+  echo src/*.c src/*.h data/*.dat > /dev/null
+done
+"""
+
+def make_tree(base:str, nfiles:int)->None:
+    for d, exts in [("src", ["c", "h", "o"]), ("data", ["dat", "txt"])]:
+        os.makedirs(os.path.join(base, d))
+        for i in range(nfiles):
+            ext = exts[i%len(exts)]
+            open(os.path.join(base, d, f"f{i}.{ext}"), "w").close()
+
+def run(s:shell, n:int)->float:
+    t0 = time()
+    for i in range(n):
+        s.run_text(cmd)
+    return (time()-t0)/n
+
+if __name__ == "__main__":
+    nfiles = 10000
+    if len(sys.argv) > 1:
+        nfiles = int(sys.argv[1])
+    base = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        make_tree(base, nfiles)
+        os.chdir(base)
+        s = shell([])
+        s.stdout = tmpfile()
+        cached = run(s, 5)
+        stats = s.dir_cache.stats()
+        s.dir_cache = None
+        uncached = run(s, 5)
+        print(f"files per dir: {nfiles}  no cache: {uncached*1e3:7.1f}ms  cache: {cached*1e3:7.1f}ms  per command line")
+        print(f"cache hits: {stats['hits']}  misses: {stats['misses']}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(base)
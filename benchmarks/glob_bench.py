@@ -0,0 +1,101 @@
+# Compare the recursive, character by character glob matcher that
+# evshell used to have with the compiled, scandir based one, on a
+# directory of many files. The old matcher is given a time limit,
+# since some patterns take it exponential time.
+from evshell.globber import glob
+from time import time
+import os
+import shutil
+import signal
+import sys
+import tempfile
+
+def old_fmatch(fn, pat, i1=0, i2=0):
+    while True:
+        if fn is None:
+            result = []
+            if pat[0] == ('/',):
+                for d in os.listdir(fn):
+                    result += old_fmatch('/'+d, pat, 1, 1)
+            else:
+                for d in os.listdir('.'):
+                    result += old_fmatch(d, pat, 0, 0)
+            return result
+        elif i2 == len(pat) and i1 == len(fn):
+            return [fn]
+        elif i1 == len(fn) and pat[i2] == ('/',):
+            dd = []
+            for k in os.listdir(fn):
+                dd += old_fmatch(os.path.join(fn,k), pat, i1, i2)
+            return dd
+        elif i2 >= len(pat):
+            return []
+        elif pat[i2] == ("g?",None):
+            i1 += 1
+            i2 += 1
+        elif pat[i2] == ("g*",None):
+            result = old_fmatch(fn, pat, i1, i2+1)
+            if i1+1 <= len(fn):
+                if len(result) == 0:
+                    result = old_fmatch(fn, pat, i1+1, i2+1)
+                if len(result) == 0:
+                    result = old_fmatch(fn, pat, i1+1, i2)
+            return result
+        elif i1 < len(fn) and (fn[i1],) == pat[i2]:
+            i1 += 1
+            i2 += 1
+        else:
+            return []
+
+def items_of(pattern:str):
+    return ["g"+c if c in "*?" else "l"+c for c in pattern]
+
+def old_pat_of(pattern:str):
+    return [("g"+c,None) if c in "*?" else (c,) for c in pattern]
+
+class Timeout(Exception):
+    pass
+
+def on_alarm(signum, frame):
+    raise Timeout()
+
+def timed(f, limit:int)->str:
+    signal.signal(signal.SIGALRM, on_alarm)
+    signal.alarm(limit)
+    t0 = time()
+    try:
+        n = len(f())
+    except Timeout:
+        return f"  >{limit}s"
+    finally:
+        signal.alarm(0)
+    return f"{time()-t0:6.3f}s ({n})"
+
+def make_tree(base:str, nfiles:int)->None:
+    for i in range(nfiles):
+        open(os.path.join(base, f"f{i:06d}_{'abc'[i%3]}x.txt"), "w").close()
+    for d in range(10):
+        sub = os.path.join(base, "d", f"s{d}")
+        os.makedirs(sub)
+        for i in range(100):
+            open(os.path.join(sub, f"g{i}.txt"), "w").close()
+
+if __name__ == "__main__":
+    nfiles = 100000
+    if len(sys.argv) > 1:
+        nfiles = int(sys.argv[1])
+    limit = 60
+    base = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        make_tree(base, nfiles)
+        os.chdir(base)
+        for pattern in ["f00001*", "*a*x*t*", "*a*b*c*", "d/s?/g1*.txt"]:
+            new = timed(lambda: glob(items_of(pattern)), limit)
+            old = timed(lambda: old_fmatch(None, old_pat_of(pattern)), limit)
+            print(f"{pattern:15s} old: {old:18s} new: {new}")
+        new = timed(lambda: glob(items_of("**/g1*.txt")), limit)
+        print(f"{'**/g1*.txt':15s} old: {'unsupported':18s} new: {new}")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(base)
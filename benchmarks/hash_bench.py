@@ -0,0 +1,26 @@
+# Compare finding a command through the command hash
+# with shutil.which, for PATHs of increasing length.
+from evshell.cmdhash import CommandHash
+from shutil import which
+from time import time
+import os
+import sys
+
+def bench(ndirs:int, n:int)->None:
+    path = ":".join(["/nonexistent/dir%d" % i for i in range(ndirs)] + [os.environ.get("PATH",os.defpath)])
+    t0 = time()
+    for i in range(n):
+        which("date", path=path)
+    t1 = time()
+    h = CommandHash()
+    for i in range(n):
+        h.lookup("date", path)
+    t2 = time()
+    print(f"PATH dirs: {ndirs:3d}+  which: {1e6*(t1-t0)/n:7.2f}us  hash: {1e6*(t2-t1)/n:7.2f}us  hits: {h.hits} misses: {h.misses}")
+
+if __name__ == "__main__":
+    n = 10000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for ndirs in [0, 10, 50]:
+        bench(ndirs, n)
@@ -0,0 +1,30 @@
+# Compare the time to start and wait for /bin/true through
+# Popen and posix_spawn as the memory of the parent grows.
+from evshell.pipe_threads import PipeThread
+from time import time
+import resource
+import sys
+
+def bench(launcher:str, n:int)->float:
+    t0 = time()
+    for i in range(n):
+        p = PipeThread(["/bin/true"], launcher=launcher)
+        p.start()
+        p.communicate()
+    return (time()-t0)/n
+
+def rss_mb()->float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+if __name__ == "__main__":
+    n = 200
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    ballast = []
+    for mb in [0, 256, 1024, 2048]:
+        # Touch every page so the memory is really mapped
+        while len(ballast) < mb:
+            ballast += [bytearray(b"x"*(1024*1024))]
+        popen = bench("popen", n)
+        spawn = bench("spawn", n)
+        print(f"rss: {rss_mb():7.0f}MB  popen: {1e6*popen:8.1f}us  spawn: {1e6*spawn:8.1f}us")
@@ -0,0 +1,33 @@
+# Compare writing log records with a flush after each one,
+# as shell.log used to, against the batching LogWriter.
+from evshell.logwriter import LogWriter
+from tempfile import TemporaryFile
+from time import time
+import json
+import sys
+
+def record(i:int)->str:
+    return json.dumps({"msg":"set_var","var":"i","val":str(i),"time":time()})+"\n"
+
+def bench(n:int)->None:
+    with TemporaryFile("w") as fd:
+        t0 = time()
+        for i in range(n):
+            fd.flush()
+            fd.write(record(i))
+            fd.flush()
+        t1 = time()
+    with TemporaryFile("w") as fd:
+        w = LogWriter(fd)
+        t2 = time()
+        for i in range(n):
+            w.write(record(i))
+        w.close()
+        t3 = time()
+    print(f"records: {n:7d}  flush each: {1e6*(t1-t0)/n:6.2f}us  batched: {1e6*(t3-t2)/n:6.2f}us")
+
+if __name__ == "__main__":
+    n = 100000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    bench(n)
@@ -0,0 +1,23 @@
+# Measure the interpreter overhead of a loop whose
+# body does not start any processes.
+import evshell
+from evshell import shell
+from time import time
+import sys
+
+def bench(n:int)->None:
+    s = shell(["evshell"])
+    s.parse_cache = None
+    vals = " ".join([str(i) for i in range(n)])
+    txt = f'for i in {vals}\ndo\n  x=$i\n  y="a $x b"\n  z=foo\ndone\n'
+    t0 = time()
+    s.run_text(txt)
+    t1 = time()
+    print(f"iterations: {n:6d}  total: {t1-t0:8.3f}s  per iteration: {1e6*(t1-t0)/n:8.1f}us")
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]]
+    if len(sizes) == 0:
+        sizes = [1000, 10000]
+    for n in sizes:
+        bench(n)
@@ -0,0 +1,36 @@
+# Measure parse time of generated scripts of increasing
+# size, with and without packrat memoization. The time per
+# line should stay flat for the packrat parser.
+from evshell import pp, packrat_grammar
+from evshell.packrat import PackratMatcher
+from piraha import Matcher
+from time import time
+import sys
+
+def gen_script(n:int)->str:
+    s = ""
+    for i in range(n):
+        s += f"for i in 1 2 3\ndo\n  echo $i ${{x:-a}} \"q $i\" > /dev/null\ndone\n"
+        s += f"if [ $a = {i} ]; then echo {i}; fi\n"
+    return s
+
+def bench(n:int)->None:
+    txt = gen_script(n)
+    pg = packrat_grammar()
+    t0 = time()
+    m = Matcher(pp, "whole_cmd", txt)
+    assert m.matches()
+    t1 = time()
+    m2 = PackratMatcher(pg, "whole_cmd", txt)
+    assert m2.matches()
+    t2 = time()
+    assert m2.gr.dump() == m.gr.dump()
+    lines = txt.count("\n")
+    print(f"lines: {lines:6d}  plain: {t1-t0:8.3f}s ({1e6*(t1-t0)/lines:7.1f}us/line)  packrat: {t2-t1:8.3f}s ({1e6*(t2-t1)/lines:7.1f}us/line)  hits: {m2.hits} misses: {m2.misses}")
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]]
+    if len(sizes) == 0:
+        sizes = [50, 100, 200, 400]
+    for n in sizes:
+        bench(n)
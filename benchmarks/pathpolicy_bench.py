@@ -0,0 +1,57 @@
+# Compare path decisions per second for a linear scan over allowed
+# and denied roots, the way a hand written allow_read hook would do
+# it, with a PathPolicy, for growing numbers of roots.
+from evshell import ShellAccess
+from evshell.policy import PathPolicy
+from time import time
+import os
+import random
+import sys
+import tempfile
+
+def make_roots(base:str, nroots:int):
+    allowed = [os.path.join(base, f"proj{i}") for i in range(nroots)]
+    denied = [os.path.join(base, f"proj{i}", "secret") for i in range(nroots)]
+    return allowed, denied
+
+def old_allow_read(allowed, denied, fname:str)->str:
+    path = os.path.realpath(fname)
+    for root in denied:
+        if path == root or path.startswith(root+"/"):
+            raise ShellAccess("no")
+    for root in allowed:
+        if path == root or path.startswith(root+"/"):
+            return path
+    raise ShellAccess("no")
+
+def make_queries(base:str, nroots:int, n:int):
+    random.seed(1)
+    queries = []
+    for i in range(n):
+        r = random.randrange(nroots*2)
+        sub = random.choice(["src/a.c", "secret/key", "doc/x/y/z.txt"])
+        # A limited set of distinct paths, as in a real session
+        queries += [os.path.join(base, f"proj{r}", sub)]
+    return queries
+
+def run(check, queries)->float:
+    t0 = time()
+    for q in queries:
+        try:
+            check(q)
+        except ShellAccess:
+            pass
+    return len(queries)/(time()-t0)
+
+if __name__ == "__main__":
+    n = 20000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    base = os.path.realpath(tempfile.gettempdir())
+    for nroots in [10, 100, 1000]:
+        allowed, denied = make_roots(base, nroots)
+        policy = PathPolicy(read=allowed, deny=denied)
+        queries = make_queries(base, nroots, n)
+        old = run(lambda q: old_allow_read(allowed, denied, q), queries)
+        new = run(policy.allow_read, queries)
+        print(f"roots: {nroots:5d}  linear scan: {old:9.0f}/s  prefix tree: {new:9.0f}/s")
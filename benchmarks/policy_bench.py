@@ -0,0 +1,86 @@
+# Compare policy decisions per second for rules checked the way
+# myshell.py does it with a compiled AccessPolicy, for a policy
+# with many commands, each with many allowed flags.
+from evshell import ShellAccess
+from evshell.policy import AccessPolicy
+from time import time
+import random
+import re
+import sys
+
+class regex:
+    def __init__(self,r):
+        self.r = r
+    def ok(self,a):
+        return re.match(r"^"+self.r+r"$", a)
+
+def make_rules(ncmds:int, nflags:int):
+    spec = {"max_args":20, "max_arg_size":1024, "commands":{}}
+    allowed = {}
+    for c in range(ncmds):
+        flags = [f"--flag{f}" for f in range(nflags)]
+        pats = [f"[0-9]{{{c%5+1}}}", "[a-z]+\\.txt", f"opt{c}=[a-z]+"]
+        spec["commands"][f"/usr/bin/cmd{c}"] = {"args": flags + [{"regex":p} for p in pats]}
+        allowed[f"/usr/bin/cmd{c}"] = tuple(flags + [regex(p) for p in pats])
+    return spec, allowed
+
+def old_allow_cmd(allowed, args):
+    if len(args) > 20:
+        return False
+    if args[0] in allowed:
+        for a in args[1:]:
+            if len(a) > 1024:
+                return False
+            found = False
+            for p in allowed[args[0]]:
+                if type(p) == str:
+                    if p == a:
+                        found = True
+                        break
+                elif p.ok(a):
+                    found = True
+                    break
+            if not found:
+                raise ShellAccess("no")
+        return args
+    raise ShellAccess("no")
+
+def make_queries(ncmds:int, nflags:int, n:int):
+    random.seed(1)
+    queries = []
+    for i in range(n):
+        c = random.randrange(ncmds)
+        args = [f"/usr/bin/cmd{c}"]
+        for j in range(5):
+            k = random.randrange(4)
+            if k == 0:
+                args += [f"--flag{random.randrange(nflags)}"]
+            elif k == 1:
+                args += ["data.txt"]
+            elif k == 2:
+                args += [f"opt{c}=abc"]
+            else:
+                args += ["--nope"]
+        queries += [args]
+    return queries
+
+def run(check, queries)->float:
+    t0 = time()
+    for q in queries:
+        try:
+            check(q)
+        except ShellAccess:
+            pass
+    return len(queries)/(time()-t0)
+
+if __name__ == "__main__":
+    n = 20000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for ncmds, nflags in [(10, 5), (300, 50)]:
+        spec, allowed = make_rules(ncmds, nflags)
+        policy = AccessPolicy(spec)
+        queries = make_queries(ncmds, nflags, n)
+        old = run(lambda q: old_allow_cmd(allowed, q), queries)
+        new = run(lambda q: policy.check_cmd(None, q), queries)
+        print(f"commands: {ncmds:4d}  flags: {nflags:3d}  myshell style: {old:9.0f}/s  compiled: {new:9.0f}/s")
@@ -0,0 +1,35 @@
+# Compare running a gateway command in a new evshell process
+# with handing it to a running server through client.py.
+from subprocess import Popen, run, DEVNULL
+from tempfile import TemporaryDirectory
+from time import time, sleep
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+client = os.path.join(here, "..", "evshell", "client.py")
+
+def bench(cmd:list, env:dict, n:int)->float:
+    t0 = time()
+    for i in range(n):
+        run(cmd, env=env, stdout=DEVNULL, check=True)
+    return (time()-t0)/n
+
+if __name__ == "__main__":
+    n = 20
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    env = dict(os.environ)
+    env["SSH_ORIGINAL_COMMAND"] = "x=1; echo $x"
+    with TemporaryDirectory() as tmp:
+        sock = os.path.join(tmp, "server.sock")
+        server = Popen([sys.executable, "-m", "evshell.server", "--socket", sock], stderr=DEVNULL)
+        try:
+            while not os.path.exists(sock):
+                sleep(0.01)
+            direct = bench([sys.executable, "-c", "import evshell; evshell.main()"], env, n)
+            served = bench([sys.executable, "-S", client, "--socket", sock], env, n)
+        finally:
+            server.kill()
+            server.wait()
+    print(f"new process: {1e3*direct:7.2f}ms  server: {1e3*served:7.2f}ms")
@@ -0,0 +1,55 @@
+# Run independent shell sessions in threads of one process, each
+# with its own directory (shell(cwd=...)), and check that none of
+# them sees another's directory, variables, files or jobs. Reports
+# command lines per second as the number of sessions grows.
+from evshell import shell
+from evshell.tmpfile import tmpfile
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from time import time
+import os
+import sys
+
+script = """
+cd work
+me={n}
+echo $me > mine.txt
+sleep 0.01 &
+wait
+for f in *.txt; do cat $f; done
+echo $(pwd)
+"""
+
+def session(base:str, n:int, rounds:int)->int:
+    home = os.path.join(base, f"s{n}")
+    os.makedirs(os.path.join(home, "work"))
+    s = shell([], cwd=home)
+    for r in range(rounds):
+        s.stdout = tmpfile()
+        s.run_text(script.format(n=n))
+        s.run_text("cd ..")
+        out = s.stdout.getvalue().split()
+        # "wait" reports the one job of this session, and
+        # the only .txt file is the session's own
+        assert out.count("pid:") == 1, out
+        assert out.count(str(n)) == 1, out
+        assert os.path.join(os.path.realpath(home), "work") in out, out
+    return rounds
+
+if __name__ == "__main__":
+    rounds = 20
+    if len(sys.argv) > 1:
+        rounds = int(sys.argv[1])
+    with TemporaryDirectory() as base:
+        cwd = os.getcwd()
+        base1 = rate1 = None
+        for nsessions in [1, 2, 4, 8, 16]:
+            sub = os.path.join(base, str(nsessions))
+            t0 = time()
+            with ThreadPoolExecutor(nsessions) as pool:
+                done = sum(pool.map(lambda n: session(sub, n, rounds), range(nsessions)))
+            rate = done/(time()-t0)
+            if rate1 is None:
+                rate1 = rate
+            assert os.getcwd() == cwd
+            print(f"sessions: {nsessions:3d}  {rate:7.1f} command lines/s  ({rate/rate1:4.1f}x)")
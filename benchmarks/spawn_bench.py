@@ -0,0 +1,42 @@
+# Measure the cost of starting an external command as the
+# number of exported variables grows. "env" is the time to
+# build the environment for one command: copying exports, as
+# the shell used to, or taking the shared snapshot.
+from evshell import shell
+from time import time
+import sys
+
+def best(f, n:int, repeat:int=5)->float:
+    times = []
+    for r in range(repeat):
+        t0 = time()
+        f()
+        times += [(time()-t0)/n]
+    return min(times)
+
+def bench(nvars:int, n:int)->None:
+    s = shell(["evshell"])
+    for i in range(nvars):
+        s.exports[f"BENCH_VAR_{i}"] = s.vars[f"BENCH_VAR_{i}"] = "x"*40
+    exports = s.exports
+    def copy_env()->None:
+        for i in range(1000):
+            env = {}
+            for k in exports:
+                env[k] = exports[k]
+    def snapshot_env()->None:
+        for i in range(1000):
+            s.environ()
+    txt = "\n".join(["/bin/true"]*n)+"\n"
+    s.run_text(txt)
+    t_copy = best(copy_env, 1000)
+    t_snap = best(snapshot_env, 1000)
+    t_cmd = best(lambda: s.run_text(txt), n)
+    print(f"exported: {len(exports):5d}  env copy: {1e6*t_copy:7.1f}us  env snapshot: {1e6*t_snap:5.2f}us  per command: {1e6*t_cmd:8.1f}us")
+
+if __name__ == "__main__":
+    n = 100
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for nvars in [0, 200, 1000, 5000]:
+        bench(nvars, n)
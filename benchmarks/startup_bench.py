@@ -0,0 +1,47 @@
+# Report import-to-first-prompt latency of evshell, and the
+# time to compile the grammar versus loading its snapshot.
+from subprocess import Popen, PIPE
+from time import time
+import sys
+
+child = """
+from time import time
+t0 = time()
+import evshell
+t1 = time()
+s = evshell.shell(["evshell"])
+t2 = time()
+print(t1-t0, t2-t0)
+"""
+
+def startup(n:int)->None:
+    imp, ready, total = 0.0, 0.0, 0.0
+    for i in range(n):
+        t0 = time()
+        p = Popen([sys.executable, "-c", child], stdout=PIPE, universal_newlines=True)
+        o, e = p.communicate()
+        total += time() - t0
+        a, b = o.split()
+        imp += float(a)
+        ready += float(b)
+    print(f"import: {1e3*imp/n:7.2f}ms  first prompt: {1e3*ready/n:7.2f}ms  process: {1e3*total/n:7.2f}ms")
+
+def grammar(n:int)->None:
+    from piraha import parse_peg_src
+    from evshell import grammar as src
+    from evshell.snapshot import compile_grammar
+    t0 = time()
+    for i in range(n):
+        parse_peg_src(src)
+    t1 = time()
+    for i in range(n):
+        compile_grammar(src)
+    t2 = time()
+    print(f"compile grammar: {1e3*(t1-t0)/n:7.2f}ms  load snapshot: {1e3*(t2-t1)/n:7.2f}ms")
+
+if __name__ == "__main__":
+    n = 10
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    startup(n)
+    grammar(n)
@@ -0,0 +1,26 @@
+# Compare $(...) and ( ... ) run by forking with the same
+# run in this process on a copy of the shell. The bodies use
+# only builtins, so no other process is started.
+from evshell import shell
+from evshell.tmpfile import tmpfile
+from time import time
+import sys
+
+def bench(txt:str, inline:bool, n:int)->float:
+    s = shell(["evshell"])
+    s.inline_subshells = inline
+    s.stdout = tmpfile()
+    body = "\n".join([txt]*n)+"\n"
+    s.run_text(body)
+    t0 = time()
+    s.run_text(body)
+    return (time()-t0)/n
+
+if __name__ == "__main__":
+    n = 200
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    for txt in ['x=$(printf hello)', '(y=1; printf $y)']:
+        fork = bench(txt, False, n)
+        inline = bench(txt, True, n)
+        print(f"{txt:20s}  fork: {1e6*fork:8.1f}us  in process: {1e6*inline:8.1f}us")
@@ -0,0 +1,35 @@
+# Measure loops dominated by conditionals. "forked" runs the test
+# program the way `if` used to for operators it did not know, and
+# "in process" uses the shell's own evaluator. Also shows how many
+# stat() calls an expression with several file tests makes.
+from evshell import shell
+from evshell.testexpr import TestExpr
+from time import time
+import os
+import sys
+
+def bench(n:int, test:str)->float:
+    s = shell(["evshell"])
+    s.stdout = open(os.devnull, "w")
+    txt = f'n={n//2}\nfor i in $(seq 1 {n}); do if {test} $i -lt $n ]; then x=$i; fi; done\n'
+    t0 = time()
+    s.run_text(txt)
+    t1 = time()
+    s.stdout.close()
+    return t1-t0
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]]
+    if len(sizes) == 0:
+        sizes = [100, 1000]
+    for n in sizes:
+        if n <= 1000:
+            t = bench(n, "/usr/bin/[")
+            print(f"forked:     iterations: {n:6d}  total: {t:8.3f}s  iterations/s: {n/t:8.1f}")
+        t = bench(n, "[")
+        print(f"in process: iterations: {n:6d}  total: {t:8.3f}s  iterations/s: {n/t:8.1f}")
+    s = shell(["evshell"])
+    args = "-e setup.py -a -f setup.py -a -r setup.py -a ! -L setup.py -a -s setup.py".split()
+    expr = TestExpr(s, args)
+    assert expr.evaluate()
+    print(f"file tests: 5  stat calls: {len(expr.stats)}")
@@ -0,0 +1,26 @@
+# Measure a loop that mostly assigns and expands variables,
+# logging every assignment and with deferred logging. The
+# script is parsed once beforehand, so only evaluation is timed.
+from evshell import shell
+from time import time
+import sys
+
+def bench(n:int, log_setvar:str)->None:
+    s = shell(["evshell"])
+    s.log_setvar = log_setvar
+    words = " ".join([str(i) for i in range(50)])
+    vals = " ".join([str(i) for i in range(n)])
+    txt = f'a="{words}"\nfor i in {vals}\ndo\n  x=$a\n  y=$i\n  z=$x\ndone\n'
+    s.run_text(txt)
+    t0 = time()
+    s.run_text(txt)
+    t1 = time()
+    print(f"log_setvar: {log_setvar:9s}  iterations: {n:6d}  per iteration: {1e6*(t1-t0)/n:8.1f}us")
+
+if __name__ == "__main__":
+    sizes = [int(a) for a in sys.argv[1:]]
+    if len(sizes) == 0:
+        sizes = [1000, 10000]
+    for n in sizes:
+        for log_setvar in ["immediate", "deferred"]:
+            bench(n, log_setvar)
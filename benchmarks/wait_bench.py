@@ -0,0 +1,39 @@
+# Measure how quickly `wait` notices that background jobs
+# have exited, and how much CPU the shell uses meanwhile.
+from evshell.pipe_threads import PipeThread, pwait
+from time import time
+import os
+import sys
+
+def bench(n:int, secs:float)->None:
+    jobs = []
+    for i in range(n):
+        p = PipeThread(["sleep",str(secs)])
+        p.background()
+        jobs += [p]
+    cpu0 = sum(os.times()[:2])
+    t0 = time()
+    for i in range(n):
+        p = pwait(None)
+        assert p is not None
+    t1 = time()
+    cpu1 = sum(os.times()[:2])
+    print(f"jobs: {n:4d}  wall: {t1-t0:6.3f}s  (sleep {secs}s)  cpu while waiting: {1e3*(cpu1-cpu0):7.2f}ms")
+
+def latency(n:int)->None:
+    # The exit time is not visible to us, so this
+    # includes the cost of starting the process.
+    t0 = time()
+    for i in range(n):
+        p = PipeThread(["true"])
+        p.background()
+        pwait(None)
+    t1 = time()
+    print(f"start+wait of 'true': {1e3*(t1-t0)/n:7.3f}ms")
+
+if __name__ == "__main__":
+    n = 100
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    bench(n, 1.0)
+    latency(n)
@@ -4,11 +4,25 @@
 # (2) Supercharge Jupyter: Allow in-process calling of bash from Python, save ENVIRON variables, etc.
 # (3) Call python functions from bash or bash functions from python
 from collections.abc import MutableMapping
-from typing import Optional, Dict, List, cast, Any, TypedDict, Union, Sequence, Tuple, IO, Callable
+from collections import OrderedDict
+from typing import Optional, Dict, List, cast, Any, TypedDict, Union, Sequence, Tuple, IO, Callable, Iterator, Iterable, Set
 from pwd import getpwnam, getpwuid
-from piraha import parse_peg_src, Matcher, Group
+from piraha import parse_peg_src, Matcher, Group, Grammar
 from subprocess import Popen, PIPE, STDOUT
-from .pipe_threads import PipeThread, get_lastpid, get_running, pwait
+from .pipe_threads import PipeThread, JobTable
+from .capture import Capture, CaptureFile, copy_fd
+from .logwriter import LogWriter
+from .auditlog import get_log_format
+from .varstore import VarStore, EnvStore
+from .globber import glob, DirCache
+from .pipes import Pipe, run_filter
+from .builtin_cmds import Builtin, builtin_cmds
+from .testexpr import CondWord, TestError, evaltest
+from threading import Thread, Lock
+from itertools import chain, count
+from functools import partial
+import inspect
+import copy
 import os
 import sys
 import re
@@ -20,9 +34,13 @@ from datetime import datetime
 from .tmpfile import tmpfile
 from .version import __version__
 from .completer import Completer
+from .cmdhash import CommandHash
+from .packrat import packratize, PackratMatcher
+from .snapshot import compile_grammar, grammar_stamp
 from time import time
 import json
 import pwd
+import hashlib
 
 enable_history : bool = True
 
@@ -95,6 +113,129 @@ def _deserGroup(data : SerGroupType, text : str)->Group:
 def deserGroup(data : SerType)->Group:
     return _deserGroup(data["root"],data["text"])
 
+class ParseCache:
+    """
+    A cache of parse trees keyed by a hash of the script text.
+    Entries are held in memory with LRU eviction. If cache_dir
+    is given, parse trees are also stored there (serialized with
+    serGroup) so that they survive between processes.
+
+    The key also covers stamp, which identifies the grammar,
+    so trees stored by another version of the grammar are not
+    used.
+
+    Script files read through read_file() are remembered by
+    path, and are only re-read if their mtime, ctime, or
+    size changes.
+    """
+    def __init__(self, max_entries:int=128, cache_dir:Optional[str]=None, stamp:str="")->None:
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.stamp = stamp
+        self.trees : 'OrderedDict[str,Group]' = OrderedDict()
+        self.files : 'OrderedDict[str,Tuple[Tuple[int,int,int],str]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Shells in several threads may share the cache
+        self.lock = Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, txt:str)->str:
+        h = hashlib.sha256(self.stamp.encode())
+        h.update(b"\0")
+        h.update(txt.encode())
+        return h.hexdigest()
+
+    def _remember(self, od:'OrderedDict[str,Any]', k:str, v:Any)->None:
+        od[k] = v
+        od.move_to_end(k)
+        while len(od) > self.max_entries:
+            od.popitem(last=False)
+
+    def get(self, txt:str)->Optional[Group]:
+        with self.lock:
+            return self._get(txt)
+
+    def _get(self, txt:str)->Optional[Group]:
+        k = self.key(txt)
+        gr = self.trees.get(k, None)
+        if gr is not None:
+            self.trees.move_to_end(k)
+        elif self.cache_dir is not None:
+            try:
+                with open(os.path.join(self.cache_dir, k+".json"), "r") as fd:
+                    data = json.load(fd)
+                if data["text"] == txt and data.get("stamp",None) == self.stamp:
+                    gr = deserGroup(data)
+                    self._remember(self.trees, k, gr)
+            except (OSError, ValueError, KeyError):
+                gr = None
+        if gr is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return gr
+
+    def put(self, txt:str, gr:Group)->None:
+        k = self.key(txt)
+        with self.lock:
+            self._remember(self.trees, k, gr)
+        if self.cache_dir is not None:
+            fname = os.path.join(self.cache_dir, k+".json")
+            tmp = fname+f".{os.getpid()}"
+            try:
+                data : Dict[str,Any] = dict(serGroup(gr))
+                data["stamp"] = self.stamp
+                with open(tmp, "w") as fd:
+                    json.dump(data, fd)
+                os.replace(tmp, fname)
+            except OSError:
+                pass
+
+    def _stamp(self, fname:str)->Optional[Tuple[int,int,int]]:
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_ctime_ns, st.st_size)
+
+    def read_file(self, fname:str)->Optional[str]:
+        """
+        Return the contents of fname if it is unchanged
+        since it was last given to add_file(), else None.
+        """
+        path = os.path.realpath(fname)
+        stamp = self._stamp(path)
+        with self.lock:
+            entry = self.files.get(path, None)
+            if entry is None:
+                return None
+            if entry[0] != stamp:
+                del self.files[path]
+                return None
+            self.files.move_to_end(path)
+            return entry[1]
+
+    def add_file(self, fname:str, txt:str)->None:
+        path = os.path.realpath(fname)
+        stamp = self._stamp(path)
+        if stamp is not None and stamp[2] == len(txt.encode()):
+            with self.lock:
+                self._remember(self.files, path, (stamp, txt))
+
+    def clear(self)->None:
+        with self.lock:
+            self.trees.clear()
+            self.files.clear()
+
+# Numbers the shells made in this process, for their log files
+shell_count = count()
+
+# Set EVSHELL_LOG_FORMAT to "binary" for compact, indexed logs.
+# Search either kind with python -m evshell.auditlog.
+default_log_format = os.environ.get("EVSHELL_LOG_FORMAT","json")
+
 
 # The way exit works is to raise SystemExit,
 # which may be caught. When we want to exit our
@@ -232,13 +373,34 @@ ident=[a-zA-Z0-9][a-zA-Z0-9_]*
 mathchar=(\)[^)]|[^)])
 math=\$\(\(({var}|{mathchar})*\)\)
 subproc=\$\(( {cmd})* \)
-cmd={subshell}|(( {word})+( {ending}|)|{ending})
+condword=(&&|\|\||[<>()])
+condre==~(?=[ \t])
+re_raw=(\\.|\$(?![a-zA-Z0-9_@?$!{(-])|[^\\"'\t \n$`])+
+reword=({var}|{math}|{subproc}|{squote}|{dquote}|{bquote}|{re_raw})+
+cond=\[\[( (?!\]\]){condre} {reword}| (?!\]\]){condword}| (?!\]\]){word})* \]\]
+cmd={subshell}|( ({cond}|(?!\[\[[ \t\n]){word})( ({cond}|{word}))*( {ending}|)|{ending})
 glob=\?|\*|\[.-.\]
 expand=[\{,\}]
 subshell=\(( {cmd})* \)
 whole_cmd=^( ({func}|{case}|{case2}|{cmd}))* $
 """
-pp,_ = parse_peg_src(grammar)
+pp,_ = compile_grammar(grammar)
+
+_packrat_pp : Optional[Grammar] = None
+
+def packrat_grammar()->Grammar:
+    """
+    A copy of pp prepared for PackratMatchers, so that plain
+    parses do not pay for the memo. Made when first needed.
+    """
+    global _packrat_pp
+    if _packrat_pp is None:
+        _packrat_pp = packratize(compile_grammar(grammar)[0])
+    return _packrat_pp
+
+# Shared by all shells in the process. Set EVSHELL_PARSE_CACHE
+# to a directory name to also keep parse trees on disk.
+default_parse_cache = ParseCache(cache_dir=os.environ.get("EVSHELL_PARSE_CACHE",None), stamp=grammar_stamp(grammar))
 
 class For:
     """
@@ -246,14 +408,23 @@ class For:
     the information needed to implement
     for loops.
     """
-    def __init__(self,variable:str,values:List[str])->None:
+    def __init__(self,variable:str,values:Iterable[str])->None:
         self.variable = variable
-        self.values = values
-        self.index = 0
+        # The values are taken one at a time, so that
+        # they need not all be expanded up front
+        self.values = iter(values)
+        self.value = ""
+        self.active = self.advance()
         self.docmd = -1
         self.donecmd = -1
+    def advance(self)->bool:
+        for value in self.values:
+            self.value = value
+            return True
+        self.active = False
+        return False
     def __repr__(self)->str:
-        return f"For({self.variable},{self.values},{self.docmd},{self.donecmd})"
+        return f"For({self.variable},{self.value},{self.docmd},{self.donecmd})"
 
 class Space:
     """
@@ -270,18 +441,6 @@ TokenElement = Union[str,Group,Space,Tuple[str,Group],Tuple[str]]
 # Space -> literal whitespace, token separator
 Token = List[TokenElement]
 
-def is_glob_star(elem : TokenElement)->bool:
-    if type(elem) == tuple and len(elem) == 2:
-        return elem[0] == "g*"
-    else:
-        return False
-
-def is_glob_question(elem : TokenElement)->bool:
-    if type(elem) == tuple and len(elem) == 2:
-        return elem[0] == "g?"
-    else:
-        return False
-
 def spaceout(a:Token)->Token:
     """
     Put a space between each member of a list
@@ -293,9 +452,10 @@ def spaceout(a:Token)->Token:
         b += list([a[i]])
     return b
 
-def deglob(a:Token)->Token:
+def deglob(a:Token, cache:Optional[DirCache]=None, cwd:Optional[str]=None)->Token:
     """
-    Process a file glob
+    Process a file glob. Relative names are
+    looked up in cwd if it is given.
     """
     assert type(a) == list
     has_glob = False
@@ -305,27 +465,69 @@ def deglob(a:Token)->Token:
     if not has_glob:
         return a
 
-    s : Token = []
+    items : List[str] = []
     raw = ''
     for k in a:
         if isinstance(k,Group) and k.is_("glob"):
             ks = k.substring()
-            s += list([("g"+ks,k)])
+            items += ["g"+ks]
             raw += ks
         elif isinstance(k,Group) and k.is_("expand"):
             here("remove this")
         elif type(k) == str:
             for c in k:
-                s += [(c,)]
+                items += ["l"+c]
             raw += k
         else:
             assert False
-    files = fmatch(None, s, i1=0, i2=0)
+    files = glob(items, cache, cwd)
     if len(files) == 0:
         return [raw]
     else:
         return spaceout(list(files))
 
+class BraceSeq:
+    """
+    The values of a sequence expression such as {1..10},
+    {01..10..3} or {a..e}, produced as they are iterated.
+    """
+    def __init__(self, first:int, last:int, step:int, width:int, chars:bool)->None:
+        step = abs(step) if step != 0 else 1
+        if first > last:
+            step = -step
+        self.values = range(first, last+(1 if step > 0 else -1), step)
+        self.width = width
+        self.chars = chars
+
+    def __iter__(self)->Iterator[Token]:
+        for v in self.values:
+            if self.chars:
+                yield [chr(v)]
+            elif v < 0:
+                yield ["-"+str(-v).zfill(self.width-1)]
+            else:
+                yield [str(v).zfill(self.width)]
+
+def brace_seq(text:str)->Optional[BraceSeq]:
+    """
+    Parse the inside of {...} as a sequence expression,
+    or return None if it is not one.
+    """
+    g = re.match(r'^(-?\d+)\.\.(-?\d+)(?:\.\.(-?\d+))?$', text)
+    if g:
+        width = 0
+        for n in [g.group(1), g.group(2)]:
+            if re.match(r'^-?0\d', n):
+                # Zero padded, to the width of the longer end
+                width = max(len(g.group(1)), len(g.group(2)))
+        step = int(g.group(3)) if g.group(3) else 1
+        return BraceSeq(int(g.group(1)), int(g.group(2)), step, width, False)
+    g = re.match(r'^([a-zA-Z])\.\.([a-zA-Z])(?:\.\.(-?\d+))?$', text)
+    if g:
+        step = int(g.group(3)) if g.group(3) else 1
+        return BraceSeq(ord(g.group(1)), ord(g.group(2)), step, 0, True)
+    return None
+
 class Expando:
     """
     Bookkeeping class used by expandCurly.
@@ -333,6 +535,7 @@ class Expando:
     def __init__(self)->None:
         self.a : List[List[Union[TokenElement,Expando]]] = [[]]
         self.parent : Optional['Expando']= None
+        self.seq : Optional[BraceSeq] = None
 
     def start_new_list(self)->'Expando':
         e = Expando()
@@ -344,7 +547,16 @@ class Expando:
         self.a += [[]]
 
     def end_list(self)->Optional['Expando']:
-        return self.parent
+        parent = self.parent
+        if len(self.a) == 1 and parent is not None:
+            items = self.a[0]
+            if all([type(item) == str for item in items]):
+                self.seq = brace_seq("".join(cast(List[str],items)))
+            if self.seq is None:
+                # Braces without a comma or a sequence are
+                # not expanded, as in bash
+                parent.a[-1][-1:] = ["{"] + items + ["}"]
+        return parent
 
     def add_item(self, item : TokenElement )->None:
         self.a[-1] += [item]
@@ -352,35 +564,54 @@ class Expando:
     def __repr__(self)->str:
         return "Expando("+str(self.a)+")"
 
+    def iter_strs(self)->Iterator[Token]:
+        """
+        Yield the expansions one at a time, in the
+        order bash gives them.
+        """
+        alternatives : Iterable[List[Union[TokenElement,Expando]]]
+        if self.seq is not None:
+            alternatives = cast(Iterable[List[Union[TokenElement,Expando]]], self.seq)
+        else:
+            alternatives = self.a
+        for alt in alternatives:
+            yield from expand_items(alt)
+
     def build_strs(self)->List[Token]:
-        # Make a copy a in stream
-        streams = [a for a in self.a]
-
-        # The result goes here
-        final_streams : List[List[Union[TokenElement,Expando]]] = []
-
-        show : bool = False
-
-        while len(streams) > 0:
-            new_streams = []
-            for stream in streams:
-                # Whether an Expand was found in the stream
-                found : bool = False
-                for i in range(len(stream)):
-                    item = stream[i]
-                    if isinstance(item,Expando):
-                        found = True
-                        show = True
-                        for a in item.a:
-                            # Create a new stream with each item in a of the Expando
-                            new_stream = stream[:i]+a+stream[i+1:]
-                            new_streams += [new_stream]
-                        break
-                if not found:
-                    final_streams += [stream]
-            streams = new_streams
-        return cast(List[Token],final_streams)
-            
+        return list(self.iter_strs())
+
+def expand_items(items:List[Union[TokenElement,Expando]])->Iterator[Token]:
+    """
+    Yield the expansions of a list of items, of which some may
+    be Expandos. The Expandos are stepped through like the digits
+    of a counter, the last one fastest.
+    """
+    places = [n for n, item in enumerate(items) if isinstance(item, Expando)]
+    if len(places) == 0:
+        yield cast(Token, items)
+        return
+    # The literal items before, between and after the Expandos
+    fixed = [cast(Token, items[a+1:b]) for a, b in zip([-1]+places, places+[len(items)])]
+    exps = [cast(Expando, items[n]) for n in places]
+    last = len(exps)-1
+    parts : List[Token] = [[] for _ in exps]
+    iters = [exps[0].iter_strs()]
+    while len(iters) > 0:
+        level = len(iters)-1
+        part = next(iters[level], None)
+        if part is None:
+            iters.pop()
+            continue
+        parts[level] = part
+        if level < last:
+            iters += [exps[level+1].iter_strs()]
+            continue
+        out = list(fixed[0])
+        for n in range(len(exps)):
+            out += parts[n]
+            out += fixed[n+1]
+        yield out
+
 def expandCurly(a:Token ,ex : Optional[Expando]=None,i:int=0,sub:int=0)->Expando:
     """
     The expandCurly method expands out curly braces on the command line,
@@ -409,53 +640,6 @@ def expandCurly(a:Token ,ex : Optional[Expando]=None,i:int=0,sub:int=0)->Expando
     assert ex is not None
     return ex
 
-def fmatch(fn:Optional[str],pat:Token,i1:int=0,i2:int=0)->List[str]:
-    """
-    Used by deglob() in processing globs in filenames.
-    """
-    while True:
-        if fn is None:
-            result = []
-            if pat[0] == ('/',):
-                for d in os.listdir(fn):
-                    result += fmatch('/'+d, pat, 1, 1)
-            else:
-                for d in os.listdir('.'):
-                    result += fmatch(d, pat, 0, 0)
-            return result
-        elif i2 == len(pat) and i1 == len(fn):
-            return [fn]
-        elif i1 == len(fn) and pat[i2] == ('/',):
-            dd = []
-            for k in os.listdir(fn):
-                ff = os.path.join(fn,k)
-                if i1 <= len(ff):
-                    dd += fmatch(os.path.join(fn,k), pat, i1, i2)
-            return dd
-        elif i2 >= len(pat):
-            return []
-        elif is_glob_question(pat[i2]):
-            # g? is a glob ? pattern
-            i1 += 1
-            i2 += 1
-        elif is_glob_star(pat[i2]):
-            # g* is a glob * pattern
-            if i2+1 <= len(pat):
-                result = fmatch(fn, pat, i1, i2+1)
-            else:
-                result = []
-            if i1+1 <= len(fn):
-                if len(result) == 0:
-                    result = fmatch(fn, pat, i1+1, i2+1)
-                if len(result) == 0:
-                    result = fmatch(fn, pat, i1+1, i2)
-            return result
-        elif i1 < len(fn) and i2 < len(pat) and (fn[i1],) == pat[i2]:
-            i1 += 1
-            i2 += 1
-        else:
-            return []
-
 def expandtilde(slist : Token)->Token:
     """
     The argument s, whether it's a list or a string,
@@ -481,7 +665,199 @@ def expandtilde(slist : Token)->Token:
             new_slist += [s]
     return new_slist
 
+def token_to_iargs(k:Group, ek:Token, cache:Optional[DirCache]=None, cwd:Optional[str]=None)->Iterator[str]:
+    """
+    Convert the evaluated form of the word k into
+    arguments, yielded one at a time.
+    """
+    if k.has(0,"dquote") or k.has(0,"squote"):
+        pass
+    else:
+        # expand ~/ and ~username/. This should
+        # not happen to quoted values.
+        ek = expandtilde(ek)
+
+    # Now the tricky part. Evaluate {a,b,c} elements of the shell.
+    # This can result in multiple arguments being generated.
+    nek : Token
+    for nek in expandCurly(ek).iter_strs():
+        # Evaluate globs
+        nek = deglob(nek, cache, cwd)
+        arg = ""
+        for kk in nek:
+            if isinstance(kk,Space):
+                yield arg
+                arg = ""
+            else:
+                arg += str(kk)
+        yield arg
+
+def token_to_args(k:Group, ek:Token, cache:Optional[DirCache]=None, cwd:Optional[str]=None)->List[str]:
+    """
+    Convert the evaluated form of the word k into
+    a list of arguments.
+    """
+    return list(token_to_iargs(k, ek, cache, cwd))
+
+def token_text(t:Token)->str:
+    return "".join([" " if isinstance(kk, Space) else str(kk) for kk in t])
+
+def cond_word(sh:Optional['shell'], k:Group)->CondWord:
+    """
+    Evaluate the word k of [[ ]]. It is neither split nor globbed,
+    and the parts of it that were quoted or escaped are marked, so
+    that they are literal in a pattern. sh may be None if k is static.
+    """
+    parts : List[Tuple[str,bool]] = []
+    for c in k.children:
+        if c.is_("raw_word") or c.is_("re_raw"):
+            for g in re.finditer(r'\\(.)|[^\\]+', c.substring(), re.DOTALL):
+                if g.group(1) is not None:
+                    parts += [(g.group(1), True)]
+                else:
+                    parts += [(g.group(0), False)]
+        elif c.is_("glob") or c.is_("expand"):
+            parts += [(c.substring(), False)]
+        else:
+            if is_static(c):
+                value = static_value(c)
+            else:
+                assert sh is not None
+                value = sh.eval(c)
+            parts += [(token_text(value), c.is_("squote") or c.is_("dquote"))]
+    return CondWord(parts)
+
+# Parse tree nodes whose value depends only on the text.
+static_nodes = set(["raw_word","re_raw","squote","dchar","dlit"])
+# Parse tree nodes that concatenate the values of their children.
+word_nodes = set(["word","word2","words2","reword","dquote"])
+# Parse tree nodes that are recorded in shell.cmds so
+# that loops can replay them.
+statement_nodes = set(["cmd","func","case","case2"])
+# Commands that change the shell process itself. A subshell
+# that may run one of them has to be forked.
+process_cmds = set(["cd","exec","source",".","wait","storeenv","loadenv","pyfrom"])
+
+def is_static(gr:Group)->bool:
+    if gr.name in static_nodes:
+        return True
+    elif gr.name in word_nodes:
+        for c in gr.children:
+            if not is_static(c):
+                return False
+        return True
+    else:
+        return False
+
+def static_value(gr:Group)->Token:
+    """
+    Evaluate a node for which is_static() is True.
+    """
+    name = gr.name
+    if name in ["raw_word", "re_raw"]:
+        return [unesc(gr.substring())]
+    elif name == "squote":
+        return [gr.substring()[1:-1]]
+    elif name == "dchar":
+        return [gr.substring()]
+    elif name == "dlit":
+        sl : str = gr.substring()
+        if sl == "\\n":
+            return ["\n"]
+        elif sl == "\\r":
+            return ["\r"]
+        else:
+            return [sl[1]]
+    elif name == "dquote":
+        return ["".join([str(x) for c in gr.children for x in static_value(c)])]
+    else:
+        s : Token = []
+        for c in gr.children:
+            s += static_value(c)
+        return s
+
+code_t = Callable[['shell',Group,int,Optional[str]],Token]
+
+def compile_group(gr:Group)->code_t:
+    """
+    Convert a parse tree node into a callable that evaluates it,
+    and store it on the node. Loops and function calls run the
+    stored callable rather than walking and dispatching on the
+    node names again. Constant words are evaluated only once.
+    """
+    code : code_t
+    name = gr.name
+    if is_static(gr):
+        value = static_value(gr)
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            return list(value)
+    elif name == "dquote":
+        parts = [(c,compile_group(c)) for c in gr.children]
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            ss : str = ""
+            for c, cc in parts:
+                for kk in cc(sh,c,-1,None):
+                    if type(kk) == Space:
+                        ss += ' '
+                    elif type(kk) == str:
+                        ss += kk
+                    else:
+                        assert False
+            return [ss]
+    elif name in word_nodes:
+        parts = [(c,compile_group(c)) for c in gr.children]
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            s : Token = []
+            for c, cc in parts:
+                s += cc(sh,c,-1,None)
+            return s
+    elif name == "var":
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            return sh.lookup_var(gr)
+    elif name in ["glob","expand"]:
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            return [gr]
+    elif name == "cmd":
+        # Each word, its arguments if they are known now,
+        # and whether it is an operand of [[ ]]
+        words : List[Tuple[Group,Optional[List[str]],bool]] = []
+        redir : Optional[Group] = None
+        ending : Optional[str] = None
+        for k in gr.children:
+            if k.is_("cond"):
+                # Inside [[ ]], operators such as && are arguments
+                words += [(k,["[["],False)]
+                for c in k.children:
+                    if c.is_("condword") or c.is_("condre"):
+                        words += [(c,[c.substring()],False)]
+                    elif is_static(c):
+                        words += [(c,[cond_word(None,c)],True)]
+                    else:
+                        words += [(c,None,True)]
+                words += [(k,["]]"],False)]
+            elif k.has(0,"redir"):
+                redir = k.children[0]
+            elif k.is_("ending"):
+                ending = k.substring()
+            elif is_static(k):
+                words += [(k,token_to_args(k,static_value(k)),False)]
+            else:
+                words += [(k,None,False)]
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            return sh.eval_cmd(gr, words, redir, ending, index, xending)
+    else:
+        def code(sh:'shell', gr:Group, index:int, xending:Optional[str])->Token:
+            r = sh.eval_(gr, index, xending)
+            if r is None:
+                r = []
+            return r
+    gr.code = code
+    return code
+
 pyfunc_t = Callable[['shell',List[str]],Token]
+# A pyfunc may also be a generator that takes an iterator over
+# the lines of its input and yields the text it outputs.
+pyfilter_t = Callable[['shell',List[str],Iterator[str]],Iterator[str]]
 
 def printf(sh:'shell', args : List[str])->Token:
     pyargs : List[Union[str,int,float]] = []
@@ -510,19 +886,46 @@ class Case:
         return f"Case('{self.word}',{self.active}"
 
 class shell:
-    
-    def __init__(self,args : List[str]=sys.argv, shell_name:str=my_shell, stdout:IO[str]=sys.stdout, stderr:IO[str]=sys.stderr, stdin:IO[str]=sys.stdin)->None:
+
+    @property
+    def vars(self)->VarStore:
+        return self._vars
+
+    @vars.setter
+    def vars(self, value:Dict[str,str])->None:
+        self._vars = value if isinstance(value, VarStore) else VarStore(value)
+
+    @property
+    def exports(self)->MutableMapping[str,str]:
+        return self._exports
+
+    @exports.setter
+    def exports(self, value:MutableMapping[str,str])->None:
+        if value is os.environ or isinstance(value, EnvStore):
+            self._exports = value
+        else:
+            self._exports = EnvStore(value)
+
+    def __init__(self,args : List[str]=sys.argv, shell_name:str=my_shell, stdout:IO[str]=sys.stdout, stderr:IO[str]=sys.stderr, stdin:IO[str]=sys.stdin, cwd:Optional[str]=None)->None:
+        # With cwd None, the shell uses the working directory of the
+        # process and cd changes it. Otherwise the shell keeps its own,
+        # so that shells running in different threads of one process
+        # do not interfere. They should also not bind_to_env().
+        self.cwd = None if cwd is None else os.path.realpath(cwd)
+        self.jobs = JobTable()
         self.alias_tab : Dict[str,str] = {}
         self.shell_name = shell_name
         self.args = args
         self.scriptname = "bash"
         self.txt = ""
         self.flags : Dict[str,bool] = {}
-        self.curr_pipe : Optional[Tuple[int,int]] = None
-        self.last_pipe : Optional[Tuple[int,int]] = None
+        self.curr_pipe : Optional[Pipe] = None
+        self.last_pipe : Optional[Pipe] = None
+        # Stages of the current pipeline that are still running
+        self.pipeline : List[Union[PipeThread,Thread]] = []
         self.vars = {
             "?":"0",
-            "PWD":os.path.realpath(os.getcwd()),
+            "PWD":self.getcwd(),
             "*":" ".join(self.args[1:]),
             "SHELL":os.path.realpath(shell_name),
             "PYTHON":sys.executable,
@@ -537,7 +940,7 @@ class shell:
         for vnum in range(len(args)):
             self.vars[str(vnum)] = args[vnum]
 
-        self.exports : MutableMapping[str,str] = {}
+        self.exports = EnvStore()
         for var in os.environ:
             if var not in self.vars:
                 self.vars[var] = os.environ[var]
@@ -552,16 +955,62 @@ class shell:
         self.case_stack : List[Case] = []
         self.funcs : Dict[str,List[Group]] = {}
         self.pyfuncs : Dict[str,pyfunc_t] = { "printf" : printf}
+        # Commands run in process rather than by starting a
+        # program. Removing one makes the shell run the program.
+        self.builtins : Dict[str,Builtin] = dict(builtin_cmds)
+        self.cmd_hash = CommandHash()
         self.save_in : List[IO[str]] = []
         self.save_out : List[IO[str]] = []
         self.last_ending : Optional[str] = None
         self.curr_ending : Optional[str] = None
         self.recursion = 0
         self.max_recursion_depth = 2000
+        # Set packrat to True to memoize the parser. The memo
+        # table for a single parse holds at most max_memo entries.
+        self.packrat = False
+        self.max_memo = 1000000
+        # Output of $(...) beyond this many bytes is
+        # collected in a temporary file.
+        self.max_capture_memory = 64*1024*1024
+        # How external commands are started: "spawn" uses
+        # os.posix_spawn, which does not copy the shell's memory,
+        # and falls back to "popen" when it cannot be used. From
+        # Python 3.10, Popen avoids the copy itself (with vfork).
+        self.launcher = "spawn" if sys.version_info < (3,10) else "popen"
+        # Run $(...) and ( ... ) in this process, on a copy of the
+        # shell, when they do not need a process of their own.
+        self.inline_subshells = True
+        # Directory listings read by globs and by tab completion.
+        # They are dropped after each command line, and reused
+        # within one while the directory is unchanged. Set
+        # dir_cache to None to read directories every time.
+        self.dir_cache : Optional[DirCache] = DirCache()
+        self.run_depth = 0
+        # Set parse_cache to None to always parse from scratch.
+        self.parse_cache : Optional[ParseCache] = default_parse_cache
         log_file_dir = os.path.join(self.vars["HOME"],".evshell-logs")
         os.makedirs(log_file_dir, exist_ok = True)
-        log_file = os.path.join(log_file_dir, f"log-{os.getpid()}.jtxt")
-        self.log_fd = open(log_file,"w")
+        self.log_format = get_log_format(default_log_format)
+        # Shells made after the first in a process get their own file
+        n = next(shell_count)
+        suffix = "" if n == 0 else f"-{n}"
+        log_file = os.path.join(log_file_dir, f"log-{os.getpid()}{suffix}{self.log_format.suffix}")
+        self.log_fd = self.log_format.open(log_file)
+        self.log_writer = LogWriter(self.log_fd, self.log_format)
+        # Records are written out within max_delay even if the
+        # shell is idle
+        self.log_writer.start_background()
+        # When to write log records out at once: "always",
+        # "security" (access violations), or "none".
+        self.log_sync = "security"
+        # With "immediate", every assignment is logged as it
+        # happens. With "deferred", which is faster but weaker,
+        # assignments are not logged one by one: the last value of
+        # each variable assigned since the previous record is logged,
+        # with a count, before the next record or a flush.
+        self.log_setvar = "immediate"
+        self.pending_vars : Dict[str,Tuple[Optional[str],int]] = {}
+        self.log_writer.pending = self.log_pending_vars
         self.log(msg="starting shell")
 
     def serialize(self, fd:IO[str])->None:
@@ -569,7 +1018,7 @@ class shell:
         print(json.dumps(self.exports),file=fd)
         print(json.dumps({
             "max_recursion_depth":self.max_recursion_depth,
-            "cwd":os.getcwd(),
+            "cwd":self.getcwd(),
         }),file=fd)
 
         # Serialize shell functions
@@ -590,7 +1039,7 @@ class shell:
         self.exports = json.loads(fd.readline())
         data = json.loads(fd.readline())
         self.max_recursion_depth = data["max_recursion_depth"]
-        os.chdir(data["cwd"])
+        self.chdir(data["cwd"])
 
         # Deserialize shell functions
         funcser = json.loads(fd.readline())
@@ -610,7 +1059,7 @@ class shell:
     def open_file(self, fname:str, rwa:str, line:int)->IO[str]:
         sout : Optional[IO[str]] = None
         try:
-            sout = open(fname, rwa)
+            sout = open(self.path(fname), rwa)
             self.log(open=fname,rwa=rwa)
         except PermissionError as pe:
             self.log(exc=pe,open=fname,rwa=rwa)
@@ -627,6 +1076,49 @@ class shell:
             self.stderr.flush()
         return sout
     
+    def getcwd(self)->str:
+        if self.cwd is None:
+            return os.path.realpath(os.getcwd())
+        return self.cwd
+
+    def chdir(self, dirname:str)->None:
+        if self.cwd is None:
+            os.chdir(dirname)
+            return
+        path = os.path.realpath(self.path(dirname))
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"No such directory: '{dirname}'")
+        if not os.access(path, os.X_OK):
+            raise PermissionError(f"Permission denied: '{dirname}'")
+        self.cwd = path
+
+    def path(self, fname:str)->str:
+        """
+        The name to use for fname in this process: fname
+        itself, unless it is relative and the shell has
+        a cwd of its own.
+        """
+        if self.cwd is None or os.path.isabs(fname):
+            return fname
+        return os.path.join(self.cwd, fname)
+
+    def read_script(self, fname:str, line:int)->str:
+        """
+        Read the contents of a script, consulting the
+        parse cache to avoid re-reading unchanged files.
+        """
+        fname = self.path(fname)
+        if self.parse_cache is not None:
+            txt = self.parse_cache.read_file(fname)
+            if txt is not None:
+                self.log(open=fname,rwa="r",cached=True)
+                return txt
+        with self.open_file(fname, "r", line) as fd:
+            txt = fd.read()
+        if self.parse_cache is not None:
+            self.parse_cache.add_file(fname, txt)
+        return txt
+
     def env_is_bound(self)->bool:
         return os.environ is self.exports
 
@@ -647,7 +1139,12 @@ class shell:
         self.exports = new_exports
 
     def log_flush(self)->None:
-        self.log_fd.flush()
+        self.log_writer.flush()
+
+    def log_pending_vars(self)->None:
+        pending, self.pending_vars = self.pending_vars, {}
+        for vname, (value, count) in pending.items():
+            self.log(setvar=vname,value=value,count=count)
 
     def log_exc(self,e : Exception)->None:
         print_exc()
@@ -656,13 +1153,19 @@ class shell:
         self.log_flush()
 
     def log(self,**kwargs:Any)->None:
-        self.log_flush()
+        if len(self.pending_vars) > 0:
+            self.log_pending_vars()
         args = prepJson(kwargs)
         if "time" not in args:
             args["time"] = time()
         args["script"] = self.scriptname
-        print(json.dumps(args),file=self.log_fd)
-        self.log_flush()
+        if self.log_sync == "always":
+            sync = True
+        elif self.log_sync == "security":
+            sync = any([isinstance(v, ShellAccess) for v in kwargs.values()])
+        else:
+            sync = False
+        self.log_writer.write(self.log_format.encode(args), sync)
 
     def unset_var(self,vname:str)->None:
         val = self.allow_set_var(vname, None)
@@ -687,7 +1190,11 @@ class shell:
             return self.vars.get(vname,"")
 
     def set_var(self,vname:str,value:Optional[str])->None:
-        self.log(setvar=vname,value=value)
+        if self.log_setvar == "deferred":
+            _, count = self.pending_vars.pop(vname, (None, 0))
+            self.pending_vars[vname] = (value, count+1)
+        else:
+            self.log(setvar=vname,value=value)
         assert vname != "2"
         value = self.allow_set_var(vname, value)
         if value is None:
@@ -695,7 +1202,7 @@ class shell:
             del self.exports[vname]
         else:
             self.vars[vname] = value
-            if self.flags.get("a",False):
+            if vname in self.exports or self.flags.get("a",False):
                 self.exports[vname] = value
 
     def allow_cd(self, cd_dir:str)->str:
@@ -736,10 +1243,15 @@ class shell:
         if varname == "$":
             return [str(os.getpid())]
         elif varname == "!":
-            return [str(get_lastpid())]
+            return [str(self.jobs.lastpid)]
         self.allow_access_var(varname)
+        if self.exports is os.environ:
+            # Python code may have changed the environment
+            value = os.environ.get(varname, None)
+            if value is not None and value != self.vars.get(varname, None):
+                self.vars[varname] = value
         if varname in self.vars:
-            v1 = spaceout(re.split(r'\s+', self.get_var(varname)))
+            v1 = spaceout(self.vars.split(varname))
         else:
             v1 = None
         if v1 is None and gr.has(1,"unset"):
@@ -765,62 +1277,34 @@ class shell:
 
     def evaltest(self, args : List[str], index:int=0)->Optional[bool]:
         """
-        Process calls to `test` or `if`, optimizing in some cases.
+        Process calls to `test` or `if`. An expression in [ ] or
+        [[ ]] is evaluated here, without running a command.
         """
-        evalresult = None
         if args[index] == "if":
             index += 1
         if args[index] in ["[[","["]:
-            start = args[index]
-            index += 1
-        else:
-            start = None
-        if index < len(args) and args[index] in ["-e","-w","r","-x","-f","-d"]:
-            op = args[index]
-            assert index+1 < len(args), f"No file following opertor '{op}'"
-            fname = args[index+1]
-            if op == "-x":
-                evalresult = os.path.exists(fname) and os.access(fname, os.X_OK)
-            elif op == "-r":
-                evalresult = os.path.exists(fname) and os.access(fname, os.R_OK)
-            elif op == "-w":
-                evalresult = os.path.exists(fname) and os.access(fname, os.W_OK)
-            elif op == "-e":
-                evalresult = os.path.exists(fname)
-            elif op == "-d":
-                evalresult = os.path.isdir(fname)
-            elif op == "-f":
-                evalresult = os.path.isfile(fname)
-            else:
-                assert False
-            index += 2
-        if index+1 < len(args) and args[index+1] in ["=","!=","\\<","<",">","\\>"]:
-            op = args[index+1]
-            arg1 = args[index]
-            arg2 = args[index+2]
-            index += 3
-            if op == "=":
-                evalresult = arg1 == arg2
-            elif op == "!=":
-                evalresult = arg1 != arg2
-            elif op in ["<","\\<"]:
-                evalresult = int(arg1) < int(arg2)
-            elif op in [">","\\>"]:
-                evalresult = int(arg1) > int(arg2)
-            else:
-                assert False
-        if index < len(args) and args[index] == "]":
-            index += 1
-            assert start == "[", f"Mismatched braces: '{start}' and '{args[index]}'"
-        if index < len(args) and args[index] == "]]":
-            index += 1
-            assert start == "[[", f"Mismatched braces: '{start}' and '{args[index]}'"
-        if start is not None:
-            pass #here(args)
-        if evalresult is None and args[0] == "if":
+            return self.test_brackets(args[index:])
+        if args[0] == "if":
             self.evalargs(args[1:], None, False, None, index, None)
-            evalresult = self.vars["?"] == "0"
-        return evalresult
+            return self.vars["?"] == "0"
+        return None
+
+    def test_brackets(self, args:List[str])->bool:
+        """
+        Evaluate [ expr ] or [[ expr ]] and set $? as the
+        command would, with 2 for a malformed expression.
+        """
+        close = "]" if args[0] == "[" else "]]"
+        try:
+            if args[-1] != close:
+                raise TestError(f"missing `{close}'")
+            result = evaltest(self, args[1:-1], close == "]]")
+            self.vars["?"] = "0" if result else "1"
+        except TestError as te:
+            print(f"{self.scriptname}: {args[0]}: {te}", file=self.stderr)
+            self.vars["?"] = "2"
+            result = False
+        return result
 
     def do_case(self, gr:Group)->None:
         word = self.case_stack[-1].word
@@ -847,42 +1331,203 @@ class shell:
         k: An input of type Piraha.Group.
         return value: a list of strings
         """
-        args : List[str] = []
         # Calling eval will cause $(...) etc. to be replaced.
-        ek : Token = self.eval(k)
-        if k.has(0,"dquote") or k.has(0,"squote"):
-            pass
-        else:
-            # expand ~/ and ~username/. This should
-            # not happen to quoted values.
-            ek = expandtilde(ek)
-
-        # Now the tricky part. Evaluate {a,b,c} elements of the shell.
-        # This can result in multiple arguments being generated.
-        exk : List[Token]= expandCurly(ek).build_strs()
-        nek : Token
-        for nek in exk:
-            # Evaluate globs
-            nek = deglob(nek)
-            args += [""]
-            for kk in nek:
-                if isinstance(kk,Space):
-                    args += [""]
-                else:
-                    args[-1] += str(kk)
+        return token_to_args(k, self.eval(k), self.dir_cache, self.cwd)
 
-        return args
+    def mkiargs(self, k : Group)->Iterator[str]:
+        """
+        Like mkargs(), but braces are expanded as the result is
+        iterated. The rest of k, including any globs, is evaluated
+        now, so that the result does not depend on what is done
+        while it is iterated.
+        """
+        ek = self.eval(k)
+        iargs = token_to_iargs(k, ek, self.dir_cache, self.cwd)
+        if any([isinstance(kk, Group) and kk.is_("glob") for kk in ek]):
+            return iter(list(iargs))
+        return iargs
 
     def eval(self, gr:Group, index:int=-1,xending:Optional[str]=None)->Token:
-        r = self.eval_(gr,index,xending)
+        code : Optional[code_t] = gr.__dict__.get("code", None)
+        if code is None:
+            code = compile_group(gr)
+        if index == -1 and gr.name in statement_nodes:
+            index = len(self.cmds)
+            self.cmds.append(gr)
+        r = code(self,gr,index,xending)
         if r is None:
             r = []
         return r
 
+    def eval_cmd(self, gr:Group, words:List[Tuple[Group,Optional[List[str]],bool]], redir:Optional[Group], ending:Optional[str], index:int, xending:Optional[str])->Token:
+        #here("cmd:",gr.dump())
+        args : List[str] = []
+        skip = False
+
+        if self.last_ending == "&&" and self.vars["?"] != "0":
+            skip = True
+        if self.last_ending == "||" and self.vars["?"] == "0":
+            skip = True
+        # The last command of $(...) or ( ... ) has no ending
+        self.curr_ending = ending
+        if self.curr_ending == "|":
+            self.curr_pipe = Pipe()
+        else:
+            self.curr_pipe = None
+        if self.curr_pipe is not None:
+            assert self.stdout is not None
+            self.save_out += [self.stdout]
+            assert self.curr_pipe is not None
+            self.stdout = self.curr_pipe.writer
+        if self.last_pipe is not None:
+            #assert self.stdin is not None
+            self.save_in += [self.stdin]
+            self.stdin = self.last_pipe.reader
+
+        try:
+            for_values : Optional[Iterator[str]] = None
+            if len(words) > 3 and words[0][1] == ["for"]:
+                # A loop's values are only expanded as it gets to
+                # them, so "for i in {1..1000000}" needs no list
+                values : List[Iterable[str]] = []
+                for k, static_args, _ in words[3:]:
+                    values += [static_args if static_args is not None else self.mkiargs(k)]
+                for_values = chain.from_iterable(values)
+                words = words[:3]
+            for k, static_args, in_cond in words:
+                if static_args is not None:
+                    args += static_args
+                elif in_cond:
+                    args += [cond_word(self, k)]
+                else:
+                    args += self.mkargs(k)
+
+            if args == ['']:
+                return ['']
+            return self.evalargs(args, redir, skip, xending, index, gr, for_values)
+        finally:
+            if self.curr_pipe is not None:
+                self.stdout = self.save_out[-1]
+                self.save_out = self.save_out[:-1]
+                # The stage has its own copy of the pipe now, or
+                # a thread that will close it when done.
+                if not self.curr_pipe.threaded_writer:
+                    self.curr_pipe.writer.close()
+            if self.last_pipe is not None:
+                self.stdin = self.save_in[-1]
+                self.save_in = self.save_in[:-1]
+                if not self.last_pipe.threaded_reader:
+                    self.last_pipe.reader.close()
+            self.last_ending = self.curr_ending
+            self.last_pipe = self.curr_pipe
+            if self.curr_pipe is None:
+                self.wait_pipeline()
+
+    def ifs(self)->str:
+        """
+        The characters that separate the words of $(...).
+        """
+        return self.vars.get("IFS", " \t\n")
+
+    def can_inline(self, body:List[Group], seen:Optional[Set[str]]=None)->bool:
+        """
+        True if the statements in body can run on a clone() of
+        the shell. They may not start background jobs or run
+        process_cmds, and every command name must be known before
+        evaluation. Nested subshells decide for themselves.
+        """
+        if seen is None:
+            seen = set()
+        todo = list(body)
+        while len(todo) > 0:
+            gr = todo.pop()
+            if gr.is_("subproc") or gr.is_("subshell"):
+                continue
+            if gr.is_("cmd"):
+                if gr.has(-1,"ending") and gr.children[-1].substring() == "&":
+                    return False
+                words = [c for c in gr.children if c.is_("word")]
+                if len(words) > 0:
+                    if not is_static(words[0]):
+                        return False
+                    name = "".join([str(v) for v in static_value(words[0])])
+                    if name in process_cmds:
+                        return False
+                    if name in self.funcs and name not in seen:
+                        seen.add(name)
+                        if not self.can_inline(self.funcs[name], seen):
+                            return False
+            todo += gr.children
+        return True
+
+    def clone(self)->'shell':
+        """
+        A copy of the shell for running a subshell in this process.
+        Changes it makes to variables, functions, flags etc. are not
+        seen by this shell.
+        """
+        sh = copy.copy(self)
+        sh.vars = VarStore(self.vars)
+        sh.exports = EnvStore(self.exports)
+        sh.flags = dict(self.flags)
+        sh.funcs = dict(self.funcs)
+        sh.pyfuncs = dict(self.pyfuncs)
+        sh.builtins = dict(self.builtins)
+        sh.alias_tab = dict(self.alias_tab)
+        sh.pending_vars = {}
+        sh.cmds = []
+        sh.stack = []
+        sh.for_loops = []
+        sh.case_stack = []
+        sh.save_in = []
+        sh.save_out = []
+        sh.new_pipeline()
+        return sh
+
+    def run_inline(self, body:List[Group], sout:IO[str])->int:
+        """
+        Run body on a clone() writing to sout, and
+        return its exit status.
+        """
+        sh = self.clone()
+        sh.stdout = sout
+        try:
+            for gr in body:
+                sh.eval(gr)
+            return int(sh.vars["?"])
+        except ShellExit as se:
+            return se.rc
+        finally:
+            sh.log_pending_vars()
+
+    def new_pipeline(self)->None:
+        """
+        Forget the pipeline being built by the parent,
+        for use in a forked child.
+        """
+        self.curr_ending = None
+        self.last_ending = None
+        self.curr_pipe = None
+        self.last_pipe = None
+        self.pipeline = []
+
+    def wait_pipeline(self)->None:
+        """
+        Wait for the earlier stages of a pipeline to finish.
+        """
+        stages, self.pipeline = self.pipeline, []
+        for stage in stages:
+            if isinstance(stage, Thread):
+                stage.join()
+            else:
+                stage.communicate()
+                self.log(msg="end", rc=stage.returncode, pid=stage.getpid())
+
     def eval_(self, gr:Group, index:int=-1, xending:Optional[str]=None)->Token:
-        if index == -1 and not gr.is_("whole_cmd"):
-            index = len(self.cmds)
-            self.cmds += [gr]
+        """
+        Evaluate the nodes that compile_group() does not
+        handle itself.
+        """
         if gr.is_("whole_cmd"):
             # here("wc:",gr.dump())
             pipes = None
@@ -894,55 +1539,6 @@ class shell:
                     continue
                 result = self.eval(c,xending=my_ending)
             return result
-        elif gr.is_("cmd"):
-            #here("cmd:",gr.dump())
-            args = []
-            skip = False
-
-            if self.last_ending == "&&" and self.vars["?"] != "0":
-                skip = True
-            if self.last_ending == "||" and self.vars["?"] == "0":
-                skip = True
-            if gr.has(-1,"ending"):
-                self.curr_ending = gr.group(-1).substring()
-            if self.curr_ending == "|":
-                self.curr_pipe = os.pipe()
-            else:
-                self.curr_pipe = None
-            if self.curr_pipe is not None:
-                assert self.stdout is not None
-                self.save_out += [self.stdout]
-                assert self.curr_pipe is not None
-                self.stdout = os.fdopen(self.curr_pipe[1], "w")
-            if self.last_pipe is not None:
-                #assert self.stdin is not None
-                self.save_in += [self.stdin]
-                self.stdin = os.fdopen(self.last_pipe[0], "r")
-
-            redir = None
-            for k in gr.children:
-                if k.has(0,"redir"):
-                    redir = k.children[0]
-                if not k.is_("ending") and not k.has(0,"redir"):
-                     args += self.mkargs(k)
-    
-            if args == ['']:
-                return ['']
-            return self.evalargs(args, redir, skip, xending, index, gr)
-
-        elif gr.is_("glob"):
-            return [gr]
-        elif gr.is_("expand"):
-            return [gr]
-        elif gr.is_("word") or gr.is_("word2") or gr.is_("words2"):
-            s : Token = []
-            for c in gr.children:
-                s += self.eval(c)
-            if gr.has(-1,"eword"):
-                here("eword found:",gr.dump())
-            return s 
-        elif gr.is_("raw_word"):
-            return [unesc(gr.substring())]
         elif gr.is_("math"):
             mtxt : str = ''
             for gc in gr.children:
@@ -960,49 +1556,45 @@ class shell:
             self.funcs[ident] = gr.children[1:]
             return []
         elif gr.is_("subproc"):
+            if self.inline_subshells and self.can_inline(gr.children):
+                out = CaptureFile(self.max_capture_memory)
+                try:
+                    self.run_inline(gr.children, out)
+                    words : Token = out.words(self.ifs())
+                finally:
+                    out.close()
+                if len(words) == 0:
+                    words = [""]
+                return spaceout(words)
             out_pipe = os.pipe()
+            self.log_flush()
             pid = os.fork()
             if pid == 0:
+                self.log_writer.after_fork()
+                if self.cwd is not None:
+                    os.chdir(self.cwd)
                 os.close(1)
                 os.dup(out_pipe[1])
                 self.stdout = sys.stdout
                 os.close(out_pipe[0])
                 os.close(out_pipe[1])
+                self.new_pipeline()
                 for c in gr.children:
                     self.eval(c)
+                self.log_flush()
                 os._exit(int(self.vars["?"]))
             assert pid != 0
             os.close(out_pipe[1])
-            result2 = os.read(out_pipe[0],10000).decode()
-            os.close(out_pipe[0])
+            cap = Capture(self.max_capture_memory)
+            try:
+                words = cap.read_from(out_pipe[0]).words(self.ifs())
+            finally:
+                cap.close()
+                os.close(out_pipe[0])
             rc=os.waitpid(pid,0)
-            return spaceout(re.split(r'\s+',result2.strip()))
-        elif gr.is_("dquote"):
-            ss : str= ""
-            for c in gr.children:
-                r = self.eval(c)
-                for kk in r:
-                    if type(kk) == Space:
-                        ss += ' '
-                    elif type(kk) == str:
-                        ss += kk
-                    else:
-                        assert False
-            return [ss]
-        elif gr.is_("dchar"):
-            return [gr.substring()]
-        elif gr.is_("squote"):
-            return [gr.substring()[1:-1]]
-        elif gr.is_("dlit"):
-            sl : str = gr.substring()
-            if sl == "\\n":
-                return ["\n"]
-            elif sl == "\\r":
-                return ["\r"]
-            else:
-                return [sl[1]]
-        elif gr.is_("var"):
-            return self.lookup_var(gr)
+            if len(words) == 0:
+                words = [""]
+            return spaceout(words)
         elif gr.has(0,"fd_from") and gr.has(1,"fd_to"):
             fd_from = gr.children[0].substring()
             fd_to = gr.children[1].substring()
@@ -1031,23 +1623,38 @@ class shell:
                 assert False
             return []
         elif gr.is_("subshell"):
+            if self.inline_subshells and self.can_inline(gr.children):
+                assert self.stdout is not None
+                self.vars["?"] = str(self.run_inline(gr.children, self.stdout))
+                self.log(msg="end subshell",rc=self.vars["?"])
+                if self.vars["?"] != "0" and self.flags.get("e",False):
+                    shell_exit(int(self.vars["?"]))
+                return []
             out_pipe = os.pipe()
+            self.log_flush()
             pid = os.fork()
             if pid == 0:
+                self.log_writer.after_fork()
+                if self.cwd is not None:
+                    os.chdir(self.cwd)
                 os.close(1)
                 self.stdout = sys.stdout
                 os.dup(out_pipe[1])
                 os.close(out_pipe[0])
                 os.close(out_pipe[1])
+                self.new_pipeline()
                 for gc in gr.children:
                     self.eval(gc)
                 code = int(self.vars["?"])
+                self.log_flush()
                 os._exit(int(self.vars["?"]))
             os.close(out_pipe[1])
-            out = os.read(out_pipe[0],10000).decode()
-            os.close(out_pipe[0])
             assert self.stdout is not None
-            self.stdout.write(out)
+            try:
+                copy_fd(out_pipe[0], self.stdout)
+                self.stdout.flush()
+            finally:
+                os.close(out_pipe[0])
             rc=os.waitpid(pid,0)
             self.vars["?"] = str(rc[1])
             self.log(msg="end subshell",rc=self.vars["?"])
@@ -1121,332 +1728,459 @@ class shell:
             raise Exception()
         return sout, serr, sin, out_is_error
 
+    def run_pyfilter(self, func:pyfilter_t, args:List[str], redir:Optional[Group], builtin:bool=False)->None:
+        """
+        Run a pyfunc written as a generator over lines of input.
+        In the middle of a pipeline it runs on a thread, so that
+        it streams to and from its neighbours. A builtin is also
+        passed its output and error streams, and otherwise sets $?
+        from what it returns, like a command.
+        """
+        sout, serr, sin = self.stdout, self.stderr, self.stdin
+        if redir is not None:
+            sout,serr,sin,_ = self.do_redir(redir,sout,serr,sin)
+        name = func.__name__
+        if builtin:
+            func = partial(func, sout=sout, serr=serr)
+        out_pipe = self.curr_pipe
+        if out_pipe is not None and sout is out_pipe.writer:
+            out_pipe.threaded_writer = True
+            in_pipe = self.last_pipe
+            if in_pipe is not None and sin is in_pipe.reader:
+                in_pipe.threaded_reader = True
+            else:
+                in_pipe = None
+            t = Thread(target=run_filter, args=(self, func, args, sin, sout, in_pipe, out_pipe), daemon=True)
+            t.start()
+            self.pipeline += [t]
+            return
+        rc = None
+        try:
+            rc = run_filter(self, func, args, sin, sout, None, None)
+        except Exception as e:
+            print(colored(f"'{name}' threw '{type(e)}: {e}'","red"))
+            rc = 1
+        finally:
+            # Close files opened for redirections
+            for f in set([sout, serr, sin]) - set([self.stdout, self.stderr, self.stdin]):
+                if isinstance(f, io.IOBase):
+                    f.close()
+        if builtin:
+            self.vars["?"] = str(rc)
+            self.log(msg="end", rc=self.vars["?"], builtin=True)
+            if rc != 0 and self.flags.get("e",False):
+                shell_exit(rc)
+
+    def run_builtin(self, args:List[str], redir:Optional[Group])->None:
+        """
+        Run a command with its Builtin. The arguments go through
+        allow_cmd() as they would for the program, under its full
+        path, so a policy sees the same command either way.
+        """
+        b = self.builtins[args[0]]
+        path = self.cmd_hash.lookup(args[0], self.get_var("PATH") or os.defpath, self.cwd)
+        args = [args[0]] + self.allow_cmd([args[0] if path is None else path] + args[1:])[1:]
+        if self.flags.get("x",False):
+            if self.stderr is not None:
+                self.stderr.write("+ "+" ".join(args)+"\n")
+        self.log(msg="start", args=args, builtin=True)
+        self.run_pyfilter(b.run, args[1:], redir, builtin=True)
+
+    def enable(self, args:List[str])->None:
+        """
+        The enable command. "enable -n name" makes the shell run the
+        program instead of the builtin, and "enable name" switches
+        the builtin back on. Without names, it lists the builtins
+        that are on, or with -n those that are off.
+        """
+        on = len(args) == 0 or args[0] != "-n"
+        names = args if on else args[1:]
+        if len(names) == 0:
+            for name in sorted(builtin_cmds):
+                if (name in self.builtins) == on:
+                    print("enable", name if on else "-n "+name, file=self.stdout)
+            self.vars["?"] = "0"
+            return
+        rc = 0
+        for name in names:
+            if name not in builtin_cmds:
+                print(f"{self.scriptname}: enable: {name}: not a shell builtin", file=self.stderr)
+                rc = 1
+            elif on:
+                self.builtins[name] = builtin_cmds[name]
+            else:
+                self.builtins.pop(name, None)
+        self.vars["?"] = str(rc)
+
     def update_env(self)->None:
         for name in self.exports:
-            os.environ[name] = self.vars[name]
+            value = self.vars[name]
+            if os.environ.get(name, None) != value:
+                os.environ[name] = value
 
-    def evalargs(self, args:List[str], redir:Optional[Group], skip:bool, xending:Optional[str], index:int, gr:Optional[Group])->Token:
-        try:
-            if len(args)>0:
-                if args[0] == "do":
-                    f = self.for_loops[-1]
-                    if f.docmd == -1:
-                        f.docmd = index
-                    args = args[1:]
-                    if len(args) == 0:
-                        return []
-
-                if args[0] == 'export':
-                    for a in args[1:]:
-                        g = re.match(r'^(\w+)=(.*)',a)
-                        if g:
-                            varname = g.group(1)
-                            value = g.group(2)
-                            self.set_var(varname,value)
-                            self.exports[varname] = self.vars[varname]
-                        elif a in self.vars:
-                            self.exports[a] = self.vars[a]
+    def environ(self)->Optional[Dict[str,str]]:
+        """
+        The environment for a new process. None means
+        the shell is bound to os.environ.
+        """
+        exports = self.exports
+        if isinstance(exports, EnvStore):
+            return exports.snapshot()
+        return None
+
+    def evalargs(self, args:List[str], redir:Optional[Group], skip:bool, xending:Optional[str], index:int, gr:Optional[Group], for_values:Optional[Iterator[str]]=None)->Token:
+        if len(args)>0:
+            if args[0] == "do":
+                f = self.for_loops[-1]
+                if f.docmd == -1:
+                    f.docmd = index
+                args = args[1:]
+                if len(args) == 0:
                     return []
 
-                if args[0] == "for":
-                    f = For(args[1],args[3:])
-                    assert args[2] == "in", "Syntax: for var in ..."
-                    self.for_loops += [f]
-                    if f.index < len(f.values):
-                        #self.vars[f.variable] = f.values[f.index]
-                        self.set_var(f.variable, f.values[f.index])
-                    return []
+            if args[0] == 'export':
+                for a in args[1:]:
+                    g = re.match(r'^(\w+)=(.*)',a)
+                    if g:
+                        varname = g.group(1)
+                        value = g.group(2)
+                        self.set_var(varname,value)
+                        self.exports[varname] = self.vars[varname]
+                    elif a in self.vars:
+                        self.exports[a] = self.vars[a]
+                return []
 
-                if args[0] == "done":
-                    f = self.for_loops[-1]
-                    assert f.docmd != -1
-                    f.donecmd = index
-                    if len(f.values) > 1:
-                        for ii in range(1,len(f.values)):
-                            f.index = ii
-                            #self.vars[f.variable] = f.values[f.index]
-                            self.set_var(f.variable, f.values[f.index])
-                            for cmdnum in range(f.docmd,f.donecmd):
-                                self.eval(self.cmds[cmdnum], cmdnum)
-                    self.for_loops = self.for_loops[:-1]
-                    return []
+            if args[0] == "for":
+                f = For(args[1],args[3:] if for_values is None else for_values)
+                assert args[2] == "in", "Syntax: for var in ..."
+                self.for_loops += [f]
+                if f.active:
+                    self.set_var(f.variable, f.value)
+                return []
 
-                if args[0] == "then":
-                    args = args[1:]
-                    if len(args) == 0:
-                        return []
+            if args[0] == "done":
+                f = self.for_loops[-1]
+                assert f.docmd != -1
+                f.donecmd = index
+                if f.active:
+                    while f.advance():
+                        self.set_var(f.variable, f.value)
+                        for cmdnum in range(f.docmd,f.donecmd):
+                            self.eval(self.cmds[cmdnum], cmdnum)
+                self.for_loops = self.for_loops[:-1]
+                return []
 
-                elif args[0] == "else":
-                    args = args[1:]
-                    self.stack[-1][1].toggle()
-                    if len(args) == 0:
-                        return []
+            if args[0] == "then":
+                args = args[1:]
+                if len(args) == 0:
+                    return []
+
+            elif args[0] == "else":
+                args = args[1:]
+                self.stack[-1][1].toggle()
+                if len(args) == 0:
+                    return []
 
-                if args[0] == "if":
-                    testresult = None
-                    if len(self.stack) > 0 and not self.stack[-1][1]:
-                        # initialize the if stack with never.
-                        # Until a conditional is evaluated,
-                        # it is not true.
+            if args[0] == "if":
+                testresult = None
+                if len(self.stack) > 0 and not self.stack[-1][1]:
+                    # initialize the if stack with never.
+                    # Until a conditional is evaluated,
+                    # it is not true.
+                    self.stack += [("if",TFN(Never))]
+                else:
+                    # if [ a = b ] ;
+                    #  7 6 5 4 3 2 1
+                    # if [ a = b ] 
+                    #  6 5 4 3 2 1 
+                    testresult = self.evaltest(args)
+                    if testresult is None:
                         self.stack += [("if",TFN(Never))]
                     else:
-                        # if [ a = b ] ;
-                        #  7 6 5 4 3 2 1
-                        # if [ a = b ] 
-                        #  6 5 4 3 2 1 
-                        testresult = self.evaltest(args)
-                        if testresult is None:
-                            self.stack += [("if",TFN(Never))]
-                        else:
-                            self.stack += [("if",TFN(testresult))]
-                elif args[0] == "fi":
-                    self.stack = self.stack[:-1]
-                g = re.match(r'(\w+)=(.*)', args[0])
-                if g:
-                    varname = g.group(1)
-                    value = g.group(2)
-                    #self.vars[varname] = value
-                    self.set_var(varname, value)
-                    return []
+                        self.stack += [("if",TFN(testresult))]
+            elif args[0] == "fi":
+                self.stack = self.stack[:-1]
+            g = re.match(r'(\w+)=(.*)', args[0])
+            if g:
+                varname = g.group(1)
+                value = g.group(2)
+                #self.vars[varname] = value
+                self.set_var(varname, value)
+                return []
 
-            if len(self.stack) > 0:
-                skip = not self.stack[-1][1]
-            if len(self.case_stack) > 0:
-                if not self.case_stack[-1].active:
-                    skip = True
-            if len(self.for_loops)>0:
-                f = self.for_loops[-1]
-                if f.index >= len(f.values):
-                    skip = True
-            if skip:
+        if len(self.stack) > 0:
+            skip = not self.stack[-1][1]
+        if len(self.case_stack) > 0:
+            if not self.case_stack[-1].active:
+                skip = True
+        if len(self.for_loops)>0:
+            f = self.for_loops[-1]
+            if not f.active:
+                skip = True
+        if skip:
+            return []
+        if len(args)==0:
+            return []
+
+        if args[0] == "exit":
+            try:
+                rc = int(args[1])
+            except Exception as ee:
+                rc = 1
+            self.vars["?"] = str(rc)
+            shell_exit(int(self.vars["?"]))
+            return []
+        if args[0] == "wait":
+            result = None
+            p = self.jobs.wait(None)
+            if p is not None:
+                print("pid:",p.getpid(),"cmd:",p.args[0], file=self.stdout)
+                self.log(msg="end wait",pid=p.pid,rc=p.returncode)
+            return []
+        if args[0] == "hash":
+            self.vars["?"] = "0"
+            if len(args) == 1:
+                self.cmd_hash.show(self.stdout)
+            elif args[1] == "-r":
+                self.cmd_hash.clear()
+            else:
+                for a in args[1:]:
+                    if self.cmd_hash.add(a, self.get_var("PATH") or os.defpath, self.cwd) is None:
+                        print(f"{self.scriptname}: hash: {a}: not found",file=self.stderr)
+                        self.vars["?"] = "1"
+            return []
+        if args[0] == "cd":
+            if len(args) == 1:
+                cd_dir = home
+            else:
+                cd_dir = args[1]
+            cd_dir = self.allow_cd(cd_dir)
+            try:
+                self.chdir(cd_dir)
+                self.log(chdir=cd_dir)
+                self.vars["PWD"] = self.getcwd()
+            except Exception as e:
+                print(colored("Failed:","red"),e)
+            return []
+
+        if args[0] in self.funcs:
+            # Invoke a function. The function body keeps its own
+            # list of commands, so that a loop around the call
+            # does not replay the body on its own.
+            save_cmds = self.cmds
+            try:
+                self.cmds = []
+                save = {}
+                for vnum in range(1,1000): #self.max_args):
+                    vname = str(vnum)
+                    if vname in self.vars:
+                        save[vname] = self.vars[vname]
+                    else:
+                        break
+                save["@"] = self.vars["@"]
+                for vnum in range(1,len(args)):
+                    vname = str(vnum)
+                    self.vars[vname] = args[vnum]
+                self.vars["@"] = " ".join(args[1:])
+                for c in self.funcs[args[0]]:
+                    if c.is_("redir"):
+                        continue
+                    self.recursion += 1
+                    try:
+                        assert self.recursion < self.max_recursion_depth, f"Max recursion depth {self.max_recursion_depth} exceeded"
+                        self.eval(c)
+                    finally:
+                        self.recursion -= 1
+            finally:
+                self.cmds = save_cmds
+                for vnum in range(1,1000): #self.max_args):
+                    vname = str(vnum)
+                    if vname in self.vars:
+                        save[vname] = self.vars[vname]
+                    else:
+                        break
+                for k in save:
+                    self.vars[k] = save[k]
+            return []
+        elif args[0] in self.pyfuncs:
+            # Invoke a python function
+            if inspect.isgeneratorfunction(self.pyfuncs[args[0]]):
+                self.run_pyfilter(self.pyfuncs[args[0]], args[1:], redir)
                 return []
-            if len(args)==0:
+            try:
+                return self.pyfuncs[args[0]](self, args[1:])
+            except Exception as e:
+                print(colored(f"'{args[0]}' threw '{type(e)}: {e}'","red"))
                 return []
-
-            if args[0] == "exit":
-                try:
-                    rc = int(args[1])
-                except Exception as ee:
-                    rc = 1
-                self.vars["?"] = str(rc)
+        elif args[0] in self.builtins and self.curr_ending != "&" and self.builtins[args[0]].handles(args[1:]):
+            self.run_builtin(args, redir)
+            return []
+        elif args[0] == "[[":
+            if not self.test_brackets(args) and self.flags.get("e",False):
                 shell_exit(int(self.vars["?"]))
+            return []
+        elif args[0] == "enable":
+            # A restricted shell may not switch builtins
+            self.enable(self.allow_cmd(args)[1:])
+            return []
+        elif args[0] == "unset":
+            for a in args[1:]:
+                self.unset_var(a)
+            return []
+        elif args[0] == "set":
+            for a in args[1:]:
+                if a[0] == '-':
+                    for cc in a[1:]:
+                        self.flags[cc] = True
+                elif a[0] == '+':
+                    for cc in a[1:]:
+                        self.flags[cc] = False
+            return []
+        elif args[0] in ["source", "."]:
+            assert len(args)==2
+            assert gr is not None
+            save_cmds = self.cmds
+            try:
+                self.cmds = []
+                self.run_text(self.read_script(args[1],gr.linenum()))
+            finally:
+                self.cmds = save_cmds
+            return []
+        elif args[0] not in ["if","then","else","fi","for","done","case","esac"]:
+            sout = self.stdout
+            serr = self.stderr
+            sin = self.stdin
+            if not os.path.exists(self.path(args[0])):
+                args0 = self.cmd_hash.lookup(args[0], self.get_var("PATH") or os.defpath, self.cwd)
+                if args0 is not None:
+                    args[0] = args0
+            #if args[0] in ["/usr/bin/bash","/bin/bash","/usr/bin/sh","/bin/sh"]:
+            #    args = [my_shell] + args[1:]
+            # We don't have a way to tell Popen we want both
+            # streams to go to stderr, so we add this flag
+            # and swap the output and error output after the
+            # command is run
+            out_is_error = False
+            if redir is not None:
+                sout,serr,sin,out_is_error = self.do_redir(redir,sout,serr,sin)
+            if len(args) == 0 or args[0] is None:
                 return []
-            if args[0] == "wait":
-                result = None
-                p = pwait(None)
-                if p is not None:
-                    print("pid:",p.getpid(),"cmd:",p.args[0], file=self.stdout)
-                    self.log(msg="end wait",pid=p.pid,rc=p.returncode)
-                return []
-            if args[0] == "cd":
-                if len(args) == 1:
-                    cd_dir = home
+            if os.path.exists(self.path(args[0])):
+                if gr is None:
+                    gr_line = 0
                 else:
-                    cd_dir = args[1]
-                cd_dir = self.allow_cd(cd_dir)
-                try:
-                    os.chdir(cd_dir)
-                    self.log(chdir=cd_dir)
-                    self.vars["PWD"] = os.getcwd()
-                except Exception as e:
-                    print(colored("Failed:","red"),e)
+                    gr_line = gr.linenum()
+                with self.open_file(args[0],"r",gr_line) as fd:
+                    try:
+                        first_line = fd.readline()
+                    except UnicodeDecodeError as ude:
+                        first_line = ""
+                    if first_line.startswith("#!"):
+                        args = re.split(r'\s+',first_line[2:].strip()) + args
+            if args[0] == 'storeenv':
+                if len(args) != 2:
+                    print(f"Usage: storeenv 'name'")
+                else:
+                    envfile = os.path.join(home, args[1])
+                    with open(envfile, "w") as fd:
+                        self.serialize(fd)
+                        print(f"Env stored to {envfile}")
                 return []
-
-            if args[0] in self.funcs:
-                # Invoke a function
-                try:
-                    save = {}
-                    for vnum in range(1,1000): #self.max_args):
-                        vname = str(vnum)
-                        if vname in self.vars:
-                            save[vname] = self.vars[vname]
-                        else:
-                            break
-                    save["@"] = self.vars["@"]
-                    for vnum in range(1,len(args)):
-                        vname = str(vnum)
-                        self.vars[vname] = args[vnum]
-                    self.vars["@"] = " ".join(args[1:])
-                    for c in self.funcs[args[0]]:
-                        if c.is_("redir"):
-                            continue
-                        self.recursion += 1
-                        try:
-                            assert self.recursion < self.max_recursion_depth, f"Max recursion depth {self.max_recursion_depth} exceeded"
-                            self.eval(c)
-                        finally:
-                            self.recursion -= 1
-                finally:
-                    for vnum in range(1,1000): #self.max_args):
-                        vname = str(vnum)
-                        if vname in self.vars:
-                            save[vname] = self.vars[vname]
-                        else:
-                            break
-                    for k in save:
-                        self.vars[k] = save[k]
+            elif args[0] == 'loadenv':
+                if len(args) != 2:
+                    print(f"Usage: loadenv 'name'")
+                else:
+                    envfile = os.path.join(home, args[1])
+                    with open(envfile, "r") as fd:
+                        self.deserialize(fd)
+                        print(f"Env loaded from {envfile}")
                 return []
-            elif args[0] in self.pyfuncs:
-                # Invoke a python function
-                try:
-                    return self.pyfuncs[args[0]](self, args[1:])
-                except Exception as e:
-                    print(colored(f"'{args[0]}' threw '{type(e)}: {e}'","red"))
-                    return []
-            elif args[0] == "unset":
-                for a in args[1:]:
-                    self.unset_var(a)
+            elif len(args) == 4 and args[0] == 'pyfrom' and args[2] == 'import':
+                args = self.allow_cmd(args)
+                modname = args[1]
+                funcname = args[3]
+                module = __import__(modname)
+                self.pyfuncs[funcname] = getattr(module,funcname)
                 return []
-            elif args[0] == "set":
-                for a in args[1:]:
-                    if a[0] == '-':
-                        for cc in a[1:]:
-                            self.flags[cc] = True
-                    elif a[0] == '+':
-                        for cc in a[1:]:
-                            self.flags[cc] = False
+            elif args[0] == 'alias':
+                gx = Regex()
+                if len(args)!=2:
+                    print(colored("alias requires exactly one argument","red"),file=self.stdout)
+                elif gx.match(r'^(\w+)(?:=(.*)|)', args[1]) != None:
+                    lhs = gx.group(1)
+                    if gx.group(2) is None and lhs is not None:
+                        rhs = self.alias_tab.get(lhs,'')
+                        print(f"alias {lhs}='{rhs}'",file=self.stdout)
+                        return []
+                        rhs = gx.group(2)
+                        if rhs is not None:
+                            self.alias_tab[lhs] = rhs
+                else:
+                    print(colored(f"Bad argument to alias '{args[1]}'","red"),file=self.stdout)
                 return []
-            elif args[0] in ["source", "."]:
-                assert len(args)==2
-                assert gr is not None
-                with self.open_file(args[1],"r",gr.linenum()) as fd:
-                    self.run_text(fd.read())
-                    return []
-            elif args[0] not in ["if","then","else","fi","for","done","case","esac"]:
-                sout = self.stdout
-                serr = self.stderr
-                sin = self.stdin
-                if not os.path.exists(args[0]):
-                    args0 = which(args[0])
-                    if args0 is not None:
-                        args0 = os.path.abspath(args0)
-                        args[0] = args0
-                #if args[0] in ["/usr/bin/bash","/bin/bash","/usr/bin/sh","/bin/sh"]:
-                #    args = [my_shell] + args[1:]
-                # We don't have a way to tell Popen we want both
-                # streams to go to stderr, so we add this flag
-                # and swap the output and error output after the
-                # command is run
-                out_is_error = False
-                if redir is not None:
-                    sout,serr,sin,out_is_error = self.do_redir(redir,sout,serr,sin)
-                if len(args) == 0 or args[0] is None:
-                    return []
-                if os.path.exists(args[0]):
-                    if gr is None:
-                        gr_line = 0
-                    else:
-                        gr_line = gr.linenum()
-                    with self.open_file(args[0],"r",gr_line) as fd:
-                        try:
-                            first_line = fd.readline()
-                        except UnicodeDecodeError as ude:
-                            first_line = ""
-                        if first_line.startswith("#!"):
-                            args = re.split(r'\s+',first_line[2:].strip()) + args
-                if args[0] == 'storeenv':
-                    if len(args) != 2:
-                        print(f"Usage: storeenv 'name'")
-                    else:
-                        envfile = os.path.join(home, args[1])
-                        with open(envfile, "w") as fd:
-                            self.serialize(fd)
-                            print(f"Env stored to {envfile}")
-                    return []
-                elif args[0] == 'loadenv':
-                    if len(args) != 2:
-                        print(f"Usage: loadenv 'name'")
-                    else:
-                        envfile = os.path.join(home, args[1])
-                        with open(envfile, "r") as fd:
-                            self.deserialize(fd)
-                            print(f"Env loaded from {envfile}")
-                    return []
-                elif len(args) == 4 and args[0] == 'pyfrom' and args[2] == 'import':
-                    args = self.allow_cmd(args)
-                    modname = args[1]
-                    funcname = args[3]
-                    module = __import__(modname)
-                    self.pyfuncs[funcname] = getattr(module,funcname)
-                    return []
-                elif args[0] == 'alias':
-                    gx = Regex()
-                    if len(args)!=2:
-                        print(colored("alias requires exactly one argument","red"),file=self.stdout)
-                    elif gx.match(r'^(\w+)(?:=(.*)|)', args[1]) != None:
-                        lhs = gx.group(1)
-                        if gx.group(2) is None and lhs is not None:
-                            rhs = self.alias_tab.get(lhs,'')
-                            print(f"alias {lhs}='{rhs}'",file=self.stdout)
-                            return []
-                            rhs = gx.group(2)
-                            if rhs is not None:
-                                self.alias_tab[lhs] = rhs
-                    else:
-                        print(colored(f"Bad argument to alias '{args[1]}'","red"),file=self.stdout)
-                    return []
-                elif args[0] == 'exec':
-                    exec_cmd = which(args[1])
-                    args = self.allow_cmd(args[1:])
-                    if exec_cmd is not None:
-                        os.execve(exec_cmd,args,self.exports)
-                if not os.path.exists(args[0]):
-                    if gr is None:
-                        fno = 0
-                    else:
-                        fno = gr.linenum()
-                    print(f"{self.scriptname}: line {fno}: {args[0]}: command not found",file=self.stderr)
-                    self.log(args=args,msg="command not found",line=fno)
-                    self.vars["?"] = "1"
-                    if self.flags.get("e",False):
-                        shell_exit(1)
-                    return []
-                args = self.allow_cmd(args)
-                env = {}
-                if self.flags.get("x",False):
-                    if self.stderr is not None:
-                        self.stderr.write("+ "+" ".join(args)+"\n")
-                for eiter in self.exports:
-                    env[eiter] = self.exports[eiter]
-                try:
-                    tstart = time()
-                    p = PipeThread(args, stdin=sin, stdout=sout, stderr=serr, universal_newlines=True, env=env)
-                    self.log(msg="start",pid=p.getpid(), args=args, time=tstart)
-                except OSError as e:
-                    args = ["/bin/sh"]+args
-                    p = PipeThread(args, stdin=sin, stdout=sout, stderr=serr, universal_newlines=True, env=env)
-                    self.log(msg="start",pid=p.getpid(), args=args)
-                if self.curr_ending == "&":
-                    p.background()
-                    p.start()
-                elif xending == "|":
-                    assert p is not None
-                    #p.setDaemon(True)
-                    p.start()
-                    return []
+            elif args[0] == 'exec':
+                exec_cmd = which(args[1])
+                args = self.allow_cmd(args[1:])
+                if exec_cmd is not None:
+                    if self.cwd is not None:
+                        os.chdir(self.cwd)
+                    # Nothing after execve() writes out the log
+                    # or what is left in our output buffers
+                    self.log_flush()
+                    for f in [self.stdout, self.stderr]:
+                        if f is not None:
+                            f.flush()
+                    env = self.environ()
+                    os.execve(exec_cmd,args,os.environ if env is None else env)
+            if not os.path.exists(self.path(args[0])):
+                if gr is None:
+                    fno = 0
                 else:
-                    p.start()
-                    p.communicate()
-                    self.vars["?"] = str(p.returncode)
-                    self.log(msg="end", rc=self.vars["?"], pid=p.getpid())
-                    if self.vars["?"] != "0" and self.flags.get("e",False):
-                        shell_exit(int(self.vars["?"]))
-                    return []
-            return []
-        finally:
-            if self.curr_pipe is not None:
-                self.stdout = self.save_out[-1]
-                self.save_out = self.save_out[:-1]
-            if self.last_pipe is not None:
-                self.stdin = self.save_in[-1]
-                self.save_in = self.save_in[:-1]
-            self.last_ending = self.curr_ending
-            self.last_pipe = self.curr_pipe
+                    fno = gr.linenum()
+                print(f"{self.scriptname}: line {fno}: {args[0]}: command not found",file=self.stderr)
+                self.log(args=args,msg="command not found",line=fno)
+                self.vars["?"] = "1"
+                if self.flags.get("e",False):
+                    shell_exit(1)
+                return []
+            args = self.allow_cmd(args)
+            if self.flags.get("x",False):
+                if self.stderr is not None:
+                    self.stderr.write("+ "+" ".join(args)+"\n")
+            env = self.environ()
+            kwargs : Dict[str,Any] = {}
+            if self.cwd is not None:
+                kwargs["cwd"] = self.cwd
+            try:
+                tstart = time()
+                p = PipeThread(args, stdin=sin, stdout=sout, stderr=serr, universal_newlines=True, env=env, launcher=self.launcher, **kwargs)
+                self.log(msg="start",pid=p.getpid(), args=args, time=tstart)
+            except OSError as e:
+                args = ["/bin/sh"]+args
+                p = PipeThread(args, stdin=sin, stdout=sout, stderr=serr, universal_newlines=True, env=env, launcher=self.launcher, **kwargs)
+                self.log(msg="start",pid=p.getpid(), args=args)
+            if self.curr_ending == "&":
+                p.background(self.jobs)
+                p.start()
+            elif self.curr_pipe is not None:
+                # Let the stage run while the rest of the
+                # pipeline starts. It is waited for at the end.
+                p.start()
+                self.pipeline += [p]
+                return []
+            else:
+                p.start()
+                p.communicate()
+                self.vars["?"] = str(p.returncode)
+                self.log(msg="end", rc=self.vars["?"], pid=p.getpid())
+                if self.vars["?"] != "0" and self.flags.get("e",False):
+                    shell_exit(int(self.vars["?"]))
+                return []
+        return []
 
     def run_file(self,fname:str)->str:
-        with open(fname, "r") as fd:
-            self.scriptname = fname
-            return self.run_text(fd.read())
+        self.scriptname = fname
+        return self.run_text(self.read_script(fname,1))
 
     def run_text(self,txt:str)->str:
         try:
@@ -1463,8 +2197,12 @@ class shell:
                     self.stderr = tmpfile()
                 else:
                     self.stderr = sys.stderr
+            self.run_depth += 1
             return self.run_text_(txt)
         finally:
+            self.run_depth -= 1
+            if self.run_depth == 0 and self.dir_cache is not None:
+                self.dir_cache.clear()
             if s1 is None and is_jupyter:
                 print(self.stdout.getvalue(),end='')
             if s2 is None and is_jupyter:
@@ -1473,6 +2211,12 @@ class shell:
             self.stdout = s1
             self.stderr = s2
 
+    def matcher(self,txt:str)->Matcher:
+        if self.packrat:
+            return PackratMatcher(packrat_grammar(), "whole_cmd", txt, self.max_memo)
+        else:
+            return Matcher(pp, "whole_cmd", txt)
+
     def run_text_(self,txt:str)->str:
         #here(colored("="*50,"yellow"))
         nchars=50
@@ -1486,9 +2230,17 @@ class shell:
             return "CONTNUE"
 
         #print(colored(txt,"cyan"))
-        m = Matcher(pp, "whole_cmd", txt)
-        if m.matches():
-            for gr in m.gr.children:
+        root = None
+        if self.parse_cache is not None:
+            root = self.parse_cache.get(txt)
+        if root is None:
+            m = self.matcher(txt)
+            if m.matches():
+                root = m.gr
+                if self.parse_cache is not None and root.end == len(txt):
+                    self.parse_cache.put(txt, root)
+        if root is not None:
+            for gr in root.children:
                 if gr.is_("case"):
                     if not gr.has(-1,"casepattern"):
                         self.txt = txt+'\n'
@@ -1502,8 +2254,8 @@ class shell:
             # here(m.gr.dump())
             if verbose:
                 print(colored(txt,"cyan"))
-                print(colored(m.gr.dump(),"magenta"))
-            end = m.gr.end
+                print(colored(root.dump(),"magenta"))
+            end = root.end
             txt2 = txt[end:]
             if len(txt2)>0:
                 self.run_text(txt2)
@@ -1511,8 +2263,8 @@ class shell:
                 with open(history,"a") as fd:
                     print(txt.strip(),file=fd)
             self.txt = ''
-            self.lines += [m.gr]
-            self.eval(m.gr)
+            self.lines += [root]
+            self.eval(root)
             if len(self.stack) > 0 or len(self.for_loops) > 0:
                 return "EVALCONTINUE"
             else:
@@ -1535,7 +2287,7 @@ class shell:
 def interactive(shell:shell)->int:
     try:
         import readline
-        c = Completer()
+        c = Completer(shell.dir_cache)
         readline.set_completer(c.complete)
         readline.parse_and_bind("tab: complete")
     except Exception as ee:
@@ -1581,7 +2333,7 @@ def run_interactive(s:shell)->None:
     except ShellAccess as sa:
         s.err(sa) #,s.stderr)
         rc = -1
-        s.log(msg="session ended with access error",rc=rc)
+        s.log(msg="session ended with access error",rc=rc,exc=sa)
     except ShellExit as se:
         rc = se.rc
         s.log(msg="session ended normally",rc=rc)
@@ -1601,13 +2353,19 @@ def run_shell(s:shell)->None:
         try:
             rs = s.run_text(ssh_cmd)
             s.log(rs=rs)
+        except ShellAccess as sa:
+            rc = -1
+            s.err(sa)
+            s.log(msg="session ended with access error",rc=rc,exc=sa)
+            exit(rc)
+        except ShellExit as se:
+            exit(se.rc)
         except Exception as ee:
             s.log_exc(ee)
     elif os.path.realpath(s.shell_name) != os.path.realpath(s.args[0]):
         s.scriptname  = s.args[0]
-        with s.open_file(s.args[0],"r",1) as fd:
-            rs = s.run_text(fd.read())
-            s.log(rs=rs)
+        rs = s.run_text(s.read_script(s.args[0],1))
+        s.log(rs=rs)
     else:
         found = False
         for n in range(1,len(args)):
@@ -1617,25 +2375,28 @@ def run_shell(s:shell)->None:
                 s.run_text(args[n])
                 found = True
             elif os.path.exists(f):
-                with s.open_file(f,"r",1) as fd:
-                    try:
-                        found = True
-                        rs = s.run_text(fd.read())
-                        s.log(rs=rs)
-                        assert rs == "EVAL", f"rc={rc}"
-                    except ShellAccess as sa:
-                        rc = -1
-                        s.err(sa)
-                        exit(rc)
-                    except ShellExit as se:
-                        rc = se.rc
-                        exit(rc)
-                    except Exception as ee:
-                        s.log_exc(ee)
+                try:
+                    found = True
+                    rs = s.run_text(s.read_script(f,1))
+                    s.log(rs=rs)
+                    assert rs == "EVAL", f"rc={rc}"
+                except ShellAccess as sa:
+                    rc = -1
+                    s.err(sa)
+                    s.log(msg="session ended with access error",rc=rc,exc=sa)
+                    exit(rc)
+                except ShellExit as se:
+                    rc = se.rc
+                    exit(rc)
+                except Exception as ee:
+                    s.log_exc(ee)
         if not found:
             run_interactive(s)
 
 def main()->None:
+    if len(sys.argv)>1 and sys.argv[1] == "--parallel":
+        from .batch import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
     if len(sys.argv)>1 and os.access(sys.argv[0], os.R_OK):
         sh = my_shell
         args = sys.argv[1:]
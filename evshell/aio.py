@@ -0,0 +1,214 @@
+# An asyncio interface for running evshell commands from Python,
+# so that one event loop can drive many sessions at once:
+#
+#   ash = AsyncShell()
+#   rc, out, err = await ash.run("ls | wc -l")
+#
+#   job = await ash.start("make")
+#   async for line in job.stdout:
+#       ...
+#   rc = await job.wait()
+#
+# Each command runs as a session of its own, like bash -c, in the
+# AsyncShell's directory and environment. If an evshell server (see
+# server.py) is listening, the session is handed to one of its
+# workers. Otherwise a new evshell process is started. Either way the
+# output arrives through asyncio pipe transports, without a thread
+# per command.
+from typing import Dict, List, Optional, Tuple
+from abc import ABC, abstractmethod
+from .client import default_socket
+import asyncio
+import json
+import os
+import socket
+import struct
+import sys
+
+class Job(ABC):
+    """
+    A running command. stdout and stderr are asyncio.StreamReaders,
+    and wait() returns the exit status once both are read or the
+    command is done.
+    """
+    def __init__(self, stdout:asyncio.StreamReader, stderr:asyncio.StreamReader)->None:
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode : Optional[int] = None
+
+    @abstractmethod
+    async def wait(self)->int:
+        pass
+
+class ProcessJob(Job):
+    """
+    A command run in a new evshell process.
+    """
+    def __init__(self, proc:asyncio.subprocess.Process)->None:
+        assert proc.stdout is not None and proc.stderr is not None
+        Job.__init__(self, proc.stdout, proc.stderr)
+        self.proc = proc
+
+    async def wait(self)->int:
+        self.returncode = await self.proc.wait()
+        return self.returncode
+
+class ServerJob(Job):
+    """
+    A command run by a worker of the evshell server. The worker
+    writes to pipes whose other ends are read here, and reports
+    the exit status on the socket.
+    """
+    def __init__(self, sock:socket.socket, stdout:asyncio.StreamReader, stderr:asyncio.StreamReader)->None:
+        Job.__init__(self, stdout, stderr)
+        self.sock = sock
+
+    async def wait(self)->int:
+        if self.returncode is not None:
+            return self.returncode
+        loop = asyncio.get_running_loop()
+        reply = b""
+        try:
+            while len(reply) < 4:
+                data = await loop.sock_recv(self.sock, 4-len(reply))
+                if len(data) == 0:
+                    # The worker died without reporting
+                    self.returncode = 255
+                    return self.returncode
+                reply += data
+        finally:
+            self.sock.close()
+        self.returncode = struct.unpack("!i", reply)[0]
+        return self.returncode
+
+async def connect(path:str)->socket.socket:
+    # Connecting to a Unix socket does not wait for the server
+    # in non-blocking mode, it fails if the backlog is full
+    delay = 0.001
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(path)
+            return sock
+        except BlockingIOError:
+            sock.close()
+        except BaseException:
+            sock.close()
+            raise
+        await asyncio.sleep(delay)
+        delay = min(2*delay, 0.1)
+
+async def read_pipe(fd:int)->asyncio.StreamReader:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, "rb"))
+    return reader
+
+class AsyncShell:
+    """
+    Runs evshell commands from an event loop. cwd and env default
+    to those of this process when the AsyncShell is made. policy
+    names a policy of the server, and server says whether to use
+    one: True requires it, False never tries, and None (the default)
+    uses it when it is listening on path.
+    """
+    def __init__(self, cwd:Optional[str]=None, env:Optional[Dict[str,str]]=None,
+            policy:Optional[str]=None, server:Optional[bool]=None, path:Optional[str]=None)->None:
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self.env = dict(os.environ) if env is None else env
+        self.policy = policy
+        self.server = server
+        self.path = default_socket() if path is None else path
+
+    async def start(self, text:str, input:Optional[bytes]=None)->Job:
+        """
+        Start running text and return its Job. input, if
+        given, is what the command reads on its stdin.
+        """
+        if self.server is not False:
+            try:
+                return await self.start_served(text, input)
+            except OSError:
+                if self.server is True:
+                    raise
+        return await self.start_process(text, input)
+
+    async def start_process(self, text:str, input:Optional[bytes])->Job:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "evshell.aio", text,
+            stdin=asyncio.subprocess.DEVNULL if input is None else asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            cwd=self.cwd, env=self.env)
+        if input is not None:
+            assert proc.stdin is not None
+            proc.stdin.write(input)
+            proc.stdin.close()
+        return ProcessJob(proc)
+
+    async def start_served(self, text:str, input:Optional[bytes])->Job:
+        loop = asyncio.get_running_loop()
+        sock = await connect(self.path)
+        fds : List[int] = []
+        ours : List[int] = []
+        try:
+            if input is None:
+                fds += [os.open(os.devnull, os.O_RDONLY)]
+            else:
+                in_r, in_w = os.pipe()
+                fds += [in_r]
+                ours += [in_w]
+            for _ in range(2):
+                r, w = os.pipe()
+                ours += [r]
+                fds += [w]
+            data = json.dumps({
+                "argv":["-c", text],
+                "env":self.env,
+                "cwd":self.cwd,
+                "policy":self.policy}).encode()
+            data = struct.pack("!I", len(data)) + data
+            n = socket.send_fds(sock, [data], fds) # type: ignore[attr-defined]
+            await loop.sock_sendall(sock, data[n:])
+        except BaseException:
+            sock.close()
+            for fd in ours:
+                os.close(fd)
+            raise
+        finally:
+            # The worker has its own copies now
+            for fd in fds:
+                os.close(fd)
+        if input is not None:
+            in_w = ours.pop(0)
+            transport, _ = await loop.connect_write_pipe(asyncio.Protocol, os.fdopen(in_w, "wb"))
+            transport.write(input)
+            transport.close()
+        stdout = await read_pipe(ours[0])
+        stderr = await read_pipe(ours[1])
+        return ServerJob(sock, stdout, stderr)
+
+    async def run(self, text:str, input:Optional[bytes]=None)->Tuple[int,str,str]:
+        """
+        Run text and return its exit status and its output.
+        """
+        job = await self.start(text, input)
+        out, err = await asyncio.gather(job.stdout.read(), job.stderr.read())
+        rc = await job.wait()
+        return rc, out.decode(errors="replace"), err.decode(errors="replace")
+
+def main(argv:List[str])->int:
+    # Run one command the way a server worker would, for start_process()
+    from . import shell, run_shell, ShellExit, my_shell
+    s = shell(args=[my_shell, "-c"]+argv, shell_name=my_shell)
+    s.bind_to_env()
+    try:
+        run_shell(s)
+        return int(s.vars["?"])
+    except ShellExit as se:
+        return se.rc
+    finally:
+        s.log_writer.close()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
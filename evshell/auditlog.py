@@ -0,0 +1,289 @@
+from typing import Any, Dict, IO, Iterator, List, Optional, Set, Tuple
+import fcntl
+import json
+import os
+import re
+import struct
+import sys
+import zlib
+
+# The kinds of record shell.log() writes. Binary records
+# store the code in their header so they can be filtered
+# without decoding the payload.
+events = ["other", "start", "end", "setvar", "unset", "open", "chdir", "exc"]
+event_codes = {name:n for n,name in enumerate(events)}
+
+def event_of(args:Dict[str,Any])->str:
+    msg = args.get("msg", None)
+    if msg in ["start", "end"]:
+        return msg
+    for key in ["setvar", "unset", "open", "chdir", "exc"]:
+        if key in args:
+            return key
+    return "other"
+
+class JsonFormat:
+    """
+    One JSON object per line. This is the default.
+    """
+    suffix = ".jtxt"
+
+    def open(self, fname:str)->IO[Any]:
+        return open(fname, "w")
+
+    def encode(self, args:Dict[str,Any])->str:
+        return json.dumps(args)+"\n"
+
+    def write_block(self, fd:IO[Any], records:List[Any])->None:
+        fd.write("".join(records))
+
+    def close(self)->None:
+        pass
+
+# Binary layout. The log is a sequence of blocks, each a header
+# followed by its records, optionally compressed with zlib. A
+# record is a fixed header followed by the remaining fields as
+# compact JSON. For every block, a summary is appended to the
+# sidecar index (the log file name plus ".idx"), so that a reader
+# can skip blocks that cannot match a query.
+magic = b"ELB1"
+block_header = struct.Struct("<4sBII")    # magic, flags, stored size, record count
+record_header = struct.Struct("<IdiiB")   # payload size, time, shell pid, process pid, event
+index_entry = struct.Struct("<QddIH")     # offset, first time, last time, event mask, pid count
+compressed = 1
+
+class BinaryFormat:
+    """
+    Length-prefixed records in blocks, with a sidecar index.
+    Files are opened for appending, so forked children may share
+    them with the shell. A block and its index entry are written
+    under a lock on the log, so that the offset in the entry is
+    where the block went.
+    """
+    suffix = ".elog"
+
+    def __init__(self, compress:bool=True, level:int=1)->None:
+        self.compress = compress
+        self.level = level
+        self.index_fd = -1
+
+    def open(self, fname:str)->IO[Any]:
+        flags = os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_APPEND
+        self.index_fd = os.open(fname+".idx", flags, 0o666)
+        return open(os.open(fname, flags, 0o666), "wb", buffering=0)
+
+    def encode(self, args:Dict[str,Any])->bytes:
+        fields = {k:v for k,v in args.items() if k != "time"}
+        payload = json.dumps(fields, separators=(",",":")).encode()
+        pid = args.get("pid", 0)
+        if type(pid) != int:
+            pid = 0
+        head = record_header.pack(len(payload), args.get("time", 0.0), os.getpid(), pid, event_codes[event_of(args)])
+        return head + payload
+
+    def write_block(self, fd:IO[Any], records:List[Any])->None:
+        tmin = tmax = 0.0
+        mask = 0
+        pids : Set[int] = set()
+        for n, rec in enumerate(records):
+            _, t, spid, pid, ev = record_header.unpack_from(rec)
+            if n == 0 or t < tmin:
+                tmin = t
+            if n == 0 or t > tmax:
+                tmax = t
+            mask |= 1 << ev
+            pids.add(spid)
+            if pid != 0:
+                pids.add(pid)
+        data = b"".join(records)
+        flags = 0
+        if self.compress and len(data) > 256:
+            zdata = zlib.compress(data, self.level)
+            if len(zdata) < len(data):
+                data = zdata
+                flags = compressed
+        block = block_header.pack(magic, flags, len(data), len(records)) + data
+        plist = sorted(pids)
+        # lockf() locks are held by a process, not by the file
+        # description that forked children share with the shell
+        fcntl.lockf(fd.fileno(), fcntl.LOCK_EX)
+        try:
+            offset = os.lseek(fd.fileno(), 0, os.SEEK_END)
+            fd.write(block)
+            entry = index_entry.pack(offset, tmin, tmax, mask, len(plist))
+            os.write(self.index_fd, entry + struct.pack(f"<{len(plist)}i", *plist))
+        finally:
+            fcntl.lockf(fd.fileno(), fcntl.LOCK_UN)
+
+    def close(self)->None:
+        if self.index_fd >= 0:
+            os.close(self.index_fd)
+            self.index_fd = -1
+
+log_formats = {"json":JsonFormat, "binary":BinaryFormat}
+
+def get_log_format(name:str)->Any:
+    if name not in log_formats:
+        raise Exception(f"Unknown log format '{name}'")
+    return log_formats[name]()
+
+class Query:
+    """
+    Selects log records. Every condition that is not None
+    must hold. events is a set of names from events, and
+    argv is a regular expression searched for in the
+    command line of start records.
+    """
+    def __init__(self, pid:Optional[int]=None, since:Optional[float]=None, until:Optional[float]=None,
+            events:Optional[Set[str]]=None, argv:Optional[str]=None)->None:
+        self.pid = pid
+        self.since = since
+        self.until = until
+        self.argv = None if argv is None else re.compile(argv)
+        if self.argv is not None:
+            # Only start records have a command line
+            events = {"start"} if events is None else events & {"start"}
+        self.events = events
+        self.mask = 0
+        if events is not None:
+            for ev in events:
+                self.mask |= 1 << event_codes[ev]
+
+    def block_may_match(self, tmin:float, tmax:float, mask:int, pids:List[int])->bool:
+        if self.since is not None and tmax < self.since:
+            return False
+        if self.until is not None and tmin > self.until:
+            return False
+        if self.events is not None and (mask & self.mask) == 0:
+            return False
+        if self.pid is not None and self.pid not in pids:
+            return False
+        return True
+
+    def matches(self, rec:Dict[str,Any], event:str, pids:Tuple[Any,...])->bool:
+        t = rec.get("time", 0.0)
+        if self.since is not None and t < self.since:
+            return False
+        if self.until is not None and t > self.until:
+            return False
+        if self.events is not None and event not in self.events:
+            return False
+        if self.pid is not None and self.pid not in pids:
+            return False
+        if self.argv is not None:
+            args = rec.get("args", None)
+            if event != "start" or type(args) != list:
+                return False
+            if self.argv.search(" ".join([str(a) for a in args])) is None:
+                return False
+        return True
+
+def _read_json(fname:str, query:Query)->Iterator[Dict[str,Any]]:
+    g = re.search(r'log-(\d+)', os.path.basename(fname))
+    shell_pid = int(g.group(1)) if g else None
+    with open(fname) as fd:
+        for line in fd:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if query.matches(rec, event_of(rec), (shell_pid, rec.get("pid", None))):
+                yield rec
+
+def _read_index(fname:str)->Optional[List[Tuple[int,float,float,int,List[int]]]]:
+    try:
+        with open(fname+".idx", "rb") as fd:
+            data = fd.read()
+    except OSError:
+        return None
+    entries = []
+    pos = 0
+    while pos + index_entry.size <= len(data):
+        offset, tmin, tmax, mask, npids = index_entry.unpack_from(data, pos)
+        pos += index_entry.size
+        pids = list(struct.unpack_from(f"<{npids}i", data, pos))
+        pos += 4*npids
+        entries += [(offset, tmin, tmax, mask, pids)]
+    entries.sort()
+    return entries
+
+def _read_block(fd:IO[bytes], query:Query)->Optional[Iterator[Dict[str,Any]]]:
+    head = fd.read(block_header.size)
+    if len(head) < block_header.size:
+        return None
+    mg, flags, size, count = block_header.unpack(head)
+    if mg != magic:
+        raise Exception("Not an evshell binary log")
+    data = fd.read(size)
+    if flags & compressed:
+        data = zlib.decompress(data)
+    return _records(data, count, query)
+
+def _records(data:bytes, count:int, query:Query)->Iterator[Dict[str,Any]]:
+    pos = 0
+    for _ in range(count):
+        size, t, spid, pid, ev = record_header.unpack_from(data, pos)
+        pos += record_header.size
+        payload = data[pos:pos+size]
+        pos += size
+        event = events[ev]
+        if query.events is not None and event not in query.events:
+            continue
+        if query.pid is not None and query.pid not in (spid, pid):
+            continue
+        rec = json.loads(payload)
+        rec["time"] = t
+        if query.matches(rec, event, (spid, pid)):
+            yield rec
+
+def _read_binary(fname:str, query:Query)->Iterator[Dict[str,Any]]:
+    index = _read_index(fname)
+    with open(fname, "rb") as fd:
+        if index is None:
+            while True:
+                recs = _read_block(fd, query)
+                if recs is None:
+                    return
+                yield from recs
+        for offset, tmin, tmax, mask, pids in index:
+            if not query.block_may_match(tmin, tmax, mask, pids):
+                continue
+            fd.seek(offset)
+            recs = _read_block(fd, query)
+            if recs is not None:
+                yield from recs
+
+def read_log(fname:str, query:Optional[Query]=None)->Iterator[Dict[str,Any]]:
+    """
+    Yield the records of a log file in either format
+    that satisfy query.
+    """
+    if query is None:
+        query = Query()
+    if fname.endswith(BinaryFormat.suffix):
+        return _read_binary(fname, query)
+    else:
+        return _read_json(fname, query)
+
+def main(argv:List[str])->int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m evshell.auditlog", description="Search evshell logs.")
+    parser.add_argument("--pid", type=int, help="shell or process id")
+    parser.add_argument("--since", type=float, help="seconds since the epoch")
+    parser.add_argument("--until", type=float, help="seconds since the epoch")
+    parser.add_argument("--event", action="append", choices=events)
+    parser.add_argument("--argv", help="regular expression to search for in command lines")
+    parser.add_argument("files", nargs="+")
+    opts = parser.parse_args(argv)
+    query = Query(pid=opts.pid, since=opts.since, until=opts.until,
+        events=None if opts.event is None else set(opts.event), argv=opts.argv)
+    for fname in opts.files:
+        for rec in read_log(fname, query):
+            print(json.dumps(rec))
+    return 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except BrokenPipeError:
+        pass
@@ -0,0 +1,141 @@
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
+from . import shell, ShellExit, ShellAccess, set_enable_history
+from .capture import capture_file
+from .pipe_threads import JobTable
+from traceback import format_exc
+import multiprocessing
+import os
+import shlex
+import signal
+import sys
+
+class Result:
+    """
+    What running one script produced.
+    """
+    def __init__(self, fname:str, rc:int, stdout:str, stderr:str)->None:
+        self.fname = fname
+        self.rc = rc
+        self.stdout = stdout
+        self.stderr = stderr
+
+    def __repr__(self)->str:
+        return f"Result({self.fname},{self.rc})"
+
+# A script file, or a script file followed by its arguments
+Script = Union[str, Sequence[str]]
+
+# The shell each worker forks for every script it runs
+_base : Optional[shell] = None
+
+def _init_worker(cwd:str)->None:
+    global _base
+    set_enable_history(False)
+    _base = shell([], cwd=cwd)
+    _base.stdin = open(os.devnull, "r")
+
+def set_args(sh:shell, argv:List[str])->None:
+    """
+    Make argv[0] the shell's $0 and the rest its $1, $2, ...
+    """
+    sh.args = argv
+    for vnum in range(len(argv)):
+        sh.vars[str(vnum)] = argv[vnum]
+    sh.vars["@"] = " ".join(argv[1:])
+    sh.vars["*"] = " ".join(argv[1:])
+
+def _run_child(sh:shell, argv:List[str])->int:
+    try:
+        set_args(sh, argv)
+        sh.run_file(argv[0])
+        return int(sh.vars["?"])
+    except ShellExit as se:
+        return se.rc
+    except ShellAccess as sa:
+        sh.err(sa)
+        sh.log(msg="session ended with access error",exc=sa)
+        return 255
+    except Exception:
+        sh.stderr.write(format_exc())
+        return 1
+
+def run_script(script:Script)->Result:
+    """
+    Run one script in a worker and collect its output and exit
+    status. The script runs in a child forked from the worker's
+    shell, so that exec, exit or a signal that kills it does not
+    take the worker (and the results of other scripts) with it.
+    The children share the worker's log file.
+    """
+    assert _base is not None
+    argv = [script] if isinstance(script, str) else list(script)
+    out = capture_file()
+    err = capture_file()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _base.log_flush()
+    pid = os.fork()
+    if pid == 0:
+        rc = 255
+        try:
+            # Commands started by the script, and any program
+            # it execs, write to the captures too
+            os.dup2(out.fileno(), 1)
+            os.dup2(err.fileno(), 2)
+            _base.log_writer.after_fork()
+            _base.jobs = JobTable()
+            _base.stdout = out
+            _base.stderr = err
+            rc = _run_child(_base, argv)
+            out.flush()
+            err.flush()
+            _base.log_flush()
+        finally:
+            os._exit(rc & 0xff)
+    _, status = os.waitpid(pid, 0)
+    rc = os.waitstatus_to_exitcode(status)
+    outputs : List[str] = []
+    for f in [out, err]:
+        f.seek(0)
+        outputs += [f.read()]
+        f.close()
+    if rc < 0:
+        outputs[1] += f"{argv[0]}: killed by {signal.Signals(-rc).name}\n"
+        rc = 128 - rc
+    return Result(argv[0], rc, outputs[0], outputs[1])
+
+def run_batch(scripts:Iterable[Script], workers:int=os.cpu_count() or 1, cwd:Optional[str]=None)->Iterator[Result]:
+    """
+    Run many scripts on a pool of worker processes and yield
+    their Results as they finish. The workers are forked from
+    this process, so the grammar is already compiled in them,
+    and each takes the next script whenever it is idle. A script
+    is a file name, or a list of the file name and its arguments.
+    Scripts start in cwd, or the current directory.
+    """
+    ctx = multiprocessing.get_context("fork")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with ctx.Pool(workers, _init_worker, (os.getcwd() if cwd is None else cwd,)) as pool:
+        yield from pool.imap_unordered(run_script, scripts, chunksize=1)
+
+def main(argv:List[str])->int:
+    import argparse
+    parser = argparse.ArgumentParser(prog="evshell --parallel",
+        description="Run scripts on N worker processes. The output of each script is written as one block when it finishes.")
+    parser.add_argument("workers", type=int, metavar="N")
+    parser.add_argument("scripts", nargs="*",
+        help="script files, or read them from stdin, one per line with its arguments")
+    opts = parser.parse_args(argv)
+    scripts : Iterable[Script] = opts.scripts
+    if len(opts.scripts) == 0:
+        scripts = (shlex.split(line) for line in sys.stdin if line.strip() != "")
+    failed = 0
+    for res in run_batch(scripts, opts.workers):
+        sys.stdout.write(res.stdout)
+        sys.stdout.flush()
+        sys.stderr.write(res.stderr)
+        sys.stderr.flush()
+        if res.rc != 0:
+            failed += 1
+    return 0 if failed == 0 else 1
@@ -0,0 +1,239 @@
+from typing import Any, Callable, Dict, Generator, IO, Iterator, List, Optional, Tuple
+import codecs
+import io
+import os
+import re
+from .pipes import PipeWriter, chunk_size
+from .capture import CaptureFile
+from .testexpr import TestError, evaltest
+
+# In-process versions of small commands that scripts run over and
+# over, so that `for i in $(seq 1 10); do echo $i; done` does not
+# start a process per line. A builtin is run like a pyfunc written
+# as a generator (see shell.run_pyfilter()): it takes the lines of
+# its input, yields its output and returns its exit status. It also
+# gets the output and error streams after redirection. A builtin
+# only stands in for arguments it handles exactly as the external
+# command would; for anything else the command is run as usual.
+builtin_t = Callable[[Any,List[str],Iterator[str],IO[str],IO[str]],Generator[str,None,int]]
+
+class Builtin:
+    """
+    A command that can run in the shell's process. handles(args)
+    says whether it can deal with the arguments (not including the
+    command name).
+    """
+    def __init__(self, name:str, run:builtin_t, handles:Optional[Callable[[List[str]],bool]]=None)->None:
+        self.name = name
+        self.run = run
+        self.handles = (lambda args: True) if handles is None else handles
+
+    def __repr__(self)->str:
+        return f"Builtin({self.name})"
+
+def is_option(arg:str)->bool:
+    return len(arg) > 1 and arg.startswith("-")
+
+def no_options(args:List[str])->bool:
+    return not any([is_option(a) for a in args])
+
+echo_escape = re.compile(r'\\(0[0-7]{0,3}|x[0-9a-fA-F]{1,2}|u[0-9a-fA-F]{1,4}|U[0-9a-fA-F]{1,8}|.)', re.DOTALL)
+echo_chars = {"a":"\a", "b":"\b", "e":"\x1b", "E":"\x1b", "f":"\f", "n":"\n",
+    "r":"\r", "t":"\t", "v":"\v", "\\":"\\"}
+
+def echo_unescape(text:str)->Tuple[str,bool]:
+    """
+    Interpret the escapes of echo -e. Also says
+    whether a \\c ended the output.
+    """
+    out = ""
+    pos = 0
+    for g in echo_escape.finditer(text):
+        out += text[pos:g.start()]
+        pos = g.end()
+        code = g.group(1)
+        if code == "c":
+            return out, True
+        elif code in echo_chars:
+            out += echo_chars[code]
+        elif code[0] == "0":
+            out += chr(int(code, 8) & 0xff)
+        elif code[0] in "xuU":
+            out += chr(int(code[1:], 16))
+        else:
+            out += g.group(0)
+    return out + text[pos:], False
+
+def echo(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    newline = True
+    escapes = False
+    while len(args) > 0 and re.fullmatch(r'-[neE]+', args[0]):
+        for c in args[0][1:]:
+            if c == "n":
+                newline = False
+            else:
+                escapes = c == "e"
+        args = args[1:]
+    text = " ".join(args)
+    if escapes:
+        text, stop = echo_unescape(text)
+        if stop:
+            newline = False
+    yield text + "\n" if newline else text
+    return 0
+
+def true(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    yield from []
+    return 0
+
+def false(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    yield from []
+    return 1
+
+seq_num = re.compile(r'[+-]?[0-9]+')
+
+def test(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str], name:str="test")->Generator[str,None,int]:
+    yield from []
+    try:
+        return 0 if evaltest(sh, args) else 1
+    except TestError as te:
+        serr.write(f"{name}: {te}\n")
+        serr.flush()
+        return 2
+
+def bracket(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    if len(args) == 0 or args[-1] != "]":
+        serr.write("[: missing `]'\n")
+        serr.flush()
+        return 2
+    return (yield from test(sh, args[:-1], lines, sout, serr, "["))
+
+def seq_args(args:List[str])->Optional[Dict[str,Any]]:
+    opts : Dict[str,Any] = {"sep":"\n", "width":False}
+    while len(args) > 0 and is_option(args[0]) and seq_num.fullmatch(args[0]) is None:
+        if args[0] == "-w":
+            opts["width"] = True
+            args = args[1:]
+        elif args[0] == "-s" and len(args) > 1:
+            opts["sep"] = args[1]
+            args = args[2:]
+        elif args[0].startswith("-s") and not args[0].startswith("--"):
+            opts["sep"] = args[0][2:]
+            args = args[1:]
+        else:
+            return None
+    if len(args) not in [1, 2, 3] or not all([seq_num.fullmatch(a) for a in args]):
+        return None
+    nums = [int(a) for a in args]
+    if len(nums) == 1:
+        nums = [1] + nums
+    if len(nums) == 2:
+        nums = [nums[0], 1, nums[1]]
+    if nums[1] == 0:
+        return None
+    opts["first"], opts["incr"], opts["last"] = nums
+    return opts
+
+def seq(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    opts = seq_args(args)
+    assert opts is not None
+    first, incr, last = opts["first"], opts["incr"], opts["last"]
+    fmt = "{}"
+    if opts["width"]:
+        fmt = "{:0" + str(max(len(str(first)), len(str(last)))) + "}"
+    nums = range(first, last+1 if incr > 0 else last-1, incr)
+    if len(nums) == 0:
+        return 0
+    sep = opts["sep"]
+    # Yield in blocks, so a long sequence streams without
+    # a call per number
+    block = 1024
+    for i in range(0, len(nums), block):
+        text = sep.join([fmt.format(n) for n in nums[i:i+block]])
+        yield text + ("\n" if i+block >= len(nums) else sep)
+    return 0
+
+def output_fd(sout:IO[str])->Optional[int]:
+    """
+    The file descriptor behind sout, if there is one. A pipe to
+    the next stage in this process, or the output of $(...) run
+    in this process, has none: asking for it would turn it into
+    a real pipe or file.
+    """
+    if isinstance(sout, (PipeWriter, CaptureFile)):
+        return None
+    try:
+        return sout.fileno()
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+def cat(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    rc = 0
+    if len(args) == 0:
+        args = ["-"]
+    for fname in args:
+        if fname == "-":
+            yield from lines
+            continue
+        try:
+            with open(sh.path(fname), "rb") as fd:
+                ofd = output_fd(sout)
+                if ofd is None:
+                    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+                    while True:
+                        data = fd.read(chunk_size)
+                        if len(data) == 0:
+                            break
+                        yield decoder.decode(data)
+                    yield decoder.decode(b"", final=True)
+                    continue
+                # Copy the bytes unchanged, as the external cat would
+                sout.flush()
+                while True:
+                    data = fd.read(chunk_size)
+                    if len(data) == 0:
+                        break
+                    while len(data) > 0:
+                        data = data[os.write(ofd, data):]
+        except OSError as e:
+            serr.write(f"cat: {fname}: {e.strerror}\n")
+            serr.flush()
+            rc = 1
+    return rc
+
+def basename(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    name = args[0]
+    base = name.rstrip("/")
+    if base == "" and name != "":
+        base = "/"
+    else:
+        base = base.split("/")[-1]
+    if len(args) == 2 and args[1] != base and base.endswith(args[1]):
+        base = base[:len(base)-len(args[1])]
+    yield base + "\n"
+    return 0
+
+def dir_name(name:str)->str:
+    path = name.rstrip("/")
+    if path == "":
+        return "/" if name != "" else "."
+    if "/" not in path:
+        return "."
+    path = path[:path.rindex("/")].rstrip("/")
+    return "/" if path == "" else path
+
+def dirname(sh:Any, args:List[str], lines:Iterator[str], sout:IO[str], serr:IO[str])->Generator[str,None,int]:
+    yield "".join([dir_name(name)+"\n" for name in args])
+    return 0
+
+builtin_cmds : Dict[str,Builtin] = {b.name:b for b in [
+    Builtin("echo", echo),
+    Builtin("true", true),
+    Builtin("false", false),
+    Builtin("test", test),
+    Builtin("[", bracket),
+    Builtin("seq", seq, lambda args: seq_args(args) is not None),
+    Builtin("cat", cat, no_options),
+    Builtin("basename", basename, lambda args: len(args) in [1, 2] and no_options(args)),
+    Builtin("dirname", dirname, lambda args: len(args) > 0 and no_options(args)),
+]}
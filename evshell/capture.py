@@ -0,0 +1,198 @@
+from typing import Iterable, Iterator, List, Optional, IO
+from tempfile import TemporaryFile
+import codecs
+import fcntl
+import os
+import re
+
+chunk_size = 65536
+
+class Capture:
+    """
+    Collects everything written to a file descriptor until EOF.
+    Data is read directly into a growing bytearray. Once more
+    than max_memory bytes have arrived, the data is moved to a
+    temporary file and further reads are appended there.
+    """
+    def __init__(self, max_memory:int=64*1024*1024)->None:
+        self.max_memory = max_memory
+        self.buf = bytearray(chunk_size)
+        self.size = 0
+        self.spill : Optional[IO[bytes]] = None
+        self.total = 0
+
+    def read_from(self, fd:int)->'Capture':
+        while True:
+            if self.spill is not None:
+                data = os.read(fd, chunk_size)
+                if len(data) == 0:
+                    break
+                self.spill.write(data)
+                self.total += len(data)
+                continue
+            if len(self.buf) - self.size < chunk_size:
+                self.buf.extend(bytes(len(self.buf)))
+            n = os.readv(fd, [memoryview(self.buf)[self.size:]])
+            if n == 0:
+                break
+            self.size += n
+            self.total += n
+            if self.size > self.max_memory:
+                self.spill = TemporaryFile()
+                self.spill.write(memoryview(self.buf)[:self.size])
+                self.buf = bytearray()
+                self.size = 0
+        return self
+
+    def getvalue(self)->str:
+        return "".join(self.chunks())
+
+    def chunks(self)->Iterator[str]:
+        """
+        The captured text, decoded a chunk at a time, so data
+        that was spilled is not read back all at once.
+        """
+        if self.spill is None:
+            yield str(memoryview(self.buf)[:self.size], "utf-8", "replace")
+            return
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.spill.seek(0)
+        while True:
+            data = self.spill.read(chunk_size)
+            if len(data) == 0:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+
+    def words(self, ifs:str=" \t\n")->List[str]:
+        return split_words(self.chunks(), ifs)
+
+    def close(self)->None:
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self.buf = bytearray()
+        self.size = 0
+
+def split_words(chunks:Iterable[str], ifs:str=" \t\n")->List[str]:
+    """
+    Split text that arrives in chunks into the words of $(...).
+    Words are separated by runs of the characters in ifs (the
+    value of $IFS). If ifs is empty, the text is one word with
+    its trailing newlines removed.
+    """
+    if ifs == "":
+        return ["".join(chunks).rstrip("\n")]
+    sep = re.compile("[" + re.escape(ifs) + "]+")
+    words : List[str] = []
+    # The start of a word that may continue in the next chunk
+    pending : List[str] = []
+    for chunk in chunks:
+        parts = sep.split(chunk)
+        if len(parts) == 1:
+            pending.append(chunk)
+            continue
+        pending.append(parts[0])
+        words += [w for w in ["".join(pending)] + parts[1:-1] if w != ""]
+        pending = [parts[-1]]
+    last = "".join(pending)
+    if last != "":
+        words.append(last)
+    return words
+
+def copy_fd(fd:int, out:IO[str])->int:
+    """
+    Copy everything written to fd until EOF to the text
+    stream out, without holding it all in memory.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    total = 0
+    while True:
+        data = os.read(fd, chunk_size)
+        if len(data) == 0:
+            break
+        total += len(data)
+        out.write(decoder.decode(data))
+    out.write(decoder.decode(b"", final=True))
+    return total
+
+class CaptureFile:
+    """
+    Collects the output of a subshell run in this process. Text
+    written by the shell is kept in memory until there is more
+    than max_memory of it, or until a command it starts needs a
+    file descriptor. From then on it goes to a capture_file().
+    """
+    def __init__(self, max_memory:int=64*1024*1024)->None:
+        self.max_memory = max_memory
+        self.parts : List[str] = []
+        self.size = 0
+        self.file : Optional[IO[str]] = None
+
+    def _spill(self)->IO[str]:
+        if self.file is None:
+            self.file = capture_file()
+            self.file.write("".join(self.parts))
+            self.file.flush()
+            self.parts = []
+            self.size = 0
+        return self.file
+
+    def write(self, text:str)->int:
+        if self.file is not None:
+            return self.file.write(text)
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size > self.max_memory:
+            self._spill()
+        return len(text)
+
+    def flush(self)->None:
+        if self.file is not None:
+            self.file.flush()
+
+    def isatty(self)->bool:
+        return False
+
+    def fileno(self)->int:
+        f = self._spill()
+        f.flush()
+        return f.fileno()
+
+    def chunks(self)->Iterator[str]:
+        if self.file is None:
+            yield "".join(self.parts)
+            return
+        f = self.file
+        f.flush()
+        f.seek(0)
+        while True:
+            text = f.read(chunk_size)
+            if text == "":
+                break
+            yield text
+
+    def words(self, ifs:str=" \t\n")->List[str]:
+        return split_words(self.chunks(), ifs)
+
+    def close(self)->None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.parts = []
+        self.size = 0
+
+def capture_file()->IO[str]:
+    """
+    A file for the output of a subshell run in this process,
+    or of a batch script, without a size limit. It is opened for appending, so that text written by the shell
+    and by the commands it starts stays in order. Read it back
+    with seek(0) and read().
+    """
+    try:
+        fd = os.memfd_create("evshell-capture") # type: ignore[attr-defined]
+    except (AttributeError, OSError):
+        with TemporaryFile() as tmp:
+            fd = os.dup(tmp.fileno())
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_APPEND)
+    return open(fd, "w+", buffering=1, errors="replace")
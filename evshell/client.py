@@ -0,0 +1,84 @@
+# A thin client for the evshell server (see server.py). It does
+# not import the evshell package, so that it starts quickly. Run it
+# as a file, e.g. as the ForceCommand of an ssh gateway:
+#
+#   python3 -S /path/to/evshell/client.py --policy gateway
+#
+# It hands its stdin, stdout and stderr, arguments, environment and
+# working directory to the server, which forks a worker to run the
+# shell, and exits with the worker's exit status.
+from typing import List, Optional
+import json
+import os
+import socket
+import struct
+import sys
+
+def default_socket()->str:
+    path = os.environ.get("EVSHELL_SOCKET", None)
+    if path is None:
+        path = os.path.join(os.path.expanduser("~"), ".evshell-server.sock")
+    return path
+
+def send_request(sock:socket.socket, req:dict, fds:List[int])->None:
+    data = json.dumps(req).encode()
+    data = struct.pack("!I", len(data)) + data
+    n = socket.send_fds(sock, [data], fds) # type: ignore[attr-defined]
+    sock.sendall(data[n:])
+
+def run(argv:List[str], policy:Optional[str]=None, path:Optional[str]=None)->int:
+    """
+    Run the shell in the server and return its exit status,
+    or raise OSError if the server cannot be reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(default_socket() if path is None else path)
+        send_request(sock, {
+            "argv":argv,
+            "env":dict(os.environ),
+            "cwd":os.getcwd(),
+            "policy":policy}, [0, 1, 2])
+        reply = b""
+        while len(reply) < 4:
+            data = sock.recv(4-len(reply))
+            if len(data) == 0:
+                # The worker died without reporting
+                return 255
+            reply += data
+        return struct.unpack("!i", reply)[0]
+    finally:
+        sock.close()
+
+def main(argv:List[str])->int:
+    policy = None
+    path = None
+    fallback = None
+    while len(argv) > 0 and argv[0].startswith("--"):
+        opt = argv.pop(0)
+        if opt == "--":
+            break
+        elif opt in ["--policy", "--socket", "--fallback"] and len(argv) > 0:
+            val = argv.pop(0)
+            if opt == "--policy":
+                policy = val
+            elif opt == "--socket":
+                path = val
+            else:
+                fallback = val
+        else:
+            print(f"Usage: client.py [--policy name] [--socket path] [--fallback program] [--] args...", file=sys.stderr)
+            return 2
+    try:
+        return run(argv, policy, path)
+    except OSError as e:
+        if fallback is None:
+            print(f"evshell server: {e}", file=sys.stderr)
+            return 255
+    # Without a server, run the program given by --fallback, which
+    # is responsible for applying the same policy.
+    os.execv(sys.executable, [sys.executable, fallback] + argv)
+    return 255
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,114 @@
+from typing import Dict, List, Optional, Set, IO
+from .completer import ExecDir
+import os
+
+class CommandHash:
+    """
+    Remembers where commands were found on the PATH, like the
+    hash table in bash. The table is cleared when PATH changes,
+    or when the directory changes and PATH has relative entries,
+    which are made absolute. An entry is dropped when the
+    directory holding it changes. Directories are listed once (see ExecDir) and
+    re-listed only when their mtime changes, so looking for a
+    command does not stat every PATH entry.
+    """
+    def __init__(self)->None:
+        self.path : Optional[str] = None
+        self.cwd : Optional[str] = None
+        self.dirs : List[ExecDir] = []
+        self.bydir : Dict[str,ExecDir] = {}
+        self.names : Dict[str,Set[str]] = {}
+        self.table : Dict[str,str] = {}
+        self.counts : Dict[str,int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self)->None:
+        self.table = {}
+        self.counts = {}
+
+    def set_path(self, path:str, cwd:Optional[str]=None)->None:
+        if cwd is None:
+            cwd = os.getcwd()
+        entries = [p if p != "" else "." for p in path.split(":")]
+        if not all([os.path.isabs(p) for p in entries]):
+            # Where relative entries point depends on cwd
+            if path == self.path and cwd == self.cwd:
+                return
+            self.cwd = cwd
+        elif path == self.path:
+            return
+        self.path = path
+        self.dirs = []
+        self.bydir = {}
+        for p in entries:
+            p = os.path.normpath(os.path.join(cwd, p))
+            if p not in self.bydir:
+                self.bydir[p] = ExecDir(p)
+                self.dirs += [self.bydir[p]]
+        self.clear()
+
+    def _dir_changed(self, fname:str)->bool:
+        e = self.bydir.get(os.path.dirname(fname), None)
+        if e is None or e.st is None:
+            return True
+        try:
+            st = os.stat(e.dirname)
+        except OSError:
+            return True
+        return e.st.st_mtime != st.st_mtime or e.st.st_ino != st.st_ino
+
+    def find(self, name:str)->Optional[str]:
+        """
+        Search the PATH for the command, ignoring the table.
+        """
+        for e in self.dirs:
+            st = e.st
+            e.scan()
+            if st is not e.st or e.dirname not in self.names:
+                self.names[e.dirname] = set(e.files)
+            if name in self.names[e.dirname]:
+                fname = os.path.join(e.dirname, name)
+                if os.access(fname, os.X_OK) and not os.path.isdir(fname):
+                    return fname
+        return None
+
+    def lookup(self, name:str, path:str, cwd:Optional[str]=None)->Optional[str]:
+        """
+        Return the full path of the command name, or None.
+        Relative PATH entries are taken from cwd, by default
+        the current directory.
+        """
+        if "/" in name:
+            return None
+        self.set_path(path, cwd)
+        fname = self.table.get(name, None)
+        if fname is not None and not self._dir_changed(fname):
+            self.hits += 1
+            self.counts[name] += 1
+            return fname
+        self.misses += 1
+        fname = self.find(name)
+        if fname is None:
+            self.table.pop(name, None)
+            self.counts.pop(name, None)
+        else:
+            self.table[name] = fname
+            self.counts[name] = self.counts.get(name, 0) + 1
+        return fname
+
+    def add(self, name:str, path:str, cwd:Optional[str]=None)->Optional[str]:
+        self.set_path(path, cwd)
+        fname = self.find(name)
+        if fname is not None:
+            self.table[name] = fname
+            self.counts[name] = 0
+        return fname
+
+    def show(self, fd:IO[str])->None:
+        if len(self.table) == 0:
+            print("hash: hash table empty", file=fd)
+            return
+        print("hits\tcommand", file=fd)
+        for name in self.table:
+            print("%4d\t%s" % (self.counts[name], self.table[name]), file=fd)
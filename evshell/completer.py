@@ -4,6 +4,7 @@ import readline
 import os, re, sys
 from time import time
 import pwd
+from .globber import DirCache
 
 home = pwd.getpwuid(os.getuid()).pw_dir
 
@@ -25,6 +26,7 @@ class ExecDir:
            self.st.st_dev == st.st_dev:
              return
         self.st = st
+        self.files = []
         for f in os.listdir(self.dirname):
             # While the next two lines are more correct, they are horrendously slow
             #fn = os.path.join(self.dirname,f)
@@ -32,7 +34,10 @@ class ExecDir:
             self.files.append(f)
 
 class Completer:
-    def __init__(self) -> None:
+    def __init__(self, dir_cache:Optional[DirCache]=None) -> None:
+        # Shared with the shell, so that a directory listed to
+        # complete a word is not listed again to expand a glob
+        self.dir_cache = dir_cache
         self.matches : List[str] = []
         self.cwd : Optional[str] = None
         self.path : Optional[str] = None
@@ -40,6 +45,11 @@ class Completer:
         self.paths : Dict[str,ExecDir] = {}
         self.update_cmds()
 
+    def listdir(self, dirname:str)->List[str]:
+        if self.dir_cache is None:
+            return os.listdir(dirname)
+        return [e.name for e in self.dir_cache.scandir(dirname)]
+
     def update_cmds(self)->None:
         cwd = os.getcwd()
         path = os.environ.get("PATH","")
@@ -89,17 +99,17 @@ class Completer:
         matches = None
         try:
             if dirname == ".":
-                matches = os.listdir(".")
+                matches = self.listdir(".")
             elif dirname.startswith("~/"):
                 # This is a temporary hack.
                 fix_dirname = os.path.join(home, dirname[2:])
                 #print("fix_dirname:",fix_dirname,file=fd)
                 #fd.flush()
-                matches = [os.path.join(dirname,m) for m in os.listdir(fix_dirname)]
+                matches = [os.path.join(dirname,m) for m in self.listdir(fix_dirname)]
             else:
                 #print("dirname:",dirname,file=fd)
                 #fd.flush()
-                matches = [os.path.join(dirname,m) for m in os.listdir(dirname)]
+                matches = [os.path.join(dirname,m) for m in self.listdir(dirname)]
         except Exception as e:
             #print(e,file=fd)
             #fd.flush()
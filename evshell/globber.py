@@ -0,0 +1,220 @@
+from typing import Dict, List, Optional, Pattern, Tuple, Union
+import os
+import re
+
+# A compiled path segment: a literal name, a regular
+# expression for one name, or "**" for any number of
+# directories.
+Segment = Union[str, Pattern[str], None]
+globstar = None
+
+class DirCache:
+    """
+    Directory listings kept for a short while, e.g. for one command
+    line, so that globs over the same directory read it only once.
+    A listing is keyed by the directory's device and inode and is
+    reused only while its modification time is unchanged, so files
+    created in between are seen. Each use costs a stat() instead
+    of reading the whole directory.
+    """
+    def __init__(self, max_dirs:int=1024)->None:
+        self.max_dirs = max_dirs
+        self.dirs : Dict[Tuple[int,int],Tuple[int,List[os.DirEntry]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def scandir(self, path:str)->List[os.DirEntry]:
+        """
+        The entries of the directory path. The caller
+        must not modify the list.
+        """
+        st = os.stat(path)
+        key = (st.st_dev, st.st_ino)
+        found = self.dirs.get(key, None)
+        if found is not None and found[0] == st.st_mtime_ns:
+            self.hits += 1
+            return found[1]
+        self.misses += 1
+        with os.scandir(path) as it:
+            entries = list(it)
+        if len(self.dirs) >= self.max_dirs:
+            self.dirs.clear()
+        self.dirs[key] = (st.st_mtime_ns, entries)
+        return entries
+
+    def clear(self)->None:
+        self.dirs.clear()
+
+    def stats(self)->Dict[str,int]:
+        return {"hits":self.hits, "misses":self.misses, "dirs":len(self.dirs)}
+
+def scandir(path:str, cache:Optional[DirCache], cwd:Optional[str]=None)->List[os.DirEntry]:
+    if path == "":
+        path = "."
+    if cwd is not None:
+        path = os.path.join(cwd, path)
+    if cache is not None:
+        return cache.scandir(path)
+    with os.scandir(path) as it:
+        return list(it)
+
+class GlobPattern:
+    """
+    A glob compiled into one matcher per path segment. Directories
+    are only read for segments that contain wildcards, and only
+    entries matching the segment are descended into.
+    """
+    def __init__(self, segments:List[Tuple[Segment,bool]], absolute:bool, trailing_slash:bool)->None:
+        # Each segment comes with whether it may match names
+        # starting with a dot
+        self.segments = segments
+        self.absolute = absolute
+        self.trailing_slash = trailing_slash
+
+    def matches(self, cache:Optional[DirCache]=None, cwd:Optional[str]=None)->List[str]:
+        """
+        The sorted list of paths that match, reading
+        directories through cache if it is given.
+        Relative paths are taken from cwd if it is
+        given, and the current directory if not.
+        """
+        paths = ["/" if self.absolute else ""]
+        last = len(self.segments)-1
+        for n, (seg, dots) in enumerate(self.segments):
+            need_dir = n < last or self.trailing_slash
+            new_paths : List[str] = []
+            for path in paths:
+                if type(seg) == str:
+                    new_paths += [join(path, seg)]
+                elif seg is globstar:
+                    new_paths += walk(path, n == last and not self.trailing_slash, cache, cwd)
+                else:
+                    new_paths += scan(path, seg, dots, need_dir, cache, cwd)
+            paths = new_paths
+            if len(paths) == 0:
+                return []
+        if type(self.segments[-1][0]) == str or self.trailing_slash:
+            # Names that were not read from a directory may not exist
+            paths = [p for p in paths if os.path.lexists(in_dir(cwd, p))]
+        if self.trailing_slash:
+            paths = [p if p.endswith("/") else p+"/" for p in paths if os.path.isdir(in_dir(cwd, p))]
+        # "**" can reach a path more than one way
+        return sorted(set(paths))
+
+def in_dir(cwd:Optional[str], path:str)->str:
+    return path if cwd is None else os.path.join(cwd, path)
+
+def join(path:str, name:str)->str:
+    if path == "" or path.endswith("/"):
+        return path+name
+    return path+"/"+name
+
+def scan(path:str, seg:Pattern[str], dots:bool, need_dir:bool, cache:Optional[DirCache], cwd:Optional[str])->List[str]:
+    result = []
+    try:
+        for entry in scandir(path, cache, cwd):
+            name = entry.name
+            if name[0] == "." and not dots:
+                continue
+            if seg.fullmatch(name) is None:
+                continue
+            if need_dir and not entry.is_dir():
+                continue
+            result += [join(path, name)]
+    except OSError:
+        pass
+    return result
+
+def walk(path:str, files:bool, cache:Optional[DirCache], cwd:Optional[str])->List[str]:
+    """
+    The matches of a "**" segment: path itself and every directory
+    below it, and also every file if nothing follows. Names that
+    start with a dot are skipped, and symlinked directories are
+    not descended into.
+    """
+    result = [path]
+    stack = [path]
+    while len(stack) > 0:
+        top = stack.pop()
+        try:
+            for entry in scandir(top, cache, cwd):
+                if entry.name[0] == ".":
+                    continue
+                sub = join(top, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    result += [sub]
+                    stack += [sub]
+                elif files:
+                    result += [sub]
+        except OSError:
+            pass
+    if files:
+        # A final "**" matches what is below path, and path itself
+        # only as a directory, as in bash with globstar set
+        result = result[1:] if path == "" else [join(path, "")] + result[1:]
+    return result
+
+def compile_segment(items:List[str])->Tuple[Segment,bool]:
+    """
+    Compile one path segment. items holds single literal characters
+    marked with a leading "l", and the wildcards "*", "?" and "[a-z]"
+    marked with a leading "g".
+    """
+    if not any([i.startswith("g") for i in items]):
+        return "".join([i[1:] for i in items]), True
+    if items == ["g*", "g*"]:
+        return globstar, False
+    regex = ""
+    for item in items:
+        if item == "g*":
+            regex += ".*"
+        elif item == "g?":
+            regex += "."
+        elif item.startswith("g["):
+            regex += "[" + re.escape(item[2]) + "-" + re.escape(item[4]) + "]"
+        else:
+            regex += re.escape(item[1:])
+    # Wildcards do not match a leading dot, as in bash
+    dots = items[0].startswith("l.")
+    return re.compile(regex, re.DOTALL), dots
+
+def compile_glob(items:List[str])->Optional[GlobPattern]:
+    """
+    Compile a glob given as a list of items, as for compile_segment().
+    Returns None if the pattern has no wildcards.
+    """
+    if not any([i.startswith("g") for i in items]):
+        return None
+    absolute = len(items) > 0 and items[0] == "l/"
+    parts : List[List[str]] = [[]]
+    for item in items:
+        if item == "l/":
+            parts += [[]]
+        else:
+            parts[-1] += [item]
+    trailing_slash = len(parts) > 1 and len(parts[-1]) == 0
+    # Repeated slashes do not make empty segments
+    segments = [compile_segment(p) for p in parts if len(p) > 0]
+    return GlobPattern(segments, absolute, trailing_slash)
+
+# Compiled patterns, so that a glob in a loop is compiled once
+glob_cache : Dict[Tuple[str,...],Optional[GlobPattern]] = {}
+glob_cache_size = 256
+
+def glob(items:List[str], cache:Optional[DirCache]=None, cwd:Optional[str]=None)->List[str]:
+    """
+    The sorted paths matching a glob given as for compile_glob(),
+    or an empty list if there are none.
+    """
+    key = tuple(items)
+    # The cache is shared by shells in all threads, so it is read
+    # and written with single dict operations
+    pat = glob_cache.get(key, None)
+    if pat is None:
+        pat = compile_glob(items)
+        if len(glob_cache) >= glob_cache_size:
+            glob_cache.clear()
+        glob_cache[key] = pat
+    if pat is None:
+        return []
+    return pat.matches(cache, cwd)
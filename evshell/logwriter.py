@@ -0,0 +1,128 @@
+from typing import IO, Any, Callable, List, Optional
+from threading import Thread, Lock
+from time import time, sleep
+from weakref import WeakSet
+from .auditlog import JsonFormat
+import atexit
+import os
+
+class LogWriter:
+    """
+    Collects log records in memory and writes them out in batches:
+    when max_bytes have built up, when max_delay seconds have passed
+    since the last write, at exit, and whenever a record is written
+    with sync=True. After start_background(), a thread shared by all
+    writers does the time-based writes, so that records are not held
+    back while the shell is idle. Records are encoded beforehand, and written by
+    fmt, one of the formats in auditlog. close() writes what is
+    left and closes fd.
+    """
+    def __init__(self, fd:IO[Any], fmt:Any=None, max_bytes:int=65536, max_delay:float=1.0)->None:
+        self.fd = fd
+        self.fmt = JsonFormat() if fmt is None else fmt
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.buf : List[Any] = []
+        self.size = 0
+        self.last = time()
+        self.lock = Lock()
+        self.background = False
+        self.closed = False
+        # Called before an explicit flush and at exit, so that
+        # the owner can write out records it has held back.
+        self.pending : Optional[Callable[[],None]] = None
+        open_writers.add(self)
+
+    def write(self, record:Any, sync:bool=False)->None:
+        with self.lock:
+            self.buf.append(record)
+            self.size += len(record)
+            if sync or self.size >= self.max_bytes:
+                self._flush()
+            elif not self.background and time() - self.last >= self.max_delay:
+                self._flush()
+
+    def _flush(self)->None:
+        if self.closed:
+            return
+        if len(self.buf) > 0:
+            self.fmt.write_block(self.fd, self.buf)
+            self.buf = []
+            self.size = 0
+        self.fd.flush()
+        self.last = time()
+
+    def flush(self)->None:
+        if self.pending is not None:
+            self.pending()
+        with self.lock:
+            self._flush()
+
+    def start_background(self)->None:
+        with self.lock:
+            self.background = True
+        background_writers.add(self)
+        start_flusher()
+
+    def flush_due(self)->None:
+        """
+        Write out what has waited max_delay seconds or more.
+        """
+        with self.lock:
+            if len(self.buf) > 0 and time() - self.last >= self.max_delay:
+                self._flush()
+
+    def after_fork(self)->None:
+        """
+        Call in a forked child. The lock may have been held by
+        the flusher thread, which does not exist in the child, so
+        the writer goes back to flushing as records are written.
+        """
+        self.lock = Lock()
+        self.background = False
+        background_writers.discard(self)
+
+    def close(self)->None:
+        if self.closed:
+            return
+        if self.pending is not None:
+            self.pending()
+        with self.lock:
+            self._flush()
+            self.closed = True
+        self.fd.close()
+        self.fmt.close()
+        open_writers.discard(self)
+        background_writers.discard(self)
+
+# The writers that have not been closed. It holds them weakly, so
+# a writer nobody uses any more is not kept alive until exit.
+open_writers : 'WeakSet[LogWriter]' = WeakSet()
+
+# The writers the flusher thread looks after
+background_writers : 'WeakSet[LogWriter]' = WeakSet()
+# How often, in seconds, the flusher thread looks
+flush_interval = 0.25
+# The process the flusher thread was started in. A forked
+# child has no flusher until it starts one of its own.
+flusher_pid : Optional[int] = None
+flusher_lock = Lock()
+
+def start_flusher()->None:
+    global flusher_pid
+    with flusher_lock:
+        if flusher_pid != os.getpid():
+            flusher_pid = os.getpid()
+            Thread(target=run_flusher, daemon=True).start()
+
+def run_flusher()->None:
+    while True:
+        sleep(flush_interval)
+        for w in list(background_writers):
+            w.flush_due()
+
+def close_writers()->None:
+    for w in list(open_writers):
+        w.close()
+
+atexit.register(close_writers)
@@ -109,21 +109,18 @@ def allow_cmd(args):
     else:
         raise ShellAccess(f"Command '{args}' is not allowed.")
 
-if __name__ == "__main__":
-
-    # Get the full shell path
-    shell_path = os.path.realpath(sys.argv[0])
-
+def setup_shell(s):
+    """
+    Apply the restrictions above to the shell s. This is also
+    used by the evshell server (python -m evshell.server --policy
+    myshell.py).
+    """
     # Ensure the workpath exists
     os.makedirs(workpath,exist_ok=True)
 
     # Start in the workpath
     os.chdir(workpath)
 
-    # Create the shell
-    s = shell()
-    s.args[0] = shell_path
-
     # Limit chdir
     s.allow_cd = allow_access
 
@@ -142,4 +139,15 @@ if __name__ == "__main__":
     # Limit commands that may be run
     s.allow_cmd = allow_cmd
 
+if __name__ == "__main__":
+
+    # Get the full shell path
+    shell_path = os.path.realpath(sys.argv[0])
+
+    # Create the shell
+    s = shell()
+    s.args[0] = shell_path
+
+    setup_shell(s)
+
     run_shell(s)
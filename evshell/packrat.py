@@ -0,0 +1,133 @@
+from typing import Dict, List, Tuple, Optional, Any, Set
+from piraha import Grammar, Matcher, Group, Pattern, Lookup, Or, Multi, Fail, BreakOut
+
+# A memo entry records the outcome of matching a named
+# rule at a given position: whether it matched, where it
+# ended, the child groups it appended to the parent, and
+# the furthest position examined while trying.
+MemoEntry = Tuple[bool, int, List[Group], int]
+
+class PackratLookup(Lookup):
+    """
+    A Lookup that consults the memo table of a PackratMatcher
+    before trying its rule, and records the result afterwards.
+    On an ordinary Matcher it behaves exactly like Lookup.
+    """
+    def match(self,m:Matcher)->bool:
+        memo : Optional[Dict[Tuple[str,bool,int],MemoEntry]] = getattr(m, "memo", None)
+        if memo is None:
+            return Lookup.match(self, m)
+        start = m.textPos
+        key = (self.name, self.capture, start)
+        entry = memo.get(key, None)
+        if entry is not None:
+            b, end, children, reach = entry
+            m.hits += 1
+            if reach > m.maxTextPos:
+                m.maxTextPos = reach
+                m.max_stack = [k for k in m.stack]
+                m.hash = {}
+            if b:
+                m.textPos = end
+                m.gr.children += children
+            return b
+        m.misses += 1
+        nchildren = len(m.gr.children)
+        b = Lookup.match(self, m)
+        if len(memo) < m.max_memo:
+            memo[key] = (b, m.textPos, m.gr.children[nchildren:], m.maxTextPos)
+        return b
+
+# Or and Multi undo a failed attempt by copying the children
+# of the current group up to where they were. At the top of a
+# script, where a group has a child per command, that makes the
+# parse quadratic in the length of the script. These versions
+# truncate the list in place instead.
+
+class PackratOr(Or):
+    def match(self,m:Matcher)->bool:
+        save = m.textPos
+        nchildren = len(m.gr.children)
+        for pat in self.patterns:
+            m.textPos = save
+            del m.gr.children[nchildren:]
+            if pat.match(m):
+                return True
+        return False
+
+class PackratMulti(Multi):
+    def match(self,m:Matcher)->bool:
+        for i in range(0,self.mx+1):
+            save = m.textPos
+            nchildren = len(m.gr.children)
+            try:
+                if not self.pattern.match(m) or m.textPos <= save:
+                    raise Fail()
+            except Fail:
+                m.textPos = save
+                del m.gr.children[nchildren:]
+                return i >= self.mn
+            except BreakOut:
+                return i >= self.mn
+        return True
+
+packrat_classes : Dict[type,type] = {Lookup:PackratLookup, Or:PackratOr, Multi:PackratMulti}
+
+def _packratize(pat:Any, seen:Set[int])->None:
+    """
+    Walk the pattern graph and convert every Lookup, Or
+    and Multi into its packrat version.
+    """
+    if id(pat) in seen:
+        return
+    seen.add(id(pat))
+    if type(pat) in packrat_classes:
+        pat.__class__ = packrat_classes[type(pat)]
+    for sub in getattr(pat, "patternList", []):
+        _packratize(sub, seen)
+    for sub in getattr(pat, "patterns", []):
+        _packratize(sub, seen)
+    for attr in ["pattern", "pat"]:
+        sub = getattr(pat, attr, None)
+        if isinstance(sub, Pattern):
+            _packratize(sub, seen)
+
+def packratize(g:Grammar)->Grammar:
+    """
+    Prepare a grammar for use with PackratMatcher. This is done
+    in place, so the grammar should be a copy that ordinary
+    Matchers do not use: on those it would still work, but
+    the memo lookups would slow them down.
+    """
+    seen : Set[int] = set()
+    for name in g.patterns:
+        _packratize(g.patterns[name], seen)
+    return g
+
+class PackratMatcher(Matcher):
+    """
+    A Matcher that memoizes (rule, position) results so that
+    backtracking never re-parses the same rule at the same place.
+    The memo table holds at most max_memo entries; once it is full,
+    matching continues without recording new results.
+    """
+    def __init__(self,grammar:Grammar,pname:str,text:str,max_memo:int=1000000)->None:
+        Matcher.__init__(self,grammar,pname,text)
+        self.memo : Dict[Tuple[str,bool,int],MemoEntry] = {}
+        self.max_memo = max_memo
+        self.hits = 0
+        self.misses = 0
+
+if __name__ == "__main__":
+    from piraha import parse_peg_src
+    g, rule = parse_peg_src(r"""
+skipper=[ \t]*
+val=[0-9]+
+term=({val}|\( {add} \))
+add={term}( [+-] {term})*
+expr=^ {add} $
+""")
+    packratize(g)
+    m = PackratMatcher(g, "expr", "(1+(2-3))+4")
+    print(m.matches(), m.hits, m.misses)
+    print(m.gr.dump())
@@ -1,98 +1,251 @@
-from typing import Optional, Dict, Any, Tuple
-from threading import Thread, RLock
+from typing import Optional, Dict, Any, Tuple, List, Mapping, Union
+from threading import Thread, RLock, Lock, Condition, Event
 from subprocess import Popen, PIPE, STDOUT
 from traceback import print_exc
+import selectors
+import signal
 import os
 from .here import here
-from time import sleep
 
-lastpid : Optional[int] = None
+class JobTable:
+    """
+    Background jobs and the pid of the last one started ($!).
+    Each shell has its own, so that shells running in different
+    threads do not wait for each other's jobs.
+    """
+    def __init__(self)->None:
+        self.lock = RLock()
+        # Notified whenever a background job finishes
+        self.cond = Condition(self.lock)
+        self.running : Dict[int,'PipeThread'] = {}
+        self.lastpid : Optional[int] = None
 
-def get_lastpid()->Optional[int]:
-    return lastpid
-
-runningLock = RLock()
-running : Dict[int,'PipeThread'] = {}
-
-def get_running(pid:int, verbose:bool=False)->Optional['PipeThread']:
-    with runningLock:
-        if pid is None:
-            for k in running:
-                pid = k
-                if verbose:
-                    print("pid:",pid)
-                break
+    def add(self, p:'PipeThread')->None:
+        with self.lock:
+            self.running[p.pid] = p
+            self.lastpid = p.pid
+
+    def get(self, pid:Optional[int], verbose:bool=False)->Optional['PipeThread']:
+        with self.lock:
             if pid is None:
-                return
-        return running.get(pid,None)
+                for k in self.running:
+                    pid = k
+                    if verbose:
+                        print("pid:",pid)
+                    break
+                if pid is None:
+                    return None
+            return self.running.get(pid,None)
 
-def pwait(pid:Optional[int])->Optional['PipeThread']:
-    if pid is not None:
-        with runningLock:
-            p = running.get(pid,None)
-            if p is None:
-                return None
+    def wait(self, pid:Optional[int])->Optional['PipeThread']:
+        """
+        Wait for the background job pid to finish, or for
+        any background job if pid is None.
+        """
+        if pid is not None:
+            with self.lock:
+                p = self.running.get(pid,None)
+                if p is None:
+                    return None
             p.communicate()
-            del running[pid]
+            with self.lock:
+                self.running.pop(pid,None)
             return p
-    else:
-        while True:
-            with runningLock:
-                for k in running:
-                    p = running[k]
-                    if not p.is_running():
-                        del running[k]
-                        return p
-            sleep(.1)
-    return None
-
-class PipeRunner(Thread):
+        else:
+            with self.cond:
+                while len(self.running) > 0:
+                    for k in self.running:
+                        p = self.running[k]
+                        if p.returncode is not None:
+                            del self.running[k]
+                            return p
+                    self.cond.wait()
+        return None
+
+    def notify(self)->None:
+        with self.cond:
+            self.cond.notify_all()
+
+# For code that does not say which shell's jobs it means
+default_jobs = JobTable()
+
+def get_lastpid()->Optional[int]:
+    return default_jobs.lastpid
+
+def get_running(pid:Optional[int], verbose:bool=False)->Optional['PipeThread']:
+    return default_jobs.get(pid, verbose)
+
+def pwait(pid:Optional[int])->Optional['PipeThread']:
+    return default_jobs.wait(pid)
+
+class Reaper(Thread):
+    """
+    Waits for background jobs to exit. Each job is watched
+    through a pidfd, so the thread sleeps in select() until
+    a child actually exits. On systems without pidfds, each
+    job gets its own thread that blocks waiting for it.
+    """
     def __init__(self)->None:
-        Thread.__init__(self)
-        self.setDaemon(True)
+        Thread.__init__(self, daemon=True)
+        self.sel = selectors.DefaultSelector()
+        self.wake = os.pipe()
+        self.sel.register(self.wake[0], selectors.EVENT_READ, None)
+        self.lock = Lock()
+        self.pending : List[Tuple[int,'PipeThread']] = []
+
+    def add(self, p:'PipeThread')->None:
+        try:
+            fd = os.pidfd_open(p.pid) # type: ignore[attr-defined]
+        except (AttributeError, OSError):
+            Thread(target=p.finish, daemon=True).start()
+            return
+        with self.lock:
+            self.pending += [(fd,p)]
+        os.write(self.wake[1], b"x")
 
     def run(self)->None:
-        count = 0
         while True:
-            with runningLock:
-                vals = running.values()
-            for p in vals:
-                if p.returncode is None and not p.is_running():
-                    p.run()
-                    count = 0
+            for key, _ in self.sel.select():
+                if key.data is None:
+                    os.read(self.wake[0], 4096)
+                    with self.lock:
+                        pending, self.pending = self.pending, []
+                    for fd, p in pending:
+                        self.sel.register(fd, selectors.EVENT_READ, p)
                 else:
-                    count += 1
-            if   count > 10000:
-                sleep(1)
-            elif count > 1000:
-                sleep(.1)
-            elif count > 100:
-                sleep(.01)
+                    self.sel.unregister(key.fd)
+                    os.close(key.fd)
+                    try:
+                        key.data.finish()
+                    except Exception:
+                        print_exc()
 
-_pipe_runner = PipeRunner()
-_pipe_runner.start()
+_reaper : Optional[Reaper] = None
+_reaper_pid : Optional[int] = None
+_reaper_lock = Lock()
+
+def get_reaper()->Reaper:
+    """
+    The reaper is started the first time a job is put in the
+    background, and again in a forked child that needs one.
+    """
+    global _reaper, _reaper_pid
+    with _reaper_lock:
+        if _reaper is None or _reaper_pid != os.getpid():
+            _reaper = Reaper()
+            _reaper_pid = os.getpid()
+            _reaper.start()
+        return _reaper
+
+restore_signals = [getattr(signal, name) for name in ["SIGPIPE", "SIGXFSZ"] if hasattr(signal, name)]
+
+class Spawned:
+    """
+    The part of the Popen interface that PipeThread uses, for a
+    process started with os.posix_spawn. The standard streams are
+    None, file descriptors, or objects with a fileno() method, and
+    are put in place by the spawn's file actions.
+    """
+    def __init__(self, args:List[str], stdin:Any=None, stdout:Any=None, stderr:Any=None,
+            env:Optional[Mapping[str,str]]=None, **kwargs:Any)->None:
+        actions = []
+        for target, f in [(0,stdin), (1,stdout), (2,stderr)]:
+            fd = _spawn_fd(f)
+            if fd is None:
+                continue
+            elif fd != target:
+                actions += [(os.POSIX_SPAWN_DUP2, fd, target)]
+            elif not os.get_inheritable(fd):
+                # e.g. made by os.dup(), which Popen would have fixed
+                os.set_inheritable(fd, True)
+        if env is None:
+            env = os.environ
+        # Python ignores SIGPIPE and SIGXFSZ; the child gets them back,
+        # as with Popen's restore_signals
+        if "/" in args[0]:
+            self.pid = os.posix_spawn(args[0], args, env, file_actions=actions, setsigdef=restore_signals)
+        else:
+            self.pid = os.posix_spawnp(args[0], args, env, file_actions=actions, setsigdef=restore_signals)
+        self.returncode : Optional[int] = None
+
+    def _reap(self, flags:int)->Optional[int]:
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, flags)
+            if pid == self.pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def poll(self)->Optional[int]:
+        return self._reap(os.WNOHANG)
+
+    def wait(self)->int:
+        rc = self._reap(0)
+        assert rc is not None
+        return rc
+
+    def communicate(self)->Tuple[None,None]:
+        self.wait()
+        return None, None
+
+def _spawn_fd(f:Any)->Optional[int]:
+    if f is None:
+        return None
+    elif type(f) == int:
+        return f
+    else:
+        return f.fileno()
+
+def can_spawn(kwargs:Dict[str,Any])->bool:
+    """
+    True if Spawned can start a process with these Popen arguments.
+    Anything it does not handle, e.g. stdout=PIPE or a stream that
+    is already one of the other standard descriptors, is left to Popen.
+    """
+    if not hasattr(os, "posix_spawn"):
+        return False
+    for key in kwargs:
+        if key not in ["stdin", "stdout", "stderr", "env", "universal_newlines"]:
+            return False
+    for target, key in enumerate(["stdin", "stdout", "stderr"]):
+        f = kwargs.get(key, None)
+        if f is None:
+            continue
+        if type(f) == int:
+            fd = f
+        elif hasattr(f, "fileno"):
+            fd = f.fileno()
+        else:
+            return False
+        if fd < 0 or (fd < 3 and fd != target):
+            return False
+    return True
 
 class PipeThread: #(Thread):
-    def __init__(self, *args:Any, **kwargs:Any)->None:
+    def __init__(self, *args:Any, launcher:str="popen", **kwargs:Any)->None:
         #Thread.__init__(self)
         self.args = args
         self.kwargs = kwargs
         self.result : Optional[Tuple[str,str]] = None
         self.returncode : Optional[int] = None
-        self.p = Popen(*self.args,**self.kwargs)
+        self.p : Union[Popen,Spawned]
+        if launcher == "spawn" and can_spawn(kwargs):
+            self.p = Spawned(*self.args, **self.kwargs)
+        else:
+            self.p = Popen(*self.args,**self.kwargs)
         self.pid : int = self.p.pid
         self.run_in_background = False
+        self.jobs = default_jobs
+        self.done = Event()
 
-    def background(self)->None:
+    def background(self, jobs:Optional[JobTable]=None)->None:
         """
         Call this method before start if the
         intent is to run in the background.
         """
-        global lastpid
-        lastpid = self.p.pid
+        self.jobs = default_jobs if jobs is None else jobs
         self.run_in_background = True
-        with runningLock:
-            running[self.pid] = self
+        self.jobs.add(self)
+        get_reaper().add(self)
 
     def start(self)->None:
         pass
@@ -106,6 +259,16 @@ class PipeThread: #(Thread):
             if fd > 2:
                 os.close(self.kwargs["stdout"])
 
+    def finish(self)->None:
+        """
+        Called by the reaper once a background job has exited.
+        """
+        try:
+            self.run()
+        finally:
+            self.done.set()
+            self.jobs.notify()
+
     def is_running(self)->bool:
         return self.p.poll() is None
 
@@ -114,8 +277,7 @@ class PipeThread: #(Thread):
 
     def communicate(self)->Optional[Tuple[str,str]]:
         if self.run_in_background:
-            while self.returncode is None:
-                sleep(.01)
+            self.done.wait()
         else:
             self.run()
         return self.result
@@ -0,0 +1,273 @@
+from typing import Optional, List, Iterator, Tuple, Deque, Any
+from threading import Thread, Condition
+from collections import deque
+import codecs
+import os
+
+chunk_size = 65536
+# How much text a writer on its own thread may queue before it
+# waits for the reader, as it would on a full os.pipe()
+max_queued = 65536
+
+class Pipe:
+    """
+    Connects two stages of a pipeline. Text written by a stage
+    running in this process is handed to the next stage as a queue
+    of strings, so two Python stages never go through the kernel.
+    A real os.pipe() is made only when a stage needs a file
+    descriptor, i.e. when it is an external command. A stage
+    writing from its own thread blocks while max_queued characters
+    are waiting; one in the shell's thread does not, since the
+    next stage may only be started after it is done.
+    """
+    def __init__(self)->None:
+        self.cond = Condition()
+        self.chunks : Deque[Optional[str]] = deque()
+        self.queued = 0
+        self.reader_closed = False
+        # The pipe made for an external writer
+        self.fds : Optional[Tuple[int,int]] = None
+        # Set when a thread, rather than the shell, owns an end
+        self.threaded_writer = False
+        self.threaded_reader = False
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.writer = PipeWriter(self)
+        self.reader = PipeReader(self)
+
+    def put(self, chunk:Optional[str])->bool:
+        """
+        Queue a chunk, or None for end of file. Returns False if
+        the writer switched to a real pipe while this waited.
+        """
+        with self.cond:
+            if chunk is not None and self.threaded_writer:
+                while self.queued >= max_queued and not self.reader_closed and self.fds is None:
+                    self.cond.wait()
+            if self.reader_closed:
+                if chunk is None:
+                    return True
+                raise BrokenPipeError()
+            if self.fds is not None:
+                return False
+            self.chunks.append(chunk)
+            if chunk is not None:
+                self.queued += len(chunk)
+            self.cond.notify_all()
+            return True
+
+    def get(self)->Optional[str]:
+        """
+        Return the next chunk, or None at end of file. Once the
+        writer has switched to a real pipe, read from that.
+        """
+        with self.cond:
+            while len(self.chunks) == 0 and self.fds is None:
+                self.cond.wait()
+            if len(self.chunks) > 0:
+                chunk = self.chunks.popleft()
+                if chunk is None:
+                    # Leave the end marker for later readers
+                    self.chunks.appendleft(None)
+                else:
+                    self.queued -= len(chunk)
+                    # Wake a writer waiting for room once half
+                    # the queue is free, not at every chunk
+                    if self.queued <= max_queued//2 < self.queued+len(chunk):
+                        self.cond.notify_all()
+                return chunk
+            assert self.fds is not None
+            rfd = self.fds[0]
+        data = os.read(rfd, chunk_size)
+        if len(data) == 0:
+            rest = self.decoder.decode(b"", final=True)
+            return rest if rest != "" else None
+        return self.decoder.decode(data)
+
+    def close_reader(self)->None:
+        with self.cond:
+            if self.reader_closed:
+                return
+            self.reader_closed = True
+            self.chunks.clear()
+            self.queued = 0
+            if self.fds is not None:
+                os.close(self.fds[0])
+            self.cond.notify_all()
+
+class PipeWriter:
+    """
+    The writing end of a Pipe. It can be used like a text
+    file, or passed to Popen as stdout.
+    """
+    def __init__(self, pipe:Pipe)->None:
+        self.pipe = pipe
+        self.closed = False
+
+    def write(self, msg:str)->int:
+        assert not self.closed
+        if self.pipe.fds is None and (len(msg) == 0 or self.pipe.put(msg)):
+            return len(msg)
+        fds = self.pipe.fds
+        assert fds is not None
+        data = msg.encode()
+        while len(data) > 0:
+            n = os.write(fds[1], data)
+            data = data[n:]
+        return len(msg)
+
+    def flush(self)->None:
+        pass
+
+    def isatty(self)->bool:
+        return False
+
+    def fileno(self)->int:
+        """
+        Switch to a real pipe for an external command,
+        first moving anything already written into it.
+        """
+        assert not self.closed
+        with self.pipe.cond:
+            if self.pipe.fds is None:
+                self.pipe.fds = os.pipe()
+                if self.pipe.reader_closed:
+                    os.close(self.pipe.fds[0])
+                pending = [c for c in self.pipe.chunks if c is not None]
+                self.pipe.chunks.clear()
+                self.pipe.queued = 0
+                # A reader waiting for chunks now reads the pipe
+                self.pipe.cond.notify_all()
+            else:
+                pending = []
+        for chunk in pending:
+            self.write(chunk)
+        return self.pipe.fds[1]
+
+    def close(self)->None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.pipe.fds is None and self.pipe.put(None):
+            return
+        assert self.pipe.fds is not None
+        os.close(self.pipe.fds[1])
+
+class PipeReader:
+    """
+    The reading end of a Pipe. It can be used like a text
+    file, iterated over by line, or passed to Popen as stdin.
+    """
+    def __init__(self, pipe:Pipe)->None:
+        self.pipe = pipe
+        self.buf = ""
+        self.eof = False
+        self.closed = False
+        self.rfd : Optional[int] = None
+
+    def _fill(self)->bool:
+        """
+        Add more text to buf. Returns False at end of file.
+        """
+        if self.eof:
+            return False
+        chunk = self.pipe.get()
+        if chunk is None:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def read(self, n:int=-1)->str:
+        while (n < 0 or len(self.buf) < n) and self._fill():
+            pass
+        if n < 0:
+            n = len(self.buf)
+        out, self.buf = self.buf[:n], self.buf[n:]
+        return out
+
+    def readline(self)->str:
+        while True:
+            i = self.buf.find("\n")
+            if i >= 0:
+                out, self.buf = self.buf[:i+1], self.buf[i+1:]
+                return out
+            if not self._fill():
+                out, self.buf = self.buf, ""
+                return out
+
+    def __iter__(self)->Iterator[str]:
+        while True:
+            line = self.readline()
+            if line == "":
+                return
+            yield line
+
+    def isatty(self)->bool:
+        return False
+
+    def fileno(self)->int:
+        """
+        Hand a file descriptor to an external command. If the
+        writer is in this process, a thread copies its output
+        into a new pipe.
+        """
+        if self.pipe.fds is not None:
+            return self.pipe.fds[0]
+        if self.rfd is None:
+            rfd, wfd = os.pipe()
+            self.rfd = rfd
+            Thread(target=self._pump, args=(wfd,), daemon=True).start()
+        return self.rfd
+
+    def _pump(self, wfd:int)->None:
+        try:
+            while True:
+                chunk = self.pipe.get()
+                if chunk is None:
+                    break
+                data = chunk.encode()
+                while len(data) > 0:
+                    n = os.write(wfd, data)
+                    data = data[n:]
+        except BrokenPipeError:
+            pass
+        finally:
+            os.close(wfd)
+            self.pipe.close_reader()
+
+    def close(self)->None:
+        if self.closed:
+            return
+        self.closed = True
+        if self.rfd is not None:
+            os.close(self.rfd)
+        else:
+            self.pipe.close_reader()
+
+def run_filter(sh:Any, func:Any, args:List[str], sin:Any, sout:Any, in_pipe:Optional[Pipe], out_pipe:Optional[Pipe])->Optional[int]:
+    """
+    Run a pyfunc written as a generator over the lines of its
+    input, writing whatever it yields to sout, and return what
+    the generator returns. Pipe ends owned by the stage are
+    closed at the end, so that the next stage sees end of file
+    and the previous one stops writing.
+    """
+    rc = None
+    try:
+        gen = func(sh, args, iter(sin))
+        while True:
+            try:
+                out = next(gen)
+            except StopIteration as si:
+                rc = si.value
+                break
+            sout.write(out)
+        sout.flush()
+    except BrokenPipeError:
+        pass
+    finally:
+        if out_pipe is not None and out_pipe.threaded_writer:
+            out_pipe.writer.close()
+        if in_pipe is not None and in_pipe.threaded_reader:
+            in_pipe.reader.close()
+    return rc
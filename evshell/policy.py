@@ -0,0 +1,259 @@
+from typing import Any, Dict, FrozenSet, List, Optional, Pattern
+from collections import OrderedDict
+from threading import Lock
+from . import ShellAccess
+import json
+import os
+import re
+
+# An example policy, equivalent to the one in myshell.py:
+#
+# {
+#   "max_args": 20,
+#   "max_arg_size": 1024,
+#   "deny_vars": ["USER", "LOGNAME", "HOME", "PATH", "SHELL"],
+#   "commands": {
+#     "ls":   {"args": ["-l", "-s", "-ls", "-a", {"path": "read"}]},
+#     "cat":  {"args": ["-", {"path": "read"}]},
+#     "rm":   {"args": ["-r", {"path": "write"}]},
+#     "cal":  {"args": [{"regex": "[0-9]+"}]},
+#     "date": {"any": true},
+#     "pwd":  {}
+#   },
+#   "paths": {
+#     "read":  ["~"],
+#     "write": ["/tmp/$USER"],
+#     "cd":    ["/tmp/$USER"]
+#   }
+# }
+#
+# Each entry in "args" allows an argument: a string allows exactly
+# that string, "regex" allows whatever the expression matches in
+# full, and "path" passes an argument that does not start with "-"
+# to the shell's allow_read or allow_write hook (which may rewrite
+# it, or raise ShellAccess).
+# "max_args" and "max_arg_size" may also be given per command.
+# "paths" sets up a PathPolicy, and takes the same lists as it does.
+
+class PathTree:
+    """
+    A prefix tree over the components of absolute paths. Each node
+    may carry a mark, and lookup() returns the mark of the deepest
+    marked node on the way to a path, so the most specific root
+    decides. The cost depends on the depth of the path, not on the
+    number of roots.
+    """
+    def __init__(self)->None:
+        self.root : Dict[Optional[str],Any] = {}
+
+    def add(self, path:str, mark:bool)->None:
+        node = self.root
+        for part in path.split("/"):
+            if part != "":
+                node = node.setdefault(part, {})
+        node[None] = mark
+
+    def lookup(self, path:str)->Optional[bool]:
+        node = self.root
+        mark = node.get(None, None)
+        for part in path.split("/"):
+            if part == "":
+                continue
+            node = node.get(part, None)
+            if node is None:
+                break
+            mark = node.get(None, mark)
+        return mark
+
+class PathPolicy:
+    """
+    Decides which files a shell may read and write, and where it
+    may cd, from lists of allowed and denied directories. Anything
+    writable is also readable. Paths are resolved with realpath
+    first, and the results are kept in a cache of at most
+    cache_size entries, so the decision is about the file a
+    symlink points to. The hooks return the resolved path.
+    """
+    def __init__(self, read:List[str]=[], write:List[str]=[], deny:List[str]=[],
+            cd:Optional[List[str]]=None, cache_size:int=4096)->None:
+        self.read_tree = PathTree()
+        self.write_tree = PathTree()
+        self.cd_tree = PathTree()
+        for root in read:
+            self.read_tree.add(self.root(root), True)
+        for root in write:
+            self.read_tree.add(self.root(root), True)
+            self.write_tree.add(self.root(root), True)
+        for root in (read+write if cd is None else cd):
+            self.cd_tree.add(self.root(root), True)
+        for root in deny:
+            for tree in [self.read_tree, self.write_tree, self.cd_tree]:
+                tree.add(self.root(root), False)
+        self.cache_size = cache_size
+        self.cache : OrderedDict[str,str] = OrderedDict()
+        # One policy may serve shells in several threads
+        self.lock = Lock()
+
+    def root(self, path:str)->str:
+        return os.path.realpath(os.path.expandvars(os.path.expanduser(path)))
+
+    def resolve(self, fname:str, cwd:Optional[str]=None)->str:
+        path = os.path.join(os.getcwd() if cwd is None else cwd, fname)
+        with self.lock:
+            real = self.cache.get(path, None)
+            if real is not None:
+                self.cache.move_to_end(path)
+                return real
+        real = os.path.realpath(path)
+        with self.lock:
+            self.cache[path] = real
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return real
+
+    def check(self, tree:PathTree, fname:str, what:str, cwd:Optional[str])->str:
+        real = self.resolve(fname, cwd)
+        if tree.lookup(real) is not True:
+            raise ShellAccess(f"{what} '{real}' not allowed.")
+        return real
+
+    def allow_read(self, fname:str, cwd:Optional[str]=None)->str:
+        return self.check(self.read_tree, fname, "Read of file", cwd)
+
+    def allow_write(self, fname:str, cwd:Optional[str]=None)->str:
+        return self.check(self.write_tree, fname, "Write of file", cwd)
+
+    def allow_append(self, fname:str, cwd:Optional[str]=None)->str:
+        return self.check(self.write_tree, fname, "Append of file", cwd)
+
+    def allow_cd(self, fname:str, cwd:Optional[str]=None)->str:
+        return self.check(self.cd_tree, fname, "Change to directory", cwd)
+
+    def install(self, sh:Any)->None:
+        # Relative names are taken from the shell's own directory
+        sh.allow_read = lambda fname: self.allow_read(fname, sh.cwd)
+        sh.allow_write = lambda fname: self.allow_write(fname, sh.cwd)
+        sh.allow_append = lambda fname: self.allow_append(fname, sh.cwd)
+        sh.allow_cd = lambda fname: self.allow_cd(fname, sh.cwd)
+
+class CommandRule:
+    """
+    The compiled rules for one command. Literal arguments are kept
+    in a set, so most arguments are checked with a hash lookup.
+    Each regular expression is compiled on its own, so that its
+    groups and backreferences keep their numbers.
+    """
+    def __init__(self, spec:Dict[str,Any], max_args:int, max_arg_size:int)->None:
+        self.any = spec.get("any", False)
+        self.max_args = spec.get("max_args", max_args)
+        self.max_arg_size = spec.get("max_arg_size", max_arg_size)
+        literals : List[str] = []
+        self.regexes : List[Pattern[str]] = []
+        self.paths : List[str] = []
+        for rule in spec.get("args", []):
+            if type(rule) == str:
+                literals += [rule]
+            elif "regex" in rule:
+                self.regexes += [re.compile(rule["regex"])]
+            elif rule.get("path", None) in ["read", "write"]:
+                self.paths += [rule["path"]]
+            else:
+                raise Exception(f"Bad argument rule: {rule}")
+        self.literals : FrozenSet[str] = frozenset(literals)
+
+    def allows(self, arg:str)->bool:
+        if arg in self.literals:
+            return True
+        for regex in self.regexes:
+            if regex.fullmatch(arg):
+                return True
+        return False
+
+class AccessPolicy:
+    """
+    A declarative policy for restricted shells, compiled once and
+    installed on any number of shells with install(). Commands
+    named with a "/" are that program. Other names are looked up
+    on the shell's PATH when the command is run, so the policy
+    follows changes to PATH and programs installed after it was
+    loaded.
+    """
+    def __init__(self, spec:Dict[str,Any])->None:
+        max_args = spec.get("max_args", 1<<30)
+        max_arg_size = spec.get("max_arg_size", 1<<30)
+        self.deny_vars : FrozenSet[str] = frozenset(spec.get("deny_vars", []))
+        self.commands : Dict[str,CommandRule] = {}
+        for name, cmd_spec in spec.get("commands", {}).items():
+            self.commands[name] = CommandRule(cmd_spec, max_args, max_arg_size)
+        self.paths : Optional[PathPolicy] = None
+        if "paths" in spec:
+            self.paths = PathPolicy(**spec["paths"])
+
+    @staticmethod
+    def load(fname:str)->'AccessPolicy':
+        with open(fname) as fd:
+            return AccessPolicy(json.load(fd))
+
+    def rule_for(self, sh:Any, cmd:str)->Optional[CommandRule]:
+        """
+        The rule for cmd, which is a program's path, or a name that
+        the shell will look up on PATH.
+        """
+        if "/" in cmd:
+            rule = self.commands.get(cmd, None)
+            if rule is not None:
+                return rule
+        name = os.path.basename(cmd)
+        rule = self.commands.get(name, None)
+        if rule is None:
+            return None
+        path = sh.cmd_hash.lookup(name, sh.get_var("PATH") or os.defpath, sh.cwd)
+        if path is None or ("/" in cmd and path != cmd):
+            # Not what the name stands for now
+            return None
+        return rule
+
+    def check_cmd(self, sh:Any, args:List[str])->List[str]:
+        rule = self.rule_for(sh, args[0])
+        if rule is None:
+            raise ShellAccess(f"Command '{args}' is not allowed.")
+        if len(args) > rule.max_args:
+            raise ShellAccess(f"Too many arguments to '{args[0]}'.")
+        if rule.any:
+            for a in args[1:]:
+                if len(a) > rule.max_arg_size:
+                    raise ShellAccess(f"Argument to '{args[0]}' is too long.")
+            return args
+        new_args = [args[0]]
+        for a in args[1:]:
+            if len(a) > rule.max_arg_size:
+                raise ShellAccess(f"Argument to '{args[0]}' is too long.")
+            if rule.allows(a):
+                new_args += [a]
+            elif a.startswith("-"):
+                # Never let an option through as a file name
+                raise ShellAccess(f"Command '{args}' is not allowed.")
+            elif "write" in rule.paths:
+                new_args += [sh.allow_write(a)]
+            elif "read" in rule.paths:
+                new_args += [sh.allow_read(a)]
+            else:
+                raise ShellAccess(f"Command '{args}' is not allowed.")
+        return new_args
+
+    def check_set_var(self, var:str, val:Optional[str])->Optional[str]:
+        if var in self.deny_vars:
+            raise ShellAccess(f"Setting of var '{var}' is not allowed.")
+        return val
+
+    def install(self, sh:Any)->None:
+        """
+        Make this policy decide which commands sh may run and
+        which variables it may set, and which files it may use if
+        the policy has "paths". Path arguments go through whatever
+        allow_read and allow_write hooks sh has.
+        """
+        if self.paths is not None:
+            self.paths.install(sh)
+        sh.allow_cmd = lambda args: self.check_cmd(sh, args)
+        sh.allow_set_var = self.check_set_var
@@ -0,0 +1,177 @@
+from typing import Any, Dict, List, Optional, Set, Tuple
+from . import shell, run_shell, ShellExit, my_shell
+from .client import default_socket
+from .policy import AccessPolicy
+import json
+import os
+import runpy
+import socket
+import struct
+import sys
+
+# The shell hooks a policy may supply
+hook_names = ["allow_cd", "allow_cmd", "allow_read", "allow_write",
+    "allow_append", "allow_set_var", "allow_access_var"]
+
+class Policy:
+    """
+    Restrictions loaded from a file when the server starts. A .json
+    file holds an AccessPolicy. Otherwise it is Python: if it defines
+    setup_shell(s), that is called on each new shell, and if not, any
+    functions named after the shell's allow_* hooks are installed.
+    """
+    def __init__(self, fname:str)->None:
+        self.fname = os.path.realpath(fname)
+        self.access : Optional[AccessPolicy] = None
+        self.ns : Dict[str,Any] = {}
+        if self.fname.endswith(".json"):
+            self.access = AccessPolicy.load(self.fname)
+            return
+        # The file may import modules next to it, as a script would
+        sys.path.insert(0, os.path.dirname(self.fname))
+        self.ns = runpy.run_path(self.fname, run_name="evshell_policy")
+
+    def apply(self, s:shell)->None:
+        if self.access is not None:
+            self.access.install(s)
+            return
+        setup = self.ns.get("setup_shell", None)
+        if setup is not None:
+            setup(s)
+            return
+        for name in hook_names:
+            if name in self.ns:
+                setattr(s, name, self.ns[name])
+
+def recv_request(conn:socket.socket)->Tuple[Dict[str,Any],List[int]]:
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 3) # type: ignore[attr-defined]
+    if len(data) < 4:
+        raise OSError("Short request")
+    size = struct.unpack("!I", data[:4])[0]
+    data = data[4:]
+    while len(data) < size:
+        more = conn.recv(size-len(data))
+        if len(more) == 0:
+            raise OSError("Short request")
+        data += more
+    return json.loads(data), fds
+
+def run_worker(req:Dict[str,Any], fds:List[int], policy:Optional[Policy])->int:
+    """
+    Runs in a worker. Take over the client's stdio,
+    environment and directory, then run the shell.
+    """
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(req["cwd"])
+    os.environ.clear()
+    os.environ.update(req["env"])
+    s = shell(args=[my_shell]+req["argv"], shell_name=my_shell)
+    s.bind_to_env()
+    if policy is not None:
+        policy.apply(s)
+    try:
+        run_shell(s)
+        return int(s.vars["?"])
+    except ShellExit as se:
+        return se.rc
+    except SystemExit as se:
+        if type(se.code) == int:
+            return se.code
+        return 0 if se.code is None else 1
+    finally:
+        # The worker leaves with os._exit(), so atexit does not run
+        s.log_writer.close()
+
+class Server:
+    """
+    Keeps evshell imported and a pool of forked workers ready.
+    Each worker accepts one client, runs its session and exits,
+    and the server forks a replacement. Only clients running as
+    the same user are served.
+    """
+    def __init__(self, path:str, policies:Dict[str,Policy], workers:int=4)->None:
+        self.path = path
+        self.policies = policies
+        self.workers = workers
+        self.children : Set[int] = set()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self.sock.bind(path)
+        finally:
+            os.umask(umask)
+        self.sock.listen(64)
+
+    def get_policy(self, name:Optional[str])->Optional[Policy]:
+        if name is None:
+            if len(self.policies) == 1:
+                return list(self.policies.values())[0]
+            elif len(self.policies) == 0:
+                return None
+        elif name in self.policies:
+            return self.policies[name]
+        raise KeyError(f"Unknown policy '{name}'")
+
+    def serve_forever(self)->None:
+        while True:
+            while len(self.children) < self.workers:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    self.worker()
+                self.children.add(pid)
+            pid, _ = os.wait()
+            self.children.discard(pid)
+
+    def worker(self)->None:
+        rc = 255
+        try:
+            conn, _ = self.sock.accept()
+            self.sock.close()
+            rc = self.serve(conn)
+        except Exception as e:
+            print(f"evshell server: {e}", file=sys.stderr)
+        finally:
+            os._exit(rc & 0xff)
+
+    def serve(self, conn:socket.socket)->int:
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+        _, uid, _ = struct.unpack("3i", creds)
+        if uid != os.getuid():
+            raise PermissionError(f"Refused client with uid {uid}")
+        req, fds = recv_request(conn)
+        rc = 255
+        try:
+            rc = run_worker(req, fds, self.get_policy(req.get("policy", None)))
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            conn.sendall(struct.pack("!i", rc))
+        return rc
+
+def main(argv:List[str])->None:
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m evshell.server", description="Serve evshell sessions to client.py.")
+    parser.add_argument("--socket", default=default_socket())
+    parser.add_argument("--workers", type=int, default=4, help="idle workers to keep ready")
+    parser.add_argument("--policy", action="append", default=[], metavar="NAME=FILE",
+        help="load a policy file that clients may ask for by name")
+    opts = parser.parse_args(argv)
+    policies : Dict[str,Policy] = {}
+    for spec in opts.policy:
+        name, _, fname = spec.partition("=")
+        if fname == "":
+            fname = name
+            name = os.path.splitext(os.path.basename(fname))[0]
+        policies[name] = Policy(fname)
+    server = Server(opts.socket, policies, opts.workers)
+    print(f"evshell server listening on {opts.socket}", file=sys.stderr)
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,167 @@
+from typing import Any, Dict, List, Optional, Tuple
+import piraha
+from piraha import Grammar, Pattern, parse_peg_src
+from .version import __version__
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+# A compiled grammar is stored as a flat table of pattern
+# objects. Only classes derived from piraha.Pattern may be
+# named in the table, so loading a snapshot never runs code.
+pattern_classes : Dict[str,type] = {}
+for _name in dir(piraha):
+    _cls = getattr(piraha, _name)
+    if isinstance(_cls, type) and issubclass(_cls, Pattern):
+        pattern_classes[_name] = _cls
+
+# Written into the package when it is built. Snapshots made at
+# run time go to the user's cache directory instead, since the
+# package directory may be read-only or shared by many users.
+snapshot_file = os.path.join(os.path.dirname(__file__), "grammar.json")
+
+def cache_dir()->str:
+    base = os.environ.get("XDG_CACHE_HOME", "") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "evshell")
+
+def grammar_stamp(src:str)->str:
+    """
+    Identifies the grammar source and the software that compiled it.
+    A snapshot with a different stamp is stale.
+    """
+    h = hashlib.sha256()
+    for part in [src, piraha.__version__, __version__]:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+class _Encoder:
+    def __init__(self)->None:
+        self.index : Dict[int,int] = {}
+        self.table : List[Dict[str,Any]] = []
+
+    def pattern(self, pat:Pattern)->int:
+        n = self.index.get(id(pat), None)
+        if n is not None:
+            return n
+        n = len(self.table)
+        self.index[id(pat)] = n
+        entry : Dict[str,Any] = {"c":type(pat).__name__}
+        self.table += [entry]
+        entry["a"] = {k:self.value(v) for k,v in pat.__dict__.items()}
+        return n
+
+    def value(self, v:Any)->Any:
+        if isinstance(v, Pattern):
+            return {"p":self.pattern(v)}
+        elif isinstance(v, Grammar):
+            return {"g":0}
+        elif type(v) == list:
+            return [self.value(x) for x in v]
+        elif type(v) == tuple:
+            return {"t":[self.value(x) for x in v]}
+        elif v is None or type(v) in [str, int, bool]:
+            return v
+        else:
+            raise Exception(f"Cannot snapshot {type(v)}")
+
+def _decode(g:Grammar, objs:List[Pattern], v:Any)->Any:
+    if type(v) == list:
+        return [_decode(g, objs, x) for x in v]
+    elif type(v) == dict:
+        if "p" in v:
+            return objs[v["p"]]
+        elif "g" in v:
+            return g
+        else:
+            return tuple([_decode(g, objs, x) for x in v["t"]])
+    else:
+        return v
+
+def dump_grammar(g:Grammar, src:str)->Dict[str,Any]:
+    enc = _Encoder()
+    patterns = {name:enc.pattern(g.patterns[name]) for name in g.patterns}
+    return {
+        "stamp":grammar_stamp(src),
+        "default_rule":g.default_rule,
+        "patterns":patterns,
+        "table":enc.table}
+
+def load_grammar(data:Dict[str,Any], src:str)->Optional[Grammar]:
+    """
+    Rebuild a grammar from dump_grammar() output. Returns
+    None if the data does not match src.
+    """
+    if data.get("stamp",None) != grammar_stamp(src):
+        return None
+    g = Grammar()
+    objs : List[Pattern] = []
+    for entry in data["table"]:
+        cls = pattern_classes[entry["c"]]
+        objs += [cls.__new__(cls)]
+    for obj, entry in zip(objs, data["table"]):
+        obj.__dict__.update({k:_decode(g, objs, v) for k,v in entry["a"].items()})
+    g.patterns = {name:objs[n] for name,n in data["patterns"].items()}
+    g.default_rule = data["default_rule"]
+    return g
+
+def save_snapshot(g:Grammar, src:str, fname:str=snapshot_file)->bool:
+    """
+    Write the snapshot to a temporary file that is then renamed,
+    so processes reading or writing it at the same time never see
+    a partial file.
+    """
+    tmp = None
+    try:
+        dirname = os.path.dirname(os.path.abspath(fname))
+        os.makedirs(dirname, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix=".grammar-")
+        with os.fdopen(fd, "w") as fw:
+            json.dump(dump_grammar(g, src), fw, separators=(',',':'))
+        os.replace(tmp, fname)
+        return True
+    except OSError:
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+
+def load_snapshot(fname:str, src:str)->Optional[Grammar]:
+    try:
+        with open(fname, "r") as fd:
+            return load_grammar(json.load(fd), src)
+    except (OSError, ValueError, KeyError):
+        return None
+
+def compile_grammar(src:str, fname:str=snapshot_file, cache:Optional[str]=None)->Tuple[Grammar,Optional[str]]:
+    """
+    Load the compiled form of the grammar src from the snapshot
+    built into the package, or else from the one in the cache
+    directory (by default ~/.cache/evshell). If neither matches
+    src, compile it the usual way and try to save it in the cache
+    for next time. The file in the cache is named after the
+    grammar's stamp, so versions do not overwrite each other.
+    """
+    stamp = grammar_stamp(src)
+    cache_file = os.path.join(cache_dir() if cache is None else cache, f"grammar-{stamp[:16]}.json")
+    for f in [fname, cache_file]:
+        g = load_snapshot(f, src)
+        if g is not None:
+            return g, g.default_rule
+    g, rule = parse_peg_src(src)
+    save_snapshot(g, src, cache_file)
+    return g, rule
+
+if __name__ == "__main__":
+    # Run when the package is built, to put the
+    # snapshot in the package directory:
+    #   python -m evshell.snapshot [fname]
+    from . import grammar
+    fname = sys.argv[1] if len(sys.argv) > 1 else snapshot_file
+    g, _ = parse_peg_src(grammar)
+    if save_snapshot(g, grammar, fname):
+        print("Wrote",fname)
+    else:
+        print("Could not write",fname)
+        sys.exit(1)
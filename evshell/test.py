@@ -23,6 +23,592 @@ s.stdout = save_io
 
 s.unbind_from_env()
 
+# A pyfunc written as a generator streams
+# between the stages of a pipeline.
+def upper(sh, args, lines):
+    for line in lines:
+        yield line.upper()
+s.pyfuncs["upper"] = upper
+s.stdout = tmpfile()
+s.run_text("echo hello | upper | tr L l")
+assert s.stdout.getvalue() == "HEllO\n"
+s.stdout = save_io
+
+# Shells with their own directories can run side by side in threads
+from threading import Thread
+from tempfile import mkdtemp
+import shutil
+outs = [tmpfile(), tmpfile()]
+tdir = os.path.realpath(mkdtemp())
+dirs = [os.path.join(tdir, "one"), os.path.join(tdir, "two")]
+for d, fname in zip(dirs, ["test.py", "other.py"]):
+    os.mkdir(d)
+    with open(os.path.join(d, fname), "w") as fd:
+        pass
+def session(n):
+    sh = shell([], cwd=dirs[n])
+    sh.stdout = outs[n]
+    sh.run_text("x=%d; cd ..; cd %s; echo $x $(pwd) tes?.py" % (n, os.path.basename(dirs[n])))
+threads = [Thread(target=session, args=(n,)) for n in range(2)]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+assert outs[0].getvalue() == f"0 {dirs[0]} test.py\n", outs[0].getvalue()
+assert outs[1].getvalue() == f"1 {dirs[1]} tes?.py\n", outs[1].getvalue()
+shutil.rmtree(tdir)
+
+# Builtins give the same output as the programs they stand in for
+outs = []
+for on in [True, False]:
+    sh = shell([])
+    if not on:
+        sh.builtins.clear()
+    sh.stdout = tmpfile()
+    sh.run_text("seq -w 8 11 | cat; echo -e 'a\\tb'; basename /a/b.txt .txt; dirname a/b/ x; [ 1 -lt 2 ] && echo lt")
+    outs += [sh.stdout.getvalue()]
+assert outs[0] == outs[1], outs
+
+# Parse trees stored on disk are only used with the grammar they came from
+from . import ParseCache, pp
+from piraha import Matcher
+from tempfile import mkdtemp
+import shutil
+cache_dir = mkdtemp()
+txt = "echo a; echo b\n"
+m = Matcher(pp, "whole_cmd", txt)
+assert m.matches()
+ParseCache(cache_dir=cache_dir, stamp="one").put(txt, m.gr)
+assert ParseCache(cache_dir=cache_dir, stamp="one").get(txt) is not None
+assert ParseCache(cache_dir=cache_dir, stamp="two").get(txt) is None
+shutil.rmtree(cache_dir)
+
+# The packrat parser gives the same tree, and keeps its memo table
+# within max_memo entries
+from . import packrat_grammar
+from .packrat import PackratMatcher
+txt = "for i in 1 2\ndo\n  echo $i ${x:-a} \"q $(echo $i)\" > /dev/null\ndone\n" * 20
+m = Matcher(pp, "whole_cmd", txt)
+assert m.matches()
+for max_memo in [1000000, 100]:
+    m2 = PackratMatcher(packrat_grammar(), "whole_cmd", txt, max_memo)
+    assert m2.matches() and m2.gr.dump() == m.gr.dump()
+    assert m2.hits > 0 and len(m2.memo) <= max_memo
+assert not PackratMatcher(packrat_grammar(), "whole_cmd", "echo $(\n").matches()
+
+# The grammar snapshot goes to the cache directory, never into the
+# package, and is read back from there
+from . import grammar
+from .snapshot import compile_grammar
+cache_dir = mkdtemp()
+pkg_file = os.path.join(cache_dir, "pkg", "grammar.json")
+compile_grammar(grammar, pkg_file, cache_dir)
+assert not os.path.exists(os.path.join(cache_dir, "pkg"))
+saved = [f for f in os.listdir(cache_dir) if f.startswith("grammar-")]
+assert len(saved) == 1, os.listdir(cache_dir)
+g, rule = compile_grammar(grammar, pkg_file, cache_dir)
+assert Matcher(g, "whole_cmd", "echo hi\n").matches()
+assert os.listdir(cache_dir) == saved
+shutil.rmtree(cache_dir)
+
+# Nodes compiled on one run see the variables and functions of later
+# runs; the same script text gets the same (cached) parse tree back
+sh = shell([])
+sh.stdout = tmpfile()
+loop = "for i in 1 2; do f $i; echo x=$x; done\n"
+sh.run_text("function f() {\n  echo one $1\n}\nx=a\n")
+sh.run_text(loop)
+sh.run_text("function f() {\n  echo two $1\n}\nx=b\n")
+sh.run_text(loop)
+sh.run_text("unset x\nfunction f() {\n  echo three $1\n}\n")
+sh.run_text(loop)
+assert sh.stdout.getvalue() == "".join([f"{w} {i}\nx={x}\n" for w, x in [("one","a"), ("two","b"), ("three","")] for i in [1,2]]), sh.stdout.getvalue()
+
+# Background jobs are reaped as soon as they exit, in the order they
+# exit, without waiting on the ones still running
+from .pipe_threads import JobTable, PipeThread
+from time import time
+jobs = JobTable()
+slow = PipeThread(["sleep","1"])
+slow.background(jobs)
+fast = PipeThread(["sleep","0.1"])
+fast.background(jobs)
+t0 = time()
+assert jobs.wait(None) is fast
+assert time()-t0 < 0.9 and slow.returncode is None
+assert jobs.wait(slow.pid) is slow and slow.returncode == 0
+assert jobs.wait(None) is None
+
+# Output of $(...) past the in-memory limit is spilled to a file and
+# split a chunk at a time, with multibyte characters across chunks
+from .capture import Capture, chunk_size
+text = "".join([f"w\u00e9{i}\u00a0x\t\n " for i in range(3*chunk_size//10)])
+pipe = os.pipe()
+writer = Thread(target=lambda: (os.write(pipe[1], text.encode()), os.close(pipe[1])))
+writer.start()
+cap = Capture(max_memory=1000).read_from(pipe[0])
+writer.join()
+os.close(pipe[0])
+assert cap.spill is not None and cap.total > 2*chunk_size
+assert cap.words() == [f"w\u00e9{i}\u00a0x" for i in range(3*chunk_size//10)]
+cap.close()
+# Output of $(...) past max_capture_memory goes to a temporary
+# file, whether the subshell is run in this process or forked
+import evshell
+from .capture import CaptureFile
+class SpyCapture(Capture):
+    def read_from(self, fd):
+        Capture.read_from(self, fd)
+        spilled.append(self.spill is not None)
+        return self
+class SpyCaptureFile(CaptureFile):
+    def close(self):
+        spilled.append(self.file is not None)
+        CaptureFile.close(self)
+evshell.Capture = SpyCapture
+evshell.CaptureFile = SpyCaptureFile
+for inline in [True, False]:
+    spilled = []
+    sh = shell([])
+    sh.inline_subshells = inline
+    sh.max_capture_memory = 1000
+    sh.stdout = tmpfile()
+    sh.run_text("echo $(seq 1 3000)\n")
+    assert sh.stdout.getvalue() == " ".join([str(i) for i in range(1,3001)]) + "\n"
+    assert spilled == [True], spilled
+# A command run from $(...) in this process writes to the file,
+# after what the shell wrote
+spilled = []
+sh = shell([])
+sh.stdout = tmpfile()
+sh.run_text("echo $(echo -n x; /usr/bin/printf ' %s' $(seq 2 3))\n")
+assert sh.stdout.getvalue() == "x 2 3\n" and spilled == [False, True], (sh.stdout.getvalue(), spilled)
+evshell.Capture = Capture
+evshell.CaptureFile = CaptureFile
+cf = CaptureFile(max_memory=1000)
+cf.write("a"*500)
+assert cf.file is None
+cf.write(" b"*300)
+assert cf.file is not None and cf.words() == ["a"*500] + ["b"]*300
+cf.close()
+
+# A reader waiting on an in-process pipe keeps reading after the
+# writer switches to a real pipe for an external command
+from .pipes import Pipe
+from time import sleep
+pipe = Pipe()
+got = []
+reader = Thread(target=lambda: got.append(pipe.reader.read()), daemon=True)
+reader.start()
+pipe.writer.write("a\u00e9")
+sleep(0.1)
+wfd = pipe.writer.fileno()
+os.write(wfd, "b\u00e9\n".encode()[:2])
+sleep(0.1)
+os.write(wfd, "b\u00e9\n".encode()[2:])
+pipe.writer.close()
+reader.join(5)
+assert not reader.is_alive() and got == ["a\u00e9b\u00e9\n"], got
+
+# A writer on its own thread waits while the reader is behind, gets
+# BrokenPipeError if the reader goes away, and all it wrote is read
+from .pipes import max_queued
+pipe = Pipe()
+pipe.threaded_writer = True
+def fill(n):
+    try:
+        for i in range(n):
+            pipe.writer.write("x"*1000)
+        pipe.writer.close()
+    except BrokenPipeError:
+        got.append("broken")
+got = []
+writer = Thread(target=fill, args=(1000,), daemon=True)
+writer.start()
+sleep(0.2)
+assert writer.is_alive() and max_queued <= pipe.queued < max_queued+1000, pipe.queued
+pipe.reader.close()
+writer.join(5)
+assert not writer.is_alive() and got == ["broken"], got
+pipe = Pipe()
+pipe.threaded_writer = True
+writer = Thread(target=fill, args=(1000,), daemon=True)
+writer.start()
+assert len(pipe.reader.read()) == 1000*1000
+writer.join(5)
+assert not writer.is_alive()
+
+# A malformed [[ is a syntax error, not a command
+sh = shell([])
+sh.stdout = tmpfile()
+sh.run_text("[[ a | echo ran ]]\n")
+assert "ran" not in sh.stdout.getvalue(), sh.stdout.getvalue()
+
+# hash sets $?, hash -r empties the table, relative PATH entries are
+# found from the shell's directory, and a PATH change is noticed
+hash_dir = os.path.realpath(mkdtemp())
+for sub, word in [("bin","one"), ("sub/bin","two"), ("other","three")]:
+    os.makedirs(os.path.join(hash_dir, sub))
+    tool = os.path.join(hash_dir, sub, "tool")
+    with open(tool, "w") as fd:
+        fd.write(f"#!/bin/sh\necho {word}\n")
+    os.chmod(tool, 0o755)
+sh = shell([], cwd=hash_dir)
+sh.stdout = tmpfile()
+sh.stderr = tmpfile()
+sh.run_text("PATH=bin:$PATH\ntool\nfalse\nhash tool\necho rc=$?\nhash nosuch\necho rc=$?\n")
+assert sh.cmd_hash.table["tool"] == os.path.join(hash_dir, "bin", "tool")
+sh.run_text("cd sub\ntool\nPATH=%s/other:$PATH\ntool\nhash -r\necho rc=$?\n" % hash_dir)
+assert "tool" not in sh.cmd_hash.table
+assert sh.stdout.getvalue() == "one\nrc=0\nrc=1\ntwo\nthree\nrc=0\n", sh.stdout.getvalue()
+shutil.rmtree(hash_dir)
+
+# A log record still in the buffer is written out when the shell
+# exits normally and when it execs another program
+from .auditlog import read_log, get_log_format
+for fmt in ["json", "binary"]:
+    for cmd in ["true", "exec /bin/true"]:
+        env = dict(os.environ, EVSHELL_LOG_FORMAT=fmt,
+            PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        code = f"from evshell import shell; s = shell([]); s.log(msg='held back'); s.run_text('{cmd}\\n')"
+        p = Popen([sys.executable, "-c", code], env=env)
+        assert p.wait() == 0
+        log_file = os.path.join(s.vars["HOME"], ".evshell-logs", f"log-{p.pid}{get_log_format(fmt).suffix}")
+        msgs = [rec.get("msg", None) for rec in read_log(log_file)]
+        assert "held back" in msgs, (fmt, cmd, msgs)
+        for f in [log_file, log_file+".idx"]:
+            if os.path.exists(f):
+                os.unlink(f)
+
+# A shell that sits idle still writes out its log records
+sh = shell([])
+sh.log_writer.max_delay = 0.2
+sh.log(msg="idle")
+log_file = sh.log_fd.name
+sleep(1)
+assert "idle" in [rec.get("msg", None) for rec in read_log(log_file)]
+sh.log_writer.close()
+os.unlink(log_file)
+
+# Assignments are logged as they happen, unless deferred logging
+# is asked for
+sh = shell([])
+sh.log_sync = "always"
+sh.run_text("tvar=1\n")
+setvars = lambda: [(r["value"], r.get("count", None)) for r in read_log(sh.log_fd.name) if r.get("setvar", None) == "tvar"]
+assert setvars() == [("1", None)], setvars()
+sh.log_setvar = "deferred"
+sh.run_text("tvar=2\ntvar=3\n")
+assert setvars() == [("1", None)], setvars()
+sh.log_flush()
+assert setvars() == [("1", None), ("3", 2)], setvars()
+sh.log_writer.close()
+os.unlink(sh.log_fd.name)
+
+# Binary logs read back as written, with or without their index,
+# from compressed and uncompressed blocks
+from .auditlog import BinaryFormat, Query
+log_dir = mkdtemp()
+recs = [{"time":100.0+i, "pid":4000+i%3, "msg":"start", "args":["ls", f"f{i}"]} if i % 4 == 0 else
+        {"time":100.0+i, "pid":4000+i%3, "setvar":f"x{i}", "value":"\u00e9"*i} for i in range(40)]
+for compress in [True, False]:
+    fmt = BinaryFormat(compress=compress)
+    log_file = os.path.join(log_dir, f"log-1{fmt.suffix}")
+    fd = fmt.open(log_file)
+    fmt.write_block(fd, [fmt.encode(r) for r in recs[:25]])
+    fmt.write_block(fd, [fmt.encode(r) for r in recs[25:]])
+    fd.close()
+    fmt.close()
+    for indexed in [True, False]:
+        if not indexed:
+            os.unlink(log_file+".idx")
+        assert list(read_log(log_file)) == recs
+        assert list(read_log(log_file, Query(since=110, until=130))) == recs[10:31]
+        assert list(read_log(log_file, Query(events={"setvar"}, pid=4001))) == [r for r in recs[1::3] if "setvar" in r]
+        assert list(read_log(log_file, Query(argv="ls f[23]"))) == [recs[20], recs[24], recs[28], recs[32], recs[36]]
+
+# Processes sharing a binary log each index their own blocks
+fmt = BinaryFormat(compress=False)
+log_file = os.path.join(log_dir, f"log-2{fmt.suffix}")
+fd = fmt.open(log_file)
+writers = []
+for w in range(8):
+    pid = os.fork()
+    if pid == 0:
+        for i in range(1000):
+            fmt.write_block(fd, [fmt.encode({"time":float(i), "pid":w, "msg":"x"*(i%50)})]*(1+i%3))
+        os._exit(0)
+    writers += [pid]
+for pid in writers:
+    os.waitpid(pid, 0)
+fd.close()
+fmt.close()
+got = sorted([(r["pid"], r["time"]) for r in read_log(log_file)])
+assert got == sorted([(w, float(i)) for w in range(8) for i in range(1000) for _ in range(1+i%3)])
+shutil.rmtree(log_dir)
+
+# VarStore's split words follow every way of changing a value
+from .varstore import VarStore, EnvStore
+vs = VarStore(a="x  y\tz")
+assert vs.split("a") == ["x", "y", "z"]
+vs["a"] = "p q"
+assert vs.split("a") == ["p", "q"]
+vs.update(a="r")
+assert vs.split("a") == ["r"]
+vs.setdefault("a", "unused")
+assert vs.split("a") == ["r"]
+vs.pop("a")
+vs.setdefault("a", "s t")
+assert vs.split("a") == ["s", "t"]
+del vs["a"]
+assert "a" not in vs and "a" not in vs.split_cache
+sh = shell([])
+sh.stdout = tmpfile()
+sh.run_text('x="1 2"\nfor i in $x; do echo $i; done\nx=3\nfor i in $x; do echo $i; done\nunset x\necho "[$x]"\n')
+assert sh.stdout.getvalue() == "1\n2\n3\n[]\n", sh.stdout.getvalue()
+
+# EnvStore hands out one copy of the environment until it changes,
+# and commands see exports, changes to them and unsets
+es = EnvStore(A="1")
+snap = es.snapshot()
+es["A"] = "1"
+assert es.snapshot() is snap
+es["B"] = "2"
+assert es.snapshot() == {"A":"1", "B":"2"} and snap == {"A":"1"}
+del es["A"]
+assert es.snapshot() == {"B":"2"}
+sh = shell([])
+sh.stdout = tmpfile()
+sh.run_text("export EVT=one\nenv | grep ^EVT=\nEVT=two\nenv | grep ^EVT=\nunset EVT\nenv | grep -c ^EVT=\n")
+assert sh.stdout.getvalue() == "EVT=one\nEVT=two\n0\n", sh.stdout.getvalue()
+# An empty environment stays empty, whether the command is exec'd
+# or started as a new process
+for cmd in ["/usr/bin/env", "exec /usr/bin/env"]:
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    code = f"from evshell import shell; s = shell([]); s.exports = {{}}; s.run_text('{cmd}\\n')"
+    out = Popen([sys.executable, "-c", code], env=env, stdout=PIPE).communicate()[0]
+    assert out == b"", (cmd, out)
+
+# The posix_spawn launcher runs commands as Popen does
+from .pipe_threads import Spawned
+p = PipeThread(["true"], launcher="spawn")
+assert isinstance(p.p, Spawned) and p.communicate() is not None and p.returncode == 0
+p = PipeThread(["true"], stdout=PIPE, launcher="spawn")
+assert not isinstance(p.p, Spawned)
+p.communicate()
+outs = []
+for launcher in ["popen", "spawn"]:
+    sh = shell([])
+    sh.launcher = launcher
+    sh.stdout = tmpfile()
+    sh.run_text("ls -d / | tr / x\nsh -c 'exit 3'\necho rc=$?\nsh -c 'echo err >&2' 2>&1 | tr e E\nenv | grep -c ^PATH=\n")
+    # A writer to a closed pipe dies quietly of SIGPIPE
+    err_file = os.path.join(mkdtemp(), "seq.err")
+    sh.run_text(f"/usr/bin/seq 1 10000000 2>{err_file} | head -1\ncat {err_file}\n")
+    shutil.rmtree(os.path.dirname(err_file))
+    outs += [sh.stdout.getvalue()]
+assert outs[0] == outs[1] == "x\nrc=3\nErr\n1\n1\n", outs
+
+# A server worker runs -c commands under a Python policy
+from .server import Server, Policy
+import signal
+srv_dir = mkdtemp()
+policy_file = os.path.join(srv_dir, "nodate.py")
+with open(policy_file, "w") as fd:
+    fd.write("import os\nfrom evshell import ShellAccess\n"
+        "def allow_cmd(args):\n"
+        "    if os.path.basename(args[0]) == 'date':\n"
+        "        raise ShellAccess('date is not allowed')\n"
+        "    return args\n")
+def start_server(sock_path, policies, workers=1):
+    """
+    Fork a server in a process group of its own, so that
+    stop_server() also stops its workers.
+    """
+    server = Server(sock_path, policies, workers)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgid(0, 0)
+            server.serve_forever()
+        finally:
+            os._exit(1)
+    os.setpgid(pid, pid)
+    server.sock.close()
+    return pid
+def stop_server(pid):
+    os.killpg(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+sock_path = os.path.join(srv_dir, "sock")
+server_pid = start_server(sock_path, {"nodate":Policy(policy_file)})
+client = os.path.join(os.path.dirname(os.path.abspath(__file__)), "client.py")
+p = Popen([sys.executable, "-S", client, "--socket", sock_path, "--policy", "nodate", "-c", "echo $((6*7)); date"],
+    stdout=PIPE, stderr=PIPE, universal_newlines=True)
+out, err = p.communicate()
+stop_server(server_pid)
+shutil.rmtree(srv_dir)
+assert out == "42\n" and "date is not allowed" in err, (out, err)
+
+# PathPolicy decides on the real path: symlinks and .. are resolved
+# first, and a root only covers whole path components
+from .policy import PathPolicy
+from . import ShellAccess
+def allowed(hook, fname, cwd=None):
+    try:
+        hook(fname, cwd)
+        return True
+    except ShellAccess:
+        return False
+base = os.path.realpath(mkdtemp())
+for d in ["tmp/w", "tmp/secret", "tmpx", "other"]:
+    os.makedirs(os.path.join(base, d))
+os.symlink(os.path.join(base, "other"), os.path.join(base, "tmp", "out"))
+os.symlink(os.path.join(base, "tmp", "w"), os.path.join(base, "other", "in"))
+os.symlink(os.path.join(base, "tmp", "secret"), os.path.join(base, "tmp", "w", "hidden"))
+paths = PathPolicy(read=[os.path.join(base, "tmp")], write=[os.path.join(base, "tmp", "w")],
+    deny=[os.path.join(base, "tmp", "secret")])
+assert allowed(paths.allow_read, os.path.join(base, "tmp", "f"))
+assert allowed(paths.allow_read, os.path.join(base, "tmp"))
+assert not allowed(paths.allow_read, os.path.join(base, "tmpx", "f"))
+assert not allowed(paths.allow_read, os.path.join(base, "tmpx"))
+assert not allowed(paths.allow_write, os.path.join(base, "tmp", "f"))
+assert allowed(paths.allow_write, os.path.join(base, "tmp", "w", "f"))
+assert not allowed(paths.allow_write, os.path.join(base, "tmp", "wx"))
+assert not allowed(paths.allow_read, os.path.join(base, "tmp", "secret", "f"))
+assert not allowed(paths.allow_read, os.path.join(base, "tmp", "out", "f"))
+assert allowed(paths.allow_write, os.path.join(base, "other", "in", "f"))
+assert not allowed(paths.allow_read, os.path.join(base, "tmp", "w", "hidden", "f"))
+assert not allowed(paths.allow_read, os.path.join(base, "tmp", "..", "tmpx", "f"))
+assert not allowed(paths.allow_read, "../other/f", os.path.join(base, "tmp"))
+assert allowed(paths.allow_read, "../tmp/f", os.path.join(base, "tmpx"))
+assert allowed(paths.allow_cd, "w", os.path.join(base, "tmp"))
+assert not allowed(paths.allow_cd, "secret", os.path.join(base, "tmp"))
+assert paths.allow_write("in/f", os.path.join(base, "other")) == os.path.join(base, "tmp", "w", "f")
+shutil.rmtree(base)
+
+# AccessPolicy looks command names up on the shell's PATH when they
+# are run, and each regex keeps its own backreferences
+from .policy import AccessPolicy
+base = os.path.realpath(mkdtemp())
+for d in ["one", "two"]:
+    os.makedirs(os.path.join(base, d))
+    shutil.copy("/bin/echo", os.path.join(base, d, "tool"))
+access = AccessPolicy({"commands":{"tool":{"args":[{"regex":"(x)y"}, {"regex":"(a)\\1"}]}}})
+sh = shell([], cwd=base)
+access.install(sh)
+sh.stdout = tmpfile()
+sh.stderr = tmpfile()
+sh.run_text(f"PATH={base}/one:$PATH\ntool aa\n")
+denied = 0
+try:
+    sh.run_text("tool ab\n")
+except ShellAccess:
+    denied += 1
+sh.run_text(f"PATH={base}/two:$PATH\ntool xy\n")
+try:
+    sh.run_text(f"{base}/one/tool aa\n")
+except ShellAccess:
+    denied += 1
+assert sh.stdout.getvalue() == "aa\nxy\n", sh.stdout.getvalue()
+assert denied == 2
+shutil.rmtree(base)
+
+# DirCache reads a directory once while it is unchanged, and again
+# once its mtime moves
+from .globber import DirCache
+glob_dir = os.path.realpath(mkdtemp())
+for f in ["a.txt", "b.txt"]:
+    open(os.path.join(glob_dir, f), "w").close()
+dc = DirCache()
+assert sorted([e.name for e in dc.scandir(glob_dir)]) == ["a.txt", "b.txt"]
+assert sorted([e.name for e in dc.scandir(glob_dir)]) == ["a.txt", "b.txt"]
+assert dc.stats() == {"hits":1, "misses":1, "dirs":1}
+open(os.path.join(glob_dir, "c.txt"), "w").close()
+st = os.stat(glob_dir)
+os.utime(glob_dir, ns=(st.st_atime_ns, st.st_mtime_ns+1000))
+assert sorted([e.name for e in dc.scandir(glob_dir)]) == ["a.txt", "b.txt", "c.txt"]
+assert dc.stats()["misses"] == 2
+sh = shell([], cwd=glob_dir)
+sh.stdout = tmpfile()
+sh.run_text("for i in 1 2 3; do echo *.txt; done\n")
+assert sh.stdout.getvalue() == "a.txt b.txt c.txt\n"*3
+assert sh.dir_cache is not None and sh.dir_cache.hits >= 2 and sh.dir_cache.stats()["dirs"] == 0
+shutil.rmtree(glob_dir)
+
+# AsyncShell runs commands through a server or in a new process,
+# with and without input, and streams the output of started jobs
+import asyncio
+from .aio import AsyncShell, ServerJob, ProcessJob
+async def aio_session(ash):
+    results = [await ash.run("echo out; echo err >&2; exit 3")]
+    results += [await ash.run("tr a-z A-Z", input=b"abc\n"*20000)]
+    job = await ash.start("seq 3; cat", input=b"x\n")
+    results += [type(job), [line async for line in job.stdout], await job.wait()]
+    return results
+aio_dir = mkdtemp()
+sock_path = os.path.join(aio_dir, "sock")
+aio_env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+server_pid = start_server(sock_path, {}, workers=2)
+try:
+    for served in [True, False]:
+        results = asyncio.run(aio_session(AsyncShell(server=served, path=sock_path, env=aio_env)))
+        assert results == [(3, "out\n", "err\n"), (0, "ABC\n"*20000, ""),
+            ServerJob if served else ProcessJob, [b"1\n", b"2\n", b"3\n", b"x\n"], 0], results
+finally:
+    stop_server(server_pid)
+missing = os.path.join(aio_dir, "missing")
+assert asyncio.run(AsyncShell(path=missing, env=aio_env).run("echo fallback")) == (0, "fallback\n", "")
+try:
+    asyncio.run(AsyncShell(server=True, path=missing, env=aio_env).run("true"))
+    assert False, "expected OSError"
+except OSError:
+    pass
+shutil.rmtree(aio_dir)
+
+# Batch scripts each run in a child of their worker, so exec and
+# signals only end that script, and they get their own $0 and $@
+from .batch import run_batch
+batch_dir = mkdtemp()
+for name, text in [("args.sh", "echo $0 $2 $1\n"),
+        ("exec.sh", "echo -n before\nexec echo after\necho not reached\n"),
+        ("kill.sh", "echo dying\nkill -9 $$\n"),
+        ("exit.sh", "echo four >&2\nexit 4\n")]:
+    with open(os.path.join(batch_dir, name), "w") as fd:
+        fd.write(text)
+results = sorted([(r.fname, r.rc, r.stdout, r.stderr) for r in
+    run_batch([["args.sh", "x", "y"], "exec.sh", "kill.sh", "exit.sh", "exec.sh"], 2, cwd=batch_dir)])
+assert results == [("args.sh", 0, "args.sh y x\n", ""), ("exec.sh", 0, "beforeafter\n", ""),
+    ("exec.sh", 0, "beforeafter\n", ""), ("exit.sh", 4, "", "four\n"),
+    ("kill.sh", 137, "dying\n", "kill.sh: killed by SIGKILL\n")], results
+evshell_cmd = [sys.executable, "-c", "import sys; sys.argv[0] = 'evshell'; from evshell import main; main()"]
+p = Popen(evshell_cmd + ["--parallel", "2"], stdin=PIPE, stdout=PIPE, stderr=PIPE,
+    universal_newlines=True, cwd=batch_dir, env=aio_env)
+out, err = p.communicate("args.sh 'a b' c\nexec.sh\n")
+assert p.returncode == 0 and sorted(out.splitlines()) == ["args.sh c a b", "beforeafter"] and err == "", (out, err)
+p = Popen(evshell_cmd + ["--parallel", "2", "exit.sh", "exec.sh"], stdout=PIPE, stderr=PIPE,
+    universal_newlines=True, cwd=batch_dir, env=aio_env)
+out, err = p.communicate()
+assert p.returncode == 1 and out == "beforeafter\n" and err == "four\n", (out, err)
+shutil.rmtree(batch_dir)
+
+# The cat builtin streams into the next stage of a pipeline, in
+# this process or not, with more data than a pipe buffer holds
+cat_dir = mkdtemp()
+cat_file = os.path.join(cat_dir, "big.txt")
+cat_text = "".join([f"line {i} \u00e9\n" for i in range(40000)])
+with open(cat_file, "w") as fd:
+    fd.write(cat_text)
+for cmd, expect in [("cat big.txt | cat", cat_text), ("cat big.txt | tr a-z A-Z | cat", cat_text.replace("line", "LINE")),
+        ("cat big.txt - < big.txt | cat", cat_text*2)]:
+    sh = shell([], cwd=cat_dir)
+    sh.stdout = tmpfile()
+    runner = Thread(target=sh.run_text, args=(cmd+"\n",), daemon=True)
+    runner.start()
+    runner.join(30)
+    assert not runner.is_alive(), f"{cmd} hangs"
+    assert sh.stdout.getvalue() == expect, cmd
+shutil.rmtree(cat_dir)
+
 def test(cmd,fname=None):
     varsave = {}
     outsave = s.stdout
@@ -106,7 +692,15 @@ test("if [ 1 = 0 ]; then echo true; else echo false; fi")
 test("if [ 1 \\> 0 ]; then echo true; else echo false; fi")
 test("if [ 1 \\< 0 ]; then echo true; else echo false; fi")
 test("if [ 1 != 0 ]; then echo true; else echo false; fi")
+test("for i in 1 2 3; do if [ $i -lt 2 -o ! -e nosuch -a -z \"$i\" ]; then echo $i; fi; done")
+test("if [[ -d evshell && ( a == a* || 1 -gt 2 ) ]]; then echo true; fi; [[ b < a ]] || echo false")
 test("echo {a,b{c,d}}{e,f}")
+test("echo hi; for a in 1 2 3; do for b in 4 5 6; do echo $a$b; done; done")
+test('echo "x${b:-$(date +%m-%d-%Y)}y"')
+s.packrat = True
+test("echo ho; for a in 1 2; do for b in 4 5; do echo $a-$b; done; done")
+test('echo "y${b:-$(echo a b)}x" $((2+3)) [[ x')
+s.packrat = False
 s.run_text('if [ a = b ]; then echo $HOME; fi;')
 #s.run_text('''
 #for x in 1 2 3
@@ -143,6 +737,11 @@ test('python3 ./x.py a b c')
 os.environ['q'] = "a b c"
 test('python3 ./x.py $q')
 test('echo $(seq 1 10)')
+test('echo $(seq 1 3) | wc -c')
+test('seq 1 100000 | tail -1')
+test('echo $(seq 1 3 | tail -1)')
+test('(x=1; cd /; pwd; echo $x); echo "$x"; pwd')
+test('echo $(for i in 1 2; do printf $i; done) $(cd /; pwd)')
 s.run_text('ls x*')
 s.run_text('ls a*')
 test('ls x.{py,sh}')
@@ -153,7 +752,21 @@ function zap() {
 zap
 ''')
 test("echo {a,b{c,d}}")
+test("echo {1..5} {a..e..2} {05..10} {3..-1} x{}y {x} {a..c}{1..2}")
+test("for i in {1..3} x{a,b}; do echo $i; done")
+test("for f in *.la *.lb {1..2}*.lb; do echo \"$f\"; echo x > new.lb; done; rm new.lb")
+test("function f() {\n  echo one $x\n}\nfor i in 1 2 3\ndo\n  x=$i\n  f\n  function f() {\n    echo two $x\n  }\ndone\n")
+test("seq 3 | cat; seq 5 -2 1; true && echo t; false || echo f; test a = b || echo ne; [ -d . ] && echo dir")
 test("echo x*")
+test("""x="a b"; [[ $x == "a b" ]] && echo yes; [[ x == "*" ]] || echo no; [[ x == * ]] && echo any""")
+test("""[[ abc == a"*" ]] || echo lit; [[ a*c == a"*"? ]] && echo mixed; [[ a?c == a\\?c ]] && echo esc; [[ abc == a\\?c ]] || echo esc2""")
+test("""p='a*'; [[ abc == $p ]] && echo var; [[ abc == "$p" ]] || echo qvar; [[ a.c =~ ^a"."c ]] && echo re; [[ abc =~ ^a"."c ]] || echo re2""")
+test("""[[ a =~ (a|b) ]] && echo re; [[ foo =~ ^(foo|bar)$ ]] && echo fb; [[ foobar =~ ^(foo|bar)$ ]] || echo nofb""")
+test("""x=bar; [[ $x =~ ^(foo|$x)$ ]] && echo var; [[ ab =~ ^a"|"b$ ]] || echo lit; [[ a.b =~ a\\.b && axb =~ a\\.b ]] || echo esc""")
+test("""[[ x -lt 3 ]]; echo $?; x=5; y=x; [[ x -lt 7 ]] && echo lt; [[ y -eq 5 ]] && echo eq""")
+test("cat a.sh | cat; cat a.sh | tr a-z A-Z | cat")
+test("for w in $(echo -e 'a\\vb\\fc d\\t e\\n'); do echo word; done")
+test("echo ?.sh [a-b].* .* */")
 test("./a.sh")
 test("./a.sh && ./b.sh")
 test("./a.sh || ./b.sh")
@@ -0,0 +1,310 @@
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from fnmatch import fnmatchcase
+import os
+import re
+import stat
+
+# The expressions of test, [ ... ] and [[ ... ]]. An expression is
+# parsed into closures by precedence, lowest first:
+#
+#   or:      and ( -o | || ) and ...
+#   and:     not ( -a | && ) not ...
+#   not:     ! not | primary
+#   primary: ( or ) | arg binary_op arg | unary_op arg | arg
+#
+# test and [ with at most four arguments follow the rules POSIX
+# gives by the number of arguments, so that e.g. [ ! = x ] compares
+# strings. Files are stat()ed at most once per expression.
+
+unary_ops = set(["-a", "-b", "-c", "-d", "-e", "-f", "-g", "-h", "-k", "-n", "-p",
+    "-r", "-s", "-t", "-u", "-v", "-w", "-x", "-z", "-G", "-L", "-N", "-O", "-S"])
+binary_ops = set(["=", "==", "!=", "<", ">", "-eq", "-ne", "-lt", "-le", "-gt", "-ge",
+    "-nt", "-ot", "-ef"])
+# The logical operators of test and of [[
+single_ops = {"and":"-a", "or":"-o"}
+double_ops = {"and":"&&", "or":"||"}
+
+int_arg = re.compile(r'\s*[+-]?[0-9]+\s*')
+var_arg = re.compile(r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*')
+
+file_types = {"-b":stat.S_ISBLK, "-c":stat.S_ISCHR, "-d":stat.S_ISDIR,
+    "-f":stat.S_ISREG, "-p":stat.S_ISFIFO, "-S":stat.S_ISSOCK}
+file_bits = {"-g":stat.S_ISGID, "-u":stat.S_ISUID, "-k":stat.S_ISVTX}
+access_modes = {"-r":os.R_OK, "-w":os.W_OK, "-x":os.X_OK}
+
+Node = Callable[[],bool]
+
+def glob_escape(text:str)->str:
+    """
+    text as an fnmatch pattern that matches only itself.
+    """
+    return re.sub(r'([*?[])', r'[\1]', text)
+
+class CondWord(str):
+    """
+    An operand of [[ ]], made from the parts of the word and
+    whether each was quoted. As a str it is the word's value.
+    glob and regex are its forms as the pattern of == and !=,
+    and of =~: the quoted parts match only themselves.
+    """
+    glob : str
+    regex : str
+
+    def __new__(cls, parts:List[Tuple[str,bool]])->'CondWord':
+        word = str.__new__(cls, "".join([text for text, _ in parts]))
+        word.glob = "".join([glob_escape(text) if quoted else text for text, quoted in parts])
+        word.regex = "".join([re.escape(text) if quoted else text for text, quoted in parts])
+        return word
+
+def glob_of(arg:str)->str:
+    return arg.glob if isinstance(arg, CondWord) else arg
+
+def regex_of(arg:str)->str:
+    return arg.regex if isinstance(arg, CondWord) else arg
+
+class TestError(Exception):
+    """
+    A malformed expression. test then fails with status 2.
+    """
+    pass
+
+class TestExpr:
+    """
+    An expression of test, or of [[ if double is set. sh supplies
+    path() for file names and vars for -v. The arguments of [[ are
+    CondWords, so that quoted pattern characters match literally.
+    """
+    def __init__(self, sh:Any, args:List[str], double:bool=False)->None:
+        self.sh = sh
+        self.args = args
+        self.double = double
+        self.ops = double_ops if double else single_ops
+        self.pos = 0
+        self.stats : Dict[Tuple[str,bool],Optional[os.stat_result]] = {}
+
+    def evaluate(self)->bool:
+        return self.compile()()
+
+    def compile(self)->Node:
+        args = self.args
+        if not self.double and len(args) <= 4:
+            return self.posix(args)
+        self.pos = 0
+        node = self.parse_or()
+        if self.pos < len(args):
+            if self.double:
+                raise TestError(f"syntax error in conditional expression near `{args[self.pos]}'")
+            raise TestError("too many arguments")
+        return node
+
+    def posix(self, args:List[str])->Node:
+        n = len(args)
+        if n == 0:
+            return lambda: False
+        if n == 1:
+            return lambda: args[0] != ""
+        if n == 2:
+            if args[0] == "!":
+                return lambda: args[1] == ""
+            if args[0] in unary_ops:
+                return self.unary(args[0], args[1])
+            raise TestError(f"{args[0]}: unary operator expected")
+        if n == 3:
+            if args[1] in binary_ops:
+                return self.binary(args[0], args[1], args[2])
+            if args[1] == "-a":
+                return lambda: args[0] != "" and args[2] != ""
+            if args[1] == "-o":
+                return lambda: args[0] != "" or args[2] != ""
+            if args[0] == "!":
+                return negate(self.posix(args[1:]))
+            if args[0] == "(" and args[2] == ")":
+                return lambda: args[1] != ""
+            raise TestError(f"{args[1]}: binary operator expected")
+        if args[0] == "!":
+            return negate(self.posix(args[1:]))
+        if args[0] == "(" and args[3] == ")":
+            return self.posix(args[1:3])
+        self.pos = 0
+        node = self.parse_or()
+        if self.pos < n:
+            raise TestError("too many arguments")
+        return node
+
+    def peek(self, ahead:int=0)->Optional[str]:
+        if self.pos+ahead < len(self.args):
+            return self.args[self.pos+ahead]
+        return None
+
+    def next(self)->str:
+        tok = self.peek()
+        if tok is None:
+            raise TestError("argument expected")
+        self.pos += 1
+        return tok
+
+    def parse_or(self)->Node:
+        node = self.parse_and()
+        while self.peek() == self.ops["or"]:
+            self.pos += 1
+            node = either(node, self.parse_and())
+        return node
+
+    def parse_and(self)->Node:
+        node = self.parse_not()
+        while self.peek() == self.ops["and"]:
+            self.pos += 1
+            node = both(node, self.parse_not())
+        return node
+
+    def parse_not(self)->Node:
+        if self.peek() == "!" and self.peek(1) is not None:
+            self.pos += 1
+            return negate(self.parse_not())
+        return self.parse_primary()
+
+    def parse_primary(self)->Node:
+        tok = self.next()
+        op = self.peek()
+        if op is not None and (op in binary_ops or (self.double and op == "=~")) and self.peek(1) is not None:
+            self.pos += 2
+            return self.binary(tok, op, self.args[self.pos-1])
+        if tok == "(":
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise TestError("`)' expected")
+            self.pos += 1
+            return node
+        if tok in unary_ops and op is not None:
+            self.pos += 1
+            return self.unary(tok, op)
+        return lambda: tok != ""
+
+    def stat(self, fname:str, follow:bool=True)->Optional[os.stat_result]:
+        key = (fname, follow)
+        if key not in self.stats:
+            st : Optional[os.stat_result] = None
+            try:
+                path = self.sh.path(fname)
+                st = os.stat(path) if follow else os.lstat(path)
+            except (OSError, ValueError):
+                pass
+            self.stats[key] = st
+        return self.stats[key]
+
+    def integer(self, arg:str, depth:int=0)->int:
+        """
+        The value of an integer operand. In [[ it is evaluated as
+        arithmetic: it may also be empty (0) or a variable's name.
+        """
+        if int_arg.fullmatch(arg) is not None:
+            return int(arg)
+        if self.double:
+            g = var_arg.fullmatch(arg)
+            if arg.strip() == "":
+                return 0
+            elif g is not None and depth < 100:
+                return self.integer(self.sh.vars.get(g.group(1), ""), depth+1)
+            raise TestError(f"{arg}: syntax error in expression")
+        raise TestError(f"{arg}: integer expression expected")
+
+    def unary(self, op:str, arg:str)->Node:
+        if op == "-z":
+            return lambda: arg == ""
+        elif op == "-n":
+            return lambda: arg != ""
+        elif op == "-v":
+            return lambda: arg in self.sh.vars
+        elif op == "-t":
+            fd = self.integer(arg)
+            return lambda: os.isatty(fd)
+        elif op in ["-a", "-e"]:
+            return lambda: self.stat(arg) is not None
+        elif op in ["-h", "-L"]:
+            return lambda: has_mode(self.stat(arg, False), stat.S_ISLNK)
+        elif op in file_types:
+            return lambda: has_mode(self.stat(arg), file_types[op])
+        elif op in file_bits:
+            return lambda: has_bit(self.stat(arg), file_bits[op])
+        elif op in access_modes:
+            return lambda: os.access(self.sh.path(arg), access_modes[op])
+        elif op == "-s":
+            return lambda: has_value(self.stat(arg), lambda st: st.st_size > 0)
+        elif op == "-O":
+            return lambda: has_value(self.stat(arg), lambda st: st.st_uid == os.geteuid())
+        elif op == "-G":
+            return lambda: has_value(self.stat(arg), lambda st: st.st_gid == os.getegid())
+        elif op == "-N":
+            return lambda: has_value(self.stat(arg), lambda st: st.st_mtime_ns > st.st_atime_ns)
+        assert False, op
+
+    def binary(self, a:str, op:str, b:str)->Node:
+        if op in ["=", "=="]:
+            if self.double:
+                pat = glob_of(b)
+                return lambda: fnmatchcase(a, pat)
+            return lambda: a == b
+        elif op == "!=":
+            if self.double:
+                pat = glob_of(b)
+                return lambda: not fnmatchcase(a, pat)
+            return lambda: a != b
+        elif op == "<":
+            return lambda: a < b
+        elif op == ">":
+            return lambda: a > b
+        elif op == "=~":
+            try:
+                regex = re.compile(regex_of(b))
+            except re.error as e:
+                raise TestError(f"{b}: {e}")
+            return lambda: regex.search(a) is not None
+        elif op in ["-nt", "-ot", "-ef"]:
+            return lambda: compare_files(op, self.stat(a), self.stat(b))
+        x = self.integer(a)
+        y = self.integer(b)
+        if op == "-eq":
+            return lambda: x == y
+        elif op == "-ne":
+            return lambda: x != y
+        elif op == "-lt":
+            return lambda: x < y
+        elif op == "-le":
+            return lambda: x <= y
+        elif op == "-gt":
+            return lambda: x > y
+        elif op == "-ge":
+            return lambda: x >= y
+        assert False, op
+
+def negate(node:Node)->Node:
+    return lambda: not node()
+
+def both(a:Node, b:Node)->Node:
+    return lambda: a() and b()
+
+def either(a:Node, b:Node)->Node:
+    return lambda: a() or b()
+
+def has_value(st:Optional[os.stat_result], pred:Callable[[os.stat_result],bool])->bool:
+    return st is not None and pred(st)
+
+def has_mode(st:Optional[os.stat_result], is_type:Callable[[int],bool])->bool:
+    return st is not None and is_type(st.st_mode)
+
+def has_bit(st:Optional[os.stat_result], bit:int)->bool:
+    return st is not None and st.st_mode & bit != 0
+
+def compare_files(op:str, st1:Optional[os.stat_result], st2:Optional[os.stat_result])->bool:
+    if op == "-nt":
+        return st1 is not None and (st2 is None or st1.st_mtime_ns > st2.st_mtime_ns)
+    elif op == "-ot":
+        return st2 is not None and (st1 is None or st1.st_mtime_ns < st2.st_mtime_ns)
+    return st1 is not None and st2 is not None and (st1.st_dev, st1.st_ino) == (st2.st_dev, st2.st_ino)
+
+def evaltest(sh:Any, args:List[str], double:bool=False)->bool:
+    """
+    Evaluate an expression of test, or of [[ if double is set.
+    Raises TestError if it is malformed.
+    """
+    return TestExpr(sh, args, double).evaluate()
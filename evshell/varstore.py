@@ -0,0 +1,102 @@
+from typing import Any, Dict, List, Optional, Tuple
+import re
+
+class VarStore(Dict[str,str]):
+    """
+    The shell's variables. It is a dict of names to values that
+    also remembers the words each value splits into, so that
+    a variable used many times is only split once per write.
+    """
+    def __init__(self, *args:Any, **kwargs:str)->None:
+        dict.__init__(self, *args, **kwargs)
+        self.split_cache : Dict[str,List[str]] = {}
+
+    def split(self, name:str)->List[str]:
+        """
+        The words of the value of name, split on whitespace.
+        The caller must not modify the list.
+        """
+        words = self.split_cache.get(name, None)
+        if words is None:
+            words = re.split(r'\s+', self[name])
+            self.split_cache[name] = words
+        return words
+
+    def __setitem__(self, name:str, value:str)->None:
+        dict.__setitem__(self, name, value)
+        self.split_cache.pop(name, None)
+
+    def __delitem__(self, name:str)->None:
+        dict.__delitem__(self, name)
+        self.split_cache.pop(name, None)
+
+    def pop(self, name:str, *default:Any)->Any:
+        self.split_cache.pop(name, None)
+        return dict.pop(self, name, *default)
+
+    def popitem(self)->Tuple[str,str]:
+        self.split_cache.clear()
+        return dict.popitem(self)
+
+    def setdefault(self, name:str, value:str="")->str:
+        self.split_cache.pop(name, None)
+        return dict.setdefault(self, name, value)
+
+    def update(self, *args:Any, **kwargs:str)->None:
+        self.split_cache.clear()
+        dict.update(self, *args, **kwargs)
+
+    def clear(self)->None:
+        self.split_cache.clear()
+        dict.clear(self)
+
+class EnvStore(Dict[str,str]):
+    """
+    The exported variables. Every change bumps version, and
+    snapshot() returns a copy that is only rebuilt after a change,
+    so the commands started in between share one environment.
+    """
+    def __init__(self, *args:Any, **kwargs:str)->None:
+        dict.__init__(self, *args, **kwargs)
+        self.version = 0
+        self.snap : Optional[Dict[str,str]] = None
+        self.snap_version = -1
+
+    def snapshot(self)->Dict[str,str]:
+        """
+        The environment for a new process. The caller
+        must not modify it.
+        """
+        if self.snap is None or self.snap_version != self.version:
+            self.snap = dict(self)
+            self.snap_version = self.version
+        return self.snap
+
+    def __setitem__(self, name:str, value:str)->None:
+        if dict.get(self, name, None) != value:
+            dict.__setitem__(self, name, value)
+            self.version += 1
+
+    def __delitem__(self, name:str)->None:
+        dict.__delitem__(self, name)
+        self.version += 1
+
+    def pop(self, name:str, *default:Any)->Any:
+        self.version += 1
+        return dict.pop(self, name, *default)
+
+    def popitem(self)->Tuple[str,str]:
+        self.version += 1
+        return dict.popitem(self)
+
+    def setdefault(self, name:str, value:str="")->str:
+        self.version += 1
+        return dict.setdefault(self, name, value)
+
+    def update(self, *args:Any, **kwargs:str)->None:
+        self.version += 1
+        dict.update(self, *args, **kwargs)
+
+    def clear(self)->None:
+        self.version += 1
+        dict.clear(self)
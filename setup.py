@@ -1,5 +1,9 @@
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
+import os
 import re
+import subprocess
+import sys
 
 vfile="evshell/version.py"
 verstrline = open(vfile, "rt").read()
@@ -10,6 +14,17 @@ if g:
 else:
     raise RuntimeError(f"Unable to find version in file '{vfile}")
 
+class build_py_snapshot(build_py):
+    """
+    Also put the compiled grammar (see evshell/snapshot.py) into
+    the built package. If piraha is not available to the build,
+    the snapshot is made in the user's cache directory at run time.
+    """
+    def run(self)->None:
+        build_py.run(self)
+        target = os.path.join(self.build_lib, "evshell", "grammar.json")
+        subprocess.call([sys.executable, "-m", "evshell.snapshot", target], cwd=self.build_lib)
+
 setup(
   name='evshell',
   version=__version__,
@@ -20,6 +35,7 @@ setup(
   author_email='steven@stevenrbrandt.com',
   license='LGPL',
   packages=['evshell'],
+  cmdclass={'build_py':build_py_snapshot},
   entry_points = {
     'console_scripts' : ['evshell=evshell:main'],
   },